@@ -1,37 +1,110 @@
 # Import necessary libraries
-from flask import Flask, request, jsonify, session # Import session
+from flask import Flask, Request, request, jsonify, session, Response, stream_with_context # Import session
 from flask_cors import CORS
 from dotenv import load_dotenv
 import os
 import logging
-import google.generativeai as genai
-import pandas as pd
-import docx
-import pytesseract
-import cv2
-import fitz  # PyMuPDF
-import pdfplumber
+import importlib
 import pathlib
 import json
 import re
-import numpy as np
 from io import BytesIO
-from PIL import Image
 import secrets # Import secrets for generating a key
-from googletrans import Translator # For translation
 import time # Potentially for translation delays
-from flask_pymongo import PyMongo # type: ignore
-from bson import ObjectId
 import jwt
 import datetime
 from functools import wraps
 from werkzeug.security import generate_password_hash, check_password_hash
-import firebase_admin
-from firebase_admin import credentials, firestore
-import docx2txt
+from werkzeug.utils import secure_filename
+import click
+import password_worker # Process pool side of PasswordHasher
+import extraction_worker # Process pool side of PDF extraction and OCR
 import io
+import hashlib
+import itertools
+import sqlite3
+import tempfile
+import threading
+import zlib
+import zipfile
+import unicodedata
+import math
+from collections import Counter, OrderedDict, deque
+from contextlib import nullcontext
+from concurrent.futures import CancelledError, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+# --- Lazy Imports ---
+
+class LazyObject:
+    """Stand-in for a heavy module or client that is only built (by `factory()`) on first attribute access.
+
+    Keeps importing app.py cheap for every worker process and script; construction is thread-safe and
+    its duration is recorded for /api/metrics and the startup benchmark.
+    """
+
+    registry = [] # Every LazyObject, in definition order
+
+    def __init__(self, name, factory):
+        self._lazy_name = name
+        self._lazy_factory = factory
+        self._lazy_target = None
+        self._lazy_seconds = None
+        self._lazy_lock = threading.Lock()
+        LazyObject.registry.append(self)
+
+    def _lazy_load(self):
+        target = self._lazy_target
+        if target is None:
+            with self._lazy_lock:
+                if self._lazy_target is None:
+                    start = time.perf_counter()
+                    self._lazy_target = self._lazy_factory()
+                    self._lazy_seconds = time.perf_counter() - start
+                    logging.info(f"Loaded {self._lazy_name} on first use in {self._lazy_seconds:.3f}s.")
+                target = self._lazy_target
+        return target
+
+    def __getattr__(self, attr):
+        return getattr(self._lazy_load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._lazy_target is not None else "not loaded"
+        return f"<LazyObject {self._lazy_name} ({state})>"
+
+def lazy_import(module_name):
+    """Returns a LazyObject that imports `module_name` on first use."""
+    return LazyObject(module_name, lambda: importlib.import_module(module_name))
+
+def preload_lazy_dependencies():
+    """Loads every lazy module and client now (e.g. in a pre-forking server's master process)."""
+    for lazy in LazyObject.registry:
+        lazy._lazy_load()
+
+def lazy_load_stats():
+    return {
+        lazy._lazy_name: {"loaded": lazy._lazy_target is not None,
+                          "seconds": round(lazy._lazy_seconds, 4) if lazy._lazy_seconds is not None else None}
+        for lazy in LazyObject.registry
+    }
+
+np = lazy_import("numpy")
+openpyxl = lazy_import("openpyxl")
+cv2 = lazy_import("cv2")
+fitz = lazy_import("fitz") # PyMuPDF
+pdfplumber = lazy_import("pdfplumber")
+docx = lazy_import("docx")
+Image = lazy_import("PIL.Image")
+ImageOps = lazy_import("PIL.ImageOps")
+genai = lazy_import("google.generativeai")
+googletrans = lazy_import("googletrans") # For translation
+firebase_admin = lazy_import("firebase_admin")
+credentials = lazy_import("firebase_admin.credentials")
+firestore = lazy_import("firebase_admin.firestore")
 
 # --- Constants ---
+ANALYSIS_IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tiff", ".tif", ".webp") # Sent to Gemini as images
+ANALYSIS_TEXT_EXTENSIONS = (".pdf", ".docx", ".xlsx", ".txt", ".rtf", ".csv") # Text is extracted and analyzed
 MAX_CHAT_HISTORY_TURNS = 10 # Number of conversation pairs (user + model) to keep
 MAX_CONTEXT_CHARS_FOR_CHAT = 30000 # Max characters of document context to inject into chat prompt
 MAX_TEXT_ANALYSIS_CHARS = 200000 # Max characters fed into initial text analysis
@@ -41,6 +114,72 @@ MAX_TEXT_ANALYSIS_CHARS = 200000 # Max characters fed into initial text analysis
 # Load environment variables
 load_dotenv()
 
+# --- Performance Settings (override via environment) ---
+CACHE_DIR = os.getenv("MEDINSIGHT_CACHE_DIR", os.path.join(os.getcwd(), "cache")) # Local cache databases live here
+ANALYSIS_CACHE_ENABLED = os.getenv("ANALYSIS_CACHE_ENABLED", "true").lower() == "true"
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", 2000))
+ANALYSIS_CACHE_MAX_BYTES = int(os.getenv("ANALYSIS_CACHE_MAX_BYTES", 256 * 1024 * 1024)) # Compressed bytes on disk
+ANALYSIS_CACHE_TTL_SECONDS = int(os.getenv("ANALYSIS_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+ANALYSIS_CACHE_VERSION = "v1" # Bump when prompts/schema change so stale analyses are not served
+XLSX_LABELED_CELLS = os.getenv("XLSX_LABELED_CELLS", "false").lower() == "true" # Emit spreadsheet rows as "Header: value" pairs of non-empty cells
+ANALYSIS_MAP_REDUCE = os.getenv("ANALYSIS_MAP_REDUCE", "true").lower() == "true" # Analyze documents over MAX_TEXT_ANALYSIS_CHARS in chunks and merge the results
+ANALYSIS_CHUNK_CHARS = int(os.getenv("ANALYSIS_CHUNK_CHARS", 100000)) # Text per map-reduce chunk (one model call each)
+ANALYSIS_MAX_CHUNKS = int(os.getenv("ANALYSIS_MAX_CHUNKS", 10)) # Text beyond this many chunks is still cut off
+ANALYSIS_MAP_CONCURRENCY = int(os.getenv("ANALYSIS_MAP_CONCURRENCY", 4)) # Chunk analyses in flight at once per document
+EXTRACTION_MAX_CHARS = int(os.getenv("EXTRACTION_MAX_CHARS", ANALYSIS_CHUNK_CHARS * max(1, ANALYSIS_MAX_CHUNKS - 1) if ANALYSIS_MAP_REDUCE else MAX_TEXT_ANALYSIS_CHARS)) # Stop reading a document once this much text is extracted (0 reads it all); a chunk below the map-reduce total, as chunks end on line breaks
+PDF_EXTRACTION_WORKERS = int(os.getenv("PDF_EXTRACTION_WORKERS", os.cpu_count() or 1)) # Process pool size for page-sharded PDF extraction
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", 32)) # Smaller PDFs are extracted in-process (pool overhead outweighs the gain)
+PDF_OCR_ENABLED = os.getenv("PDF_OCR_ENABLED", "true").lower() == "true" # OCR pages that have no text layer (scanned PDFs)
+PDF_OCR_DPI = int(os.getenv("PDF_OCR_DPI", 200))
+ANALYSIS_JOB_BACKEND = os.getenv("ANALYSIS_JOB_BACKEND", "thread") # 'thread' (worker pool) or 'inline' (run in the request, for tests)
+ANALYSIS_JOB_WORKERS = int(os.getenv("ANALYSIS_JOB_WORKERS", 4))
+ANALYSIS_JOB_MAX_PENDING = int(os.getenv("ANALYSIS_JOB_MAX_PENDING", 100)) # Queued jobs beyond this are rejected with 503
+ANALYSIS_JOB_TTL_SECONDS = int(os.getenv("ANALYSIS_JOB_TTL_SECONDS", 900)) # Finished jobs are kept this long for polling
+TRANSLATION_BATCH_MAX_CHARS = int(os.getenv("TRANSLATION_BATCH_MAX_CHARS", 4500)) # Google Translate rejects requests above ~5000 chars
+TRANSLATION_BATCH_MAX_ITEMS = int(os.getenv("TRANSLATION_BATCH_MAX_ITEMS", 50))
+TRANSLATION_MAX_CONCURRENCY = int(os.getenv("TRANSLATION_MAX_CONCURRENCY", 4)) # Parallel translation requests per analysis
+TRANSLATION_MEMORY_SIZE = int(os.getenv("TRANSLATION_MEMORY_SIZE", 5000)) # In-memory LRU entries; 0 disables the translation memory
+TRANSLATION_MEMORY_DISK = os.getenv("TRANSLATION_MEMORY_DISK", "true").lower() == "true" # Also persist translations under CACHE_DIR
+TRANSLATION_MEMORY_DISK_MAX_ENTRIES = int(os.getenv("TRANSLATION_MEMORY_DISK_MAX_ENTRIES", 100000))
+TRANSLATION_MEMORY_TTL_SECONDS = int(os.getenv("TRANSLATION_MEMORY_TTL_SECONDS", 30 * 24 * 3600))
+CONTEXT_STORE_MAX_ENTRIES = int(os.getenv("CONTEXT_STORE_MAX_ENTRIES", 256)) # Documents kept (compressed) in process memory for chat
+CONTEXT_STORE_TTL_SECONDS = int(os.getenv("CONTEXT_STORE_TTL_SECONDS", 24 * 3600))
+CONTEXT_STORE_DISK = os.getenv("CONTEXT_STORE_DISK", "true").lower() == "true" # Share contexts across worker processes via SQLite
+CONTEXT_STORE_DISK_MAX_ENTRIES = int(os.getenv("CONTEXT_STORE_DISK_MAX_ENTRIES", 10000))
+CONTEXT_STORE_DISK_MAX_BYTES = int(os.getenv("CONTEXT_STORE_DISK_MAX_BYTES", 512 * 1024 * 1024))
+CHAT_FULL_CONTEXT_MAX_CHARS = int(os.getenv("CHAT_FULL_CONTEXT_MAX_CHARS", 8000)) # Documents up to this size are sent whole; larger ones use retrieval
+CHAT_CHUNK_CHARS = int(os.getenv("CHAT_CHUNK_CHARS", 1200))
+CHAT_CHUNK_OVERLAP_CHARS = int(os.getenv("CHAT_CHUNK_OVERLAP_CHARS", 200))
+CHAT_RETRIEVAL_TOP_K = int(os.getenv("CHAT_RETRIEVAL_TOP_K", 8)) # Chunks retrieved per chat question
+CHAT_SUMMARY_MAX_CHARS = int(os.getenv("CHAT_SUMMARY_MAX_CHARS", 2000)) # Rolling summary of turns older than MAX_CHAT_HISTORY_TURNS
+CHAT_SUMMARY_SNIPPET_CHARS = 160 # Per-side length of a summarized turn
+USER_CACHE_TTL_SECONDS = int(os.getenv("USER_CACHE_TTL_SECONDS", 30)) # How long token_required may reuse a user lookup (0 disables)
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", 10000))
+PRELOAD_DEPENDENCIES = os.getenv("PRELOAD_DEPENDENCIES", "false").lower() == "true" # Import heavy libraries and create clients at startup instead of on first use
+EMAIL_INDEX_LEGACY_FALLBACK = os.getenv("EMAIL_INDEX_LEGACY_FALLBACK", "true").lower() == "true" # Query by email for accounts missing from the index until backfill_email_index has completed (false: no pre-index accounts exist)
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", max(1, (os.cpu_count() or 1) // 2))) # Dedicated hashing processes (0 hashes on the request thread)
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", 32)) # Hashes queued or running at once; extra callers wait for a slot
+PASSWORD_HASH_QUEUE_TIMEOUT_SECONDS = float(os.getenv("PASSWORD_HASH_QUEUE_TIMEOUT_SECONDS", 5)) # Longest wait for a slot before answering 503
+UPLOAD_MEMORY_MAX_BYTES = int(os.getenv("UPLOAD_MEMORY_MAX_BYTES", 8 * 1024 * 1024)) # Uploaded files up to this size are buffered in memory; larger ones spill to a temp file
+MAX_CONTENT_LENGTH = int(os.getenv("MAX_CONTENT_LENGTH", 256 * 1024 ** 2)) # Request bodies over this size are rejected with 413 (0 = no limit)
+UPLOAD_STORE_MAX_BYTES = int(os.getenv("UPLOAD_STORE_MAX_BYTES", 2 * 1024 ** 3)) # Least recently used uploads are deleted beyond this much disk
+UPLOAD_STORE_MAX_AGE_SECONDS = int(os.getenv("UPLOAD_STORE_MAX_AGE_SECONDS", 24 * 3600)) # Uploads not used for this long are deleted
+UPLOAD_STORE_GC_INTERVAL_SECONDS = int(os.getenv("UPLOAD_STORE_GC_INTERVAL_SECONDS", 600)) # How often the eviction thread runs (0 disables it)
+IMAGE_MAX_LONG_EDGE = int(os.getenv("IMAGE_MAX_LONG_EDGE", 3072)) # Images sent to Gemini are downscaled to at most this many pixels on the long edge...
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", 6_000_000)) # ...and this many pixels in total
+IMAGE_TARGET_BYTES = int(os.getenv("IMAGE_TARGET_BYTES", 1_500_000)) # JPEG quality is lowered (down to IMAGE_MIN_JPEG_QUALITY) to fit this payload size
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", 90))
+IMAGE_MIN_JPEG_QUALITY = int(os.getenv("IMAGE_MIN_JPEG_QUALITY", 60))
+SPECULATIVE_EXTRACTION = os.getenv("SPECULATIVE_EXTRACTION", "true").lower() == "true" # Start extracting text documents as soon as they are uploaded
+SPECULATIVE_EXTRACTION_WORKERS = int(os.getenv("SPECULATIVE_EXTRACTION_WORKERS", 2)) # Background threads (PDF pages still fan out to the extraction pool)
+SPECULATIVE_EXTRACTION_MAX_ENTRIES = int(os.getenv("SPECULATIVE_EXTRACTION_MAX_ENTRIES", 32)) # Extracted texts kept for /analyze; the oldest is dropped beyond this
+SPECULATIVE_EXTRACTION_TTL_SECONDS = int(os.getenv("SPECULATIVE_EXTRACTION_TTL_SECONDS", 600)) # Unclaimed results are dropped after this long
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", 30)) # Files accepted by one /analyze/batch request
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", 8)) # Files of one batch extracted and analyzed at once
+BATCH_MODEL_CONCURRENCY = int(os.getenv("BATCH_MODEL_CONCURRENCY", 4)) # Gemini requests (map-reduce chunks included) in flight at once across all batches
+BATCH_UPLOAD_MEMORY_MAX_BYTES = int(os.getenv("BATCH_UPLOAD_MEMORY_MAX_BYTES", 1024 * 1024)) # Per-file memory buffer for /analyze/batch (bigger files spill to disk)
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "") # werkzeug method string, e.g. "scrypt:32768:8:1" or "pbkdf2:sha256:600000" ('' = werkzeug default)
+
 # Initialize Flask
 app = Flask(__name__)
 CORS(app, supports_credentials=True) # Allow credentials for session cookies
@@ -56,48 +195,396 @@ log = logging.getLogger('werkzeug') # Flask's default logger
 log.setLevel(logging.INFO)
 
 # Set the path to Tesseract OCR (Ensure this is correct for your system)
-TESSERACT_PATH = os.getenv("TESSERACT_CMD", r"C:\\Program Files\\Tesseract-OCR\\tesseract.exe") # Default to Windows path if not set in .env
-try:
-    if os.path.exists(TESSERACT_PATH):
-        pytesseract.pytesseract.tesseract_cmd = TESSERACT_PATH
-        logging.info(f"Using Tesseract at: {pytesseract.pytesseract.tesseract_cmd}")
-    else:
-        logging.warning(f"Tesseract path '{TESSERACT_PATH}' does not exist. OCR will likely fail. Set TESSERACT_CMD environment variable if needed.")
-except Exception as e:
-     logging.error(f"Error setting up Tesseract path: {e}. Please ensure Tesseract is installed and the path/environment variable is correct.")
+TESSERACT_PATH = extraction_worker.TESSERACT_PATH # TESSERACT_CMD (and the OCR_* settings) are read by extraction_worker, which runs the OCR
+if os.path.exists(TESSERACT_PATH):
+    logging.info(f"Using Tesseract at: {TESSERACT_PATH}")
+else:
+    logging.warning(f"Tesseract path '{TESSERACT_PATH}' does not exist. OCR will likely fail. Set TESSERACT_CMD environment variable if needed.")
+
+pytesseract = LazyObject("pytesseract", extraction_worker.load_pytesseract)
 
 # Configure API Keys
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if not GEMINI_API_KEY:
     raise ValueError("❌ GEMINI_API_KEY is missing in .env file.")
 
-# Configure Gemini API
-genai.configure(api_key=GEMINI_API_KEY)
-try:
-    # Use a model capable of multimodal input and good chat performance
-    gemini_model = genai.GenerativeModel("gemini-1.5-flash-latest")
-    logging.info("Using gemini-1.5-flash-latest for analysis and chat.")
-except Exception as e:
-    logging.warning(f"Could not initialize gemini-1.5-flash-latest, falling back to gemini-pro. Error: {e}")
-    gemini_model = genai.GenerativeModel("gemini-pro") # Fallback
+# Configure Gemini API (on first use)
+def _create_gemini_model():
+    genai.configure(api_key=GEMINI_API_KEY)
+    try:
+        # Use a model capable of multimodal input and good chat performance
+        model = genai.GenerativeModel("gemini-1.5-flash-latest")
+        logging.info("Using gemini-1.5-flash-latest for analysis and chat.")
+    except Exception as e:
+        logging.warning(f"Could not initialize gemini-1.5-flash-latest, falling back to gemini-pro. Error: {e}")
+        model = genai.GenerativeModel("gemini-pro") # Fallback
+    return model
+
+gemini_model = LazyObject("gemini_model", _create_gemini_model)
 
 # Uploads directory
 UPLOAD_FOLDER = os.path.join(os.getcwd(), "uploads")
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH or None # 0 = no limit
+
+
+class MemoryDocument:
+    """An uploaded document held in memory, accepted wherever extraction takes a file path.
+
+    `name` supplies the extension and the name used in logs; `data` is any bytes-like object (bytes, or
+    a memoryview over an UploadBuffer), handed to the parsing libraries without writing it to disk.
+    `sha256` is the data's hex digest, if already known.
+    """
+
+    def __init__(self, name, data, sha256=None):
+        self.name = name
+        self.data = data
+        self.sha256 = sha256
+        self._bytes = None
+
+    @property
+    def size(self):
+        return memoryview(self.data).nbytes
+
+    def open(self):
+        """A binary file object over the data, for libraries that only take paths or file objects."""
+        return io.BytesIO(self.data)
+
+    def tobytes(self):
+        """The data as bytes (copied once), e.g. to send it to the extraction process pool."""
+        if self._bytes is None:
+            self._bytes = self.data if isinstance(self.data, bytes) else bytes(self.data)
+        return self._bytes
+
+
+def source_name(source):
+    """File name of an extraction source (a file path or a MemoryDocument)."""
+    return source.name if isinstance(source, MemoryDocument) else os.path.basename(source)
+
+def open_source(source):
+    """Opens an extraction source for binary reading."""
+    return source.open() if isinstance(source, MemoryDocument) else open(source, "rb")
+
+def path_or_file(source):
+    """The path itself, or a file object for a MemoryDocument (for libraries that accept either)."""
+    return source.open() if isinstance(source, MemoryDocument) else source
+
+def pool_source(source):
+    """A picklable form of an extraction source for process pool workers: the absolute path (workers keep
+    the working directory their forkserver started in), or the document's bytes."""
+    return source.tobytes() if isinstance(source, MemoryDocument) else os.path.abspath(source)
+
+def open_pdf(source):
+    """fitz.open for a file path, raw PDF bytes or a MemoryDocument."""
+    return extraction_worker.open_pdf(source.data if isinstance(source, MemoryDocument) else source)
+
+
+class UploadBuffer:
+    """Writable, seekable buffer that receives one uploaded file while the request body is parsed.
+
+    The data stays in a BytesIO until it would grow past `max_memory` bytes, then moves to a named
+    temporary file in `spill_dir` (keeping the upload's extension) so it can still be opened by path.
+    The SHA-256 is computed as the data is written. close() deletes the temporary file unless
+    detach_spill() handed it over.
+    """
+
+    _counts = Counter()
+    _counts_lock = threading.Lock()
+
+    def __init__(self, max_memory, filename=None, spill_dir=None):
+        self.max_memory = max_memory
+        self.filename = filename
+        self.spill_dir = spill_dir
+        self.path = None # Set once the data has spilled to disk
+        self._file = io.BytesIO()
+        self._digest = hashlib.sha256()
+        self._hashed_bytes = 0
+        self._closed = False
+        self._detached = False
+
+    def write(self, data):
+        if self.path is None and self._file.tell() + len(data) > self.max_memory:
+            self._spill()
+        if self._digest is not None:
+            if self._file.tell() == self._hashed_bytes:
+                self._digest.update(data)
+                self._hashed_bytes += len(data)
+            else: # Written out of order; sha256() reads the data back instead
+                self._digest = None
+        return self._file.write(data)
+
+    def _spill(self):
+        suffix = pathlib.Path(self.filename or "").suffix.lower()
+        spill = tempfile.NamedTemporaryFile(prefix="upload_", suffix=suffix, dir=self.spill_dir, delete=False)
+        position = self._file.tell()
+        spill.write(self._file.getbuffer())
+        spill.seek(position)
+        self._file = spill
+        self.path = spill.name
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def readline(self, size=-1):
+        return self._file.readline(size)
+
+    def seek(self, offset, whence=0):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def flush(self):
+        self._file.flush()
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def sha256(self):
+        """Hex SHA-256 of the buffered data (computed during the writes unless they were out of order)."""
+        position = self._file.tell()
+        size = self._file.seek(0, io.SEEK_END)
+        if self._digest is not None and self._hashed_bytes == size:
+            self._file.seek(position)
+            return self._digest.hexdigest()
+        digest = hashlib.sha256()
+        self._file.seek(0)
+        for chunk in iter(lambda: self._file.read(1024 * 1024), b""):
+            digest.update(chunk)
+        self._file.seek(position)
+        return digest.hexdigest()
+
+    def document(self, name=None):
+        """The upload as an extraction source: a MemoryDocument viewing the buffer (no copy) or the spill file's path."""
+        if self.path is not None:
+            self._file.flush()
+            return self.path
+        return MemoryDocument(name or self.filename or "upload", self._file.getbuffer(), sha256=self.sha256())
+
+    def detach_spill(self):
+        """Closes the spill file and hands it to the caller, who becomes responsible for it; returns its path."""
+        self._file.close()
+        self._detached = True
+        return self.path
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        with self._counts_lock:
+            self._counts['spilled' if self.path else 'in_memory'] += 1
+        try:
+            self._file.close()
+        except BufferError: # A MemoryDocument still views the buffer; it is freed with the last view
+            pass
+        if self.path and not self._detached:
+            try:
+                os.remove(self.path)
+            except OSError as e:
+                logging.warning(f"Could not delete spilled upload {self.path}: {e}")
+
+    @classmethod
+    def stats(cls):
+        with cls._counts_lock:
+            return {'in_memory': cls._counts['in_memory'], 'spilled': cls._counts['spilled'],
+                    'memory_max_bytes': UPLOAD_MEMORY_MAX_BYTES}
+
+
+class SpooledUploadRequest(Request):
+    """Request class that buffers uploaded files in an UploadBuffer (werkzeug keeps only files under 500 KB in memory).
+
+    Batch requests carry up to BATCH_MAX_FILES files, so each of them gets the smaller BATCH_UPLOAD_MEMORY_MAX_BYTES.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        max_memory = BATCH_UPLOAD_MEMORY_MAX_BYTES if self.endpoint == 'analyze_batch' else UPLOAD_MEMORY_MAX_BYTES
+        return UploadBuffer(max_memory, filename, spill_dir=upload_store.tmp_dir)
+
+
+app.request_class = SpooledUploadRequest
+
+# Initialize Translator (on first use)
+translator = LazyObject("translator", lambda: googletrans.Translator())
+
+# Initialize Firebase Admin (on first use)
+FIREBASE_CREDENTIALS_PATH = os.path.abspath('serviceAccountKey.json') # Service account JSON in the backend directory
+
+def _create_firestore_client():
+    cred = credentials.Certificate(FIREBASE_CREDENTIALS_PATH)
+    firebase_admin.initialize_app(cred)
+    return firestore.client()
 
-# Initialize Translator
-translator = Translator()
+db = LazyObject("firestore_client", _create_firestore_client)
 
-# Initialize Firebase Admin
-cred = credentials.Certificate('serviceAccountKey.json')  # Updated path to the JSON file in the backend directory
-firebase_admin.initialize_app(cred)
-db = firestore.client()
+if PRELOAD_DEPENDENCIES:
+    preload_lazy_dependencies()
 
 # JWT configuration
 JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
 JWT_ACCESS_TOKEN_EXPIRES = datetime.timedelta(days=1)
 
+class UserCache:
+    """Short-TTL in-process cache of user document snapshots, keyed by user id.
+
+    `loader(user_id)` fetches a snapshot on a miss (Firestore by default; any stand-in with the same
+    interface works). Only existing users are cached. Writers must call invalidate(); other worker
+    processes see changes once their entry expires (USER_CACHE_TTL_SECONDS).
+    """
+
+    def __init__(self, loader, ttl_seconds=30, max_entries=10000):
+        self.loader = loader
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # user_id -> (fetched_at, snapshot)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and now - entry[0] <= self.ttl_seconds:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        snapshot = self.loader(user_id)
+        if snapshot.exists and self.ttl_seconds > 0:
+            with self._lock:
+                self._entries[user_id] = (now, snapshot)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return snapshot
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "entries": len(self._entries),
+            }
+
+user_cache = UserCache(lambda user_id: db.collection('users').document(user_id).get(),
+                       ttl_seconds=USER_CACHE_TTL_SECONDS, max_entries=USER_CACHE_MAX_ENTRIES)
+
+class PasswordHasherBusy(Exception):
+    """Raised when no hashing slot frees up within PASSWORD_HASH_QUEUE_TIMEOUT_SECONDS."""
+
+
+class PasswordHasher:
+    """Runs werkzeug password hashing and checking on a dedicated process pool.
+
+    Hashes are deliberately CPU-heavy, so a burst of logins would otherwise pin the request threads
+    that also serve /analyze. At most `max_pending` operations are queued or running; further callers
+    wait up to `queue_timeout` seconds for a slot and then get PasswordHasherBusy. Queue time (slot
+    wait plus pool queue) and run time are tracked per operation. `workers=0` hashes inline. The pool
+    runs password_worker.timed_password_call (see that module for how its workers are started).
+    """
+
+    def __init__(self, workers, max_pending=32, queue_timeout=5.0, method=None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.queue_timeout = queue_timeout
+        self.method = method or None
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.rejected = 0
+        self._ops = {} # name -> {'count', 'queue_seconds', 'max_queue_seconds', 'run_seconds'}
+
+    def hash(self, password):
+        kwargs = {'method': self.method} if self.method else {}
+        return self._run('hash', password, **kwargs)
+
+    def check(self, pwhash, password):
+        return self._run('check', pwhash, password)
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = password_worker.create_pool(self.workers)
+                logging.info(f"Started password hashing pool with {self.workers} workers.")
+            return self._pool
+
+    def _reset_pool(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def _run(self, name, *args, **kwargs):
+        submitted_at = time.time()
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self.rejected += 1
+            raise PasswordHasherBusy(f"No password hashing slot within {self.queue_timeout}s")
+        with self._lock:
+            self.in_flight += 1
+        try:
+            if self.workers <= 0:
+                result, started_at, run_seconds = password_worker.timed_password_call(name, *args, **kwargs)
+            else:
+                try:
+                    result, started_at, run_seconds = self._get_pool().submit(password_worker.timed_password_call, name, *args, **kwargs).result()
+                except BrokenProcessPool as pool_err:
+                    logging.error(f"Password hashing pool failed ({pool_err}); hashing in-process.")
+                    self._reset_pool()
+                    result, started_at, run_seconds = password_worker.timed_password_call(name, *args, **kwargs)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self._slots.release()
+        queue_seconds = max(0.0, started_at - submitted_at)
+        with self._lock:
+            op = self._ops.setdefault(name, {'count': 0, 'queue_seconds': 0.0, 'max_queue_seconds': 0.0, 'run_seconds': 0.0})
+            op['count'] += 1
+            op['queue_seconds'] += queue_seconds
+            op['max_queue_seconds'] = max(op['max_queue_seconds'], queue_seconds)
+            op['run_seconds'] += run_seconds
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'in_flight': self.in_flight,
+                'rejected': self.rejected,
+                'operations': {
+                    name: {
+                        'count': op['count'],
+                        'avg_queue_ms': round(op['queue_seconds'] * 1000 / op['count'], 2),
+                        'max_queue_ms': round(op['max_queue_seconds'] * 1000, 2),
+                        'avg_run_ms': round(op['run_seconds'] * 1000 / op['count'], 2),
+                    }
+                    for name, op in self._ops.items()
+                },
+            }
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, max_pending=PASSWORD_HASH_MAX_PENDING,
+                                 queue_timeout=PASSWORD_HASH_QUEUE_TIMEOUT_SECONDS, method=PASSWORD_HASH_METHOD)
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -110,7 +597,7 @@ def token_required(f):
         
         try:
             data = jwt.decode(token, JWT_SECRET_KEY, algorithms=["HS256"])
-            current_user = db.collection('users').document(data['user_id']).get()
+            current_user = user_cache.get(data['user_id']) # Avoids a Firestore round trip per request for hot users
             if not current_user.exists:
                 return jsonify({'message': 'User not found'}), 401
         except:
@@ -148,6 +635,7 @@ def update_user_profile(current_user):
             
         # Update user document
         current_user.reference.update(update_data)
+        user_cache.invalidate(current_user.id)
         
         return jsonify({'message': 'Profile updated successfully'}), 200
     except Exception as e:
@@ -167,6 +655,7 @@ def update_avatar(current_user):
         current_user.reference.update({
             'avatar': data['avatar']
         })
+        user_cache.invalidate(current_user.id)
         
         return jsonify({'message': 'Avatar updated successfully'}), 200
     except Exception as e:
@@ -180,204 +669,575 @@ def update_avatar(current_user):
 # Keep the functions from the previous version here.
 # ... (Include all the utility functions from the previous answer here) ...
 
-def preprocess_image(image):
-    """Preprocesses an image for better OCR."""
-    try:
-        # Convert to grayscale
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        # Apply median blur to remove noise
-        gray = cv2.medianBlur(gray, 3)
-        # Apply thresholding - OTSU is good for bimodal histograms
-        thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
-        # Optional: Dilation and Erosion to remove noise (use carefully)
-        # kernel = np.ones((1, 1), np.uint8)
-        # thresh = cv2.dilate(thresh, kernel, iterations=1)
-        # thresh = cv2.erode(thresh, kernel, iterations=1)
-        return thresh
-    except cv2.error as cv_err:
-         if "color conversion" in str(cv_err):
-             logging.warning(f"Image seems to be already grayscale or has unsupported channels. Trying direct Otsu threshold.")
-             try:
-                 # If it's already gray or has alpha, try just thresholding
-                 if len(image.shape) == 2: # Grayscale
-                    gray = image
-                 elif image.shape[2] == 4: # BGRA/RGBA
-                    gray = cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY)
-                 else: # Unexpected shape
-                    logging.error(f"Unsupported image channel count: {image.shape}")
-                    return None
-                 thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
-                 return thresh
-             except Exception as fallback_err:
-                 logging.error(f"Error during fallback preprocessing: {fallback_err}")
-                 return None
-         else:
-             logging.error(f"Error during image preprocessing (OpenCV): {cv_err}")
-             return None
-    except Exception as e:
-        logging.error(f"General error during image preprocessing: {e}")
-        return None
+class OcrMetrics:
+    """Thread-safe per-strategy OCR counters (runs, wins, cumulative time)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.strategies = {}
+        self.modes = {}
+
+    def record(self, report):
+        with self._lock:
+            self.modes[report["mode"]] = self.modes.get(report["mode"], 0) + 1
+            for ocr_pass in report["passes"]:
+                stats = self.strategies.setdefault(f"psm{ocr_pass['psm']}", {"runs": 0, "wins": 0, "total_seconds": 0.0})
+                stats["runs"] += 1
+                stats["total_seconds"] += ocr_pass["seconds"]
+                if ocr_pass["psm"] == report["chosen_psm"]:
+                    stats["wins"] += 1
+
+    def stats(self):
+        with self._lock:
+            strategies = {
+                name: dict(values, total_seconds=round(values["total_seconds"], 4),
+                           avg_seconds=round(values["total_seconds"] / values["runs"], 4) if values["runs"] else 0.0)
+                for name, values in self.strategies.items()
+            }
+            return {"modes": dict(self.modes), "strategies": strategies}
+
+ocr_metrics = OcrMetrics()
 
-def extract_text_from_image(file_path):
-    """Extracts text from an image using OCR with preprocessing."""
+def ocr_image(image, label="image"):
+    """Adaptive OCR of an OpenCV image; records per-strategy metrics in this process."""
+    text, report = extraction_worker.ocr_image_with_report(image, label)
+    ocr_metrics.record(report)
+    return text
+
+def extract_text_from_image(source):
+    """Extracts text from an image (file path or MemoryDocument) using OCR with preprocessing."""
+    filename = source_name(source)
     try:
-        image = cv2.imread(file_path)
+        if isinstance(source, MemoryDocument):
+            image = cv2.imdecode(np.frombuffer(source.data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        else:
+            image = cv2.imread(source)
         if image is None:
-            logging.error(f"Error: Could not read image at {file_path} using OpenCV.")
+            logging.error(f"Error: Could not read image {filename} using OpenCV.")
             # Try with PIL as a fallback for formats OpenCV might struggle with
             try:
-                pil_image = Image.open(file_path)
+                with open_source(source) as f:
+                    pil_image = Image.open(f).convert('RGB')
                 image = cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR) # Convert PIL to OpenCV
-                logging.info(f"Successfully read image {os.path.basename(file_path)} using PIL fallback.")
+                logging.info(f"Successfully read image {filename} using PIL fallback.")
             except Exception as pil_err:
-                logging.error(f"PIL fallback also failed for {file_path}: {pil_err}")
+                logging.error(f"PIL fallback also failed for {filename}: {pil_err}")
                 return ""
 
-        preprocessed_image = preprocess_image(image)
-        if preprocessed_image is None:
-             logging.warning(f"Preprocessing failed for image {file_path}, attempting OCR on original image.")
-             # Attempt OCR on the original grayscale version if preprocessing failed
-             try:
-                 if len(image.shape) == 3:
-                     gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-                 else: # Assume already gray
-                     gray_image = image
-                 text = pytesseract.image_to_string(gray_image, config='--oem 3 --psm 3').strip() # Use default PSM 3
-                 if text:
-                     logging.info(f"OCR successful on original grayscale image for {file_path} after preprocessing failure.")
-                 else:
-                     logging.warning(f"OCR yielded no text on original grayscale image either for {file_path}.")
-                 return text
-             except Exception as ocr_fallback_err:
-                 logging.error(f"Error during OCR fallback attempt for {file_path}: {ocr_fallback_err}")
-                 return ""
-
-        # Try PSM 6 first (Assume a single uniform block of text)
-        custom_config = r'--oem 3 --psm 6'
-        text = pytesseract.image_to_string(preprocessed_image, config=custom_config).strip()
-
-        if not text or len(text) < 20: # If PSM 6 yields little/no text, try PSM 3 (Auto page segmentation)
-             logging.warning(f"OCR with PSM 6 yielded minimal/no text for {os.path.basename(file_path)} (len: {len(text)}), trying PSM 3 (Auto).")
-             custom_config = r'--oem 3 --psm 3'
-             text = pytesseract.image_to_string(preprocessed_image, config=custom_config).strip()
-
-        if not text:
-            logging.warning(f"Final OCR attempt yielded no text for {os.path.basename(file_path)}.")
-
-        return text
+        return ocr_image(image, filename)
     except pytesseract.TesseractNotFoundError:
          logging.error("TESSERACT NOT FOUND. Please install Tesseract and ensure pytesseract.pytesseract.tesseract_cmd points to the executable.")
          return "Error: Tesseract not found."
     except Exception as e:
-        logging.error(f"Error during OCR for {os.path.basename(file_path)}: {e}", exc_info=True)
+        logging.error(f"Error during OCR for {filename}: {e}", exc_info=True)
         return ""
 
-def extract_text(file_path):
-    """Extract text from PDFs, DOCX, Images (using OCR), and Excel files."""
-    extracted_text = ""
-    ext = pathlib.Path(file_path).suffix.lower()
-    filename = os.path.basename(file_path)
-
+_extraction_pool = None
+_extraction_pool_lock = threading.Lock()
+
+def get_extraction_pool():
+    """Returns the shared process pool used for CPU-bound extraction work (created on first use)."""
+    global _extraction_pool
+    with _extraction_pool_lock:
+        if _extraction_pool is None:
+            _extraction_pool = extraction_worker.create_pool(max(1, PDF_EXTRACTION_WORKERS))
+            logging.info(f"Started extraction process pool with {max(1, PDF_EXTRACTION_WORKERS)} workers.")
+        return _extraction_pool
+
+def _reset_extraction_pool():
+    """Drops a broken pool so the next call to get_extraction_pool starts a fresh one."""
+    global _extraction_pool
+    with _extraction_pool_lock:
+        if _extraction_pool is not None:
+            _extraction_pool.shutdown(wait=False, cancel_futures=True)
+        _extraction_pool = None
+
+def iter_pdf_pages(source, workers=None):
+    """Yields the text of every PDF page in page order ('' for pages without a text layer).
+
+    Large documents are split into contiguous page shards and fanned out across a process pool, keeping
+    at most two shards per worker ahead of the consumer, so a consumer that stops early leaves the rest
+    of the document unparsed. `workers` overrides the shared pool with a dedicated one of that size.
+    In-memory documents are sent to the workers as bytes.
+    """
+    with open_pdf(source) as doc:
+        page_count = doc.page_count
+        worker_count = workers or PDF_EXTRACTION_WORKERS
+        if worker_count <= 1 or page_count < PDF_PARALLEL_MIN_PAGES:
+            for page_no in range(page_count):
+                yield doc[page_no].get_text("text", sort=True).strip()
+            return
+
+    # A few shards per worker keeps the pool balanced when some pages are much denser than others
+    shard_size = max(1, -(-page_count // (worker_count * 4)))
+    shards = iter([(start, min(start + shard_size, page_count)) for start in range(0, page_count, shard_size)])
+    logging.info(f"Extracting {page_count} PDF pages in shards of {shard_size} across {worker_count} workers.")
+    pages_done = 0
+    worker_source = pool_source(source)
+
+    def run(pool):
+        nonlocal pages_done
+        pending = deque(pool.submit(extraction_worker.extract_pdf_page_range, worker_source, start, stop)
+                        for start, stop in itertools.islice(shards, worker_count * 2))
+        try:
+            while pending:
+                texts = pending.popleft().result()
+                next_shard = next(shards, None)
+                if next_shard is not None:
+                    pending.append(pool.submit(extraction_worker.extract_pdf_page_range, worker_source, *next_shard))
+                for text in texts: # Shards are consumed in order, so pages come out in page order
+                    pages_done += 1
+                    yield text
+        finally:
+            for future in pending:
+                future.cancel()
+
+    if workers:
+        with extraction_worker.create_pool(workers) as pool:
+            yield from run(pool)
+        return
     try:
-        logging.info(f"Attempting to extract text from: {filename} (type: {ext})")
-        if ext == ".pdf":
-            text_found = False
-            # Try PyMuPDF first (usually faster and better)
-            try:
-                doc = fitz.open(file_path)
-                # Use flags for better layout preservation if needed: page.get_text("text", flags=fitz.TEXT_PRESERVE_LIGATURES | fitz.TEXT_PRESERVE_WHITESPACE)
-                extracted_text = "\n".join([page.get_text("text", sort=True).strip() for page in doc if page.get_text("text").strip()]) # Added sort=True
-                doc.close()
-                if extracted_text.strip():
-                    logging.info(f"PyMuPDF extraction successful for {filename}.")
-                    text_found = True
-                else:
-                    logging.warning(f"PyMuPDF extracted no text from {filename}. It might be image-based or empty.")
-            except Exception as e_fitz:
-                logging.warning(f"PyMuPDF failed for {filename}: {e_fitz}. Trying pdfplumber...")
-
-            # Try pdfplumber if PyMuPDF failed or got no text
-            if not text_found:
-                try:
-                    with pdfplumber.open(file_path) as pdf:
-                        # Adjust tolerances if text extraction is poor on certain PDFs
-                        extracted_text = "\n".join([page.extract_text(x_tolerance=1, y_tolerance=3) or "" for page in pdf.pages]) # Increased y_tolerance slightly
-                    if extracted_text.strip():
-                        logging.info(f"pdfplumber extraction successful for {filename}.")
-                        text_found = True
-                    else:
-                        logging.warning(f"pdfplumber also extracted no text from {filename}.")
-                except Exception as e_plumber:
-                    logging.error(f"Both PyMuPDF and pdfplumber failed for PDF {filename}. Last error: {e_plumber}")
-                    extracted_text = "" # Ensure it's empty if both fail
-
-            # Future Improvement: Add OCR step here if text_found is still False for image-based PDFs
-
-        elif ext == ".docx":
+        yield from run(get_extraction_pool())
+    except BrokenProcessPool as pool_err:
+        logging.error(f"Extraction process pool failed ({pool_err}); extracting {source_name(source)} in-process from page {pages_done + 1}.")
+        _reset_extraction_pool()
+        yield from extraction_worker.extract_pdf_page_range(source, pages_done, page_count)
+
+def extract_pdf_pages(source, workers=None):
+    """Extracts the text of every PDF page in page order (see iter_pdf_pages)."""
+    return list(iter_pdf_pages(source, workers))
+
+def ocr_pdf_pages(source, page_numbers):
+    """OCRs the given (0-based) PDF pages concurrently; returns {page_no: text}.
+
+    Pages are submitted to the extraction pool as a sliding window of at most two per worker,
+    so rasterized pages are streamed through the pool instead of being rendered up front.
+    """
+    results = {}
+    if not page_numbers:
+        return results
+    filename = source_name(source)
+
+    if PDF_EXTRACTION_WORKERS <= 1 or len(page_numbers) == 1:
+        for page_no in page_numbers:
             try:
-                doc = docx.Document(file_path)
-                full_text = []
-                for para in doc.paragraphs:
-                    full_text.append(para.text)
-                # Optional: Add table extraction
-                # for table in doc.tables:
-                #     for row in table.rows:
-                #         row_text = [cell.text for cell in row.cells]
-                #         full_text.append("\t".join(row_text)) # Tab-separated cells
-                extracted_text = "\n".join(filter(None, full_text)) # Join non-empty parts
-                logging.info(f"Docx extraction successful for {filename}.")
-            except Exception as e_docx:
-                 logging.error(f"Error extracting from DOCX {filename}: {e_docx}")
-                 extracted_text = ""
-
-
-        elif ext == ".xlsx":
+                results[page_no], report = extraction_worker.ocr_pdf_page(source, page_no, PDF_OCR_DPI, filename)
+                ocr_metrics.record(report)
+            except extraction_worker.TesseractUnavailable:
+                logging.error("TESSERACT NOT FOUND. OCR of image-only PDF pages skipped.")
+                break
+            except Exception as e_page:
+                logging.warning(f"OCR failed for {filename} page {page_no + 1}: {e_page}")
+        return results
+
+    pool = get_extraction_pool()
+    worker_source = pool_source(source)
+    max_in_flight = max(1, PDF_EXTRACTION_WORKERS) * 2
+    page_iter = iter(page_numbers)
+    pending = {}
+
+    def submit_next():
+        page_no = next(page_iter, None)
+        if page_no is not None:
+            pending[pool.submit(extraction_worker.ocr_pdf_page, worker_source, page_no, PDF_OCR_DPI, filename)] = page_no
+
+    for _ in range(max_in_flight):
+        submit_next()
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            page_no = pending.pop(future)
             try:
-                # Read all sheets, convert to string, handling potential errors
-                excel_file = pd.ExcelFile(file_path)
-                all_text = []
-                for sheet_name in excel_file.sheet_names:
-                    try:
-                        df = excel_file.parse(sheet_name)
-                        # Convert dataframe to string, replacing NaN with empty string
-                        df_string = df.fillna('').to_string(index=False, header=True)
-                        all_text.append(f"--- Sheet: {sheet_name} ---\n{df_string}")
-                    except Exception as e_sheet:
-                        logging.warning(f"Could not read sheet '{sheet_name}' in {filename}: {e_sheet}")
-                        all_text.append(f"--- Sheet: {sheet_name} (Error reading) ---")
-                extracted_text = "\n\n".join(all_text)
-                logging.info(f"Xlsx extraction successful for {filename}.")
-            except Exception as e_xlsx:
-                logging.error(f"Error reading XLSX {filename}: {e_xlsx}")
-                extracted_text = ""
-
-        elif ext in [".png", ".jpg", ".jpeg", ".bmp", ".tiff", ".tif"]:
-            extracted_text = extract_text_from_image(file_path)
-            # Logging is done inside extract_text_from_image
+                results[page_no], report = future.result()
+                ocr_metrics.record(report)
+            except extraction_worker.TesseractUnavailable:
+                logging.error("TESSERACT NOT FOUND. OCR of image-only PDF pages skipped.")
+                for other in pending:
+                    other.cancel()
+                return results
+            except BrokenProcessPool:
+                _reset_extraction_pool()
+                raise
+            except Exception as e_page:
+                logging.warning(f"OCR failed for {filename} page {page_no + 1}: {e_page}")
+            submit_next()
+    return results
+
+class TextExtractor:
+    """Base class for per-format text extractors (see register_extractor).
+
+    iter_text() yields the document's text in reading order in natural chunks (a page, a sheet, a
+    paragraph), parsing only as far as the consumer reads, so downstream stages can stop early.
+    Chunks are joined with `separator`; extraction errors are logged and end the stream. `source` is a
+    file path or a MemoryDocument.
+    """
+
+    extensions = ()
+    separator = "\n"
+    unit = "chunk" # What one yielded chunk corresponds to, for coverage reports
+
+    def iter_text(self, source):
+        raise NotImplementedError
+
+    def count_units(self, source):
+        """Total number of chunks iter_text would yield, if that is cheap to know (else None)."""
+        return None
 
-        else:
-            logging.warning(f"Unsupported file type for standard text extraction: {ext}")
-            # Fallback: Try reading as plain text
-            try:
-                with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    extracted_text = f.read()
-                if extracted_text.strip():
-                    logging.info(f"Read {filename} as plain text (fallback).")
-                else:
-                    extracted_text = ""
-            except Exception as e_txt:
-                logging.warning(f"Could not read {filename} as plain text: {e_txt}")
-                extracted_text = ""
+
+EXTRACTORS = {} # File extension -> extractor instance
+
+def register_extractor(cls):
+    """Class decorator: registers an extractor instance for each of the class's extensions."""
+    extractor = cls()
+    for ext in cls.extensions:
+        EXTRACTORS[ext] = extractor
+    return cls
+
+
+@register_extractor
+class PdfExtractor(TextExtractor):
+    """PyMuPDF text layer page by page, OCR for pages without one, pdfplumber as a fallback."""
+
+    extensions = (".pdf",)
+    unit = "page"
+
+    def count_units(self, source):
+        try:
+            with open_pdf(source) as doc:
+                return doc.page_count
+        except Exception:
+            return None
+
+    def iter_text(self, source):
+        filename = source_name(source)
+        pages_read = 0
+        text_found = False
+        # Try PyMuPDF first (usually faster and better)
+        try:
+            for text in self._iter_pymupdf_pages(source, filename):
+                pages_read += 1
+                text_found = text_found or bool(text)
+                yield text
+            if text_found:
+                logging.info(f"PyMuPDF extraction successful for {filename}.")
+                return
+            logging.warning(f"PyMuPDF (and OCR, if enabled) extracted no text from {filename}. It might be empty or unreadable.")
+            pages_read = 0
+        except Exception as e_fitz:
+            logging.warning(f"PyMuPDF failed for {filename} after {pages_read} pages: {e_fitz}. Trying pdfplumber...")
+
+        # Try pdfplumber if PyMuPDF failed (from the first page it did not deliver) or got no text
+        try:
+            text_found = False
+            with open_source(source) as f, pdfplumber.open(f) as pdf:
+                for page in pdf.pages[pages_read:]:
+                    # Adjust tolerances if text extraction is poor on certain PDFs
+                    text = (page.extract_text(x_tolerance=1, y_tolerance=3) or "").strip() # Increased y_tolerance slightly
+                    text_found = text_found or bool(text)
+                    yield text
+            if text_found:
+                logging.info(f"pdfplumber extraction successful for {filename}.")
+            else:
+                logging.warning(f"pdfplumber also extracted no text from {filename}.")
+        except Exception as e_plumber:
+            logging.error(f"Both PyMuPDF and pdfplumber failed for PDF {filename}. Last error: {e_plumber}")
+
+    def _iter_pymupdf_pages(self, source, filename):
+        # Pages are read once (sort=True), sharded across processes for large files. Pages without a text
+        # layer (scanned pages) are OCRed in blocks of one pool window and merged back in page order.
+        block_size = max(1, PDF_EXTRACTION_WORKERS) * 2
+        block = []
+        block_start = 0
+        for text in iter_pdf_pages(source):
+            block.append(text)
+            if len(block) >= block_size:
+                yield from self._ocr_missing_pages(source, filename, block_start, block)
+                block_start += len(block)
+                block = []
+        yield from self._ocr_missing_pages(source, filename, block_start, block)
+
+    def _ocr_missing_pages(self, source, filename, block_start, texts):
+        image_pages = [block_start + offset for offset, text in enumerate(texts) if not text]
+        if image_pages and PDF_OCR_ENABLED:
+            logging.info(f"{len(image_pages)} pages of {filename} from page {block_start + 1} have no text layer, running OCR...")
+            for page_no, text in ocr_pdf_pages(source, image_pages).items():
+                texts[page_no - block_start] = text
+        return texts
+
+
+@register_extractor
+class DocxExtractor(TextExtractor):
+    """Walks the document body once, in order: one chunk per paragraph and per table row.
+
+    Works on the body XML directly (python-docx's Table.rows/cells recompute the cell grid on every
+    access). Table rows become pipe-delimited lines like spreadsheet rows; paragraphs inside a cell,
+    including nested tables, are joined into the cell's text. Content controls are descended into.
+    """
+
+    extensions = (".docx",)
+    unit = "block"
+    cell_separator = " | "
+    # Clark-notation tags, as docx.oxml.ns.qn('w:p') etc. would build them (spelled out so docx is not imported at startup)
+    TAGS = {name: f"{{http://schemas.openxmlformats.org/wordprocessingml/2006/main}}{name}"
+            for name in ('p', 'tbl', 'tr', 'tc', 'sdt', 'sdtContent', 't', 'tab', 'br', 'cr')}
+
+    def iter_text(self, source):
+        filename = source_name(source)
+        try:
+            doc = docx.Document(path_or_file(source))
+            yield from self._iter_blocks(doc.element.body)
+            logging.info(f"Docx extraction successful for {filename}.")
+        except Exception as e_docx:
+            logging.error(f"Error extracting from DOCX {filename}: {e_docx}")
+
+    def _iter_blocks(self, container):
+        tags = self.TAGS
+        for child in container.iterchildren():
+            if child.tag == tags['p']:
+                yield self._text(child)
+            elif child.tag == tags['tbl']:
+                for row in child.iterchildren(tags['tr']):
+                    cells = [self._text(cell).strip() for cell in row.iterchildren(tags['tc'])]
+                    while cells and not cells[-1]:
+                        cells.pop()
+                    yield self.cell_separator.join(cells)
+            elif child.tag == tags['sdt']: # Content control wrapping paragraphs/tables
+                for content in child.iterchildren(tags['sdtContent']):
+                    yield from self._iter_blocks(content)
+
+    def _text(self, element):
+        # One lxml pass over the text nodes (python-docx's CT_P.text runs an XPath query per paragraph);
+        # paragraphs after the first inside `element` (cell paragraphs, text boxes) are joined with a space
+        tags = self.TAGS
+        parts = []
+        for node in element.iter(tags['t'], tags['tab'], tags['br'], tags['cr'], tags['p']):
+            if node.tag == tags['t']:
+                parts.append(node.text or "")
+            elif node.tag == tags['p']:
+                if parts:
+                    parts.append(" ")
+            elif node.tag == tags['tab']:
+                parts.append("\t")
+            else:
+                parts.append("\n")
+        return "".join(parts)
+
+
+def _format_xlsx_cell(value):
+    """Compact text for a cell value: '' for blanks, 12 instead of 12.0, dates without a midnight time."""
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, datetime.datetime):
+        return value.date().isoformat() if value.time() == datetime.time() else value.isoformat(sep=' ')
+    return " ".join(str(value).split()) # One line per row, whatever the cell contains
+
+
+XLSX_DIMENSION_PATTERN = re.compile(r'<(?:\w+:)?dimension ref="[A-Z]+(\d+)(?::[A-Z]+(\d+))?"')
+
+@register_extractor
+class XlsxExtractor(TextExtractor):
+    """Streams rows with openpyxl in read-only mode, one chunk per row.
+
+    Rows become pipe-delimited lines with trailing blanks trimmed; with XLSX_LABELED_CELLS each row
+    after a sheet's header row lists only its non-empty cells as "Header: value". Nothing is
+    materialized beyond the current row, so the extraction budget can stop a 100k-row export early.
+    """
+
+    extensions = (".xlsx",)
+    unit = "row"
+    cell_separator = " | "
+
+    def count_units(self, source):
+        # Max row of each worksheet from its <dimension> element, which writers put ahead of the cell data,
+        # so the archive is peeked at instead of loading the workbook (and its shared strings) twice
+        try:
+            total = 0
+            with open_source(source) as f, zipfile.ZipFile(f) as archive:
+                for name in archive.namelist():
+                    if name.startswith("xl/worksheets/") and name.endswith(".xml"):
+                        with archive.open(name) as sheet_xml:
+                            head = sheet_xml.read(4096).decode("utf-8", "ignore")
+                        match = XLSX_DIMENSION_PATTERN.search(head)
+                        if match is None:
+                            return None
+                        total += int(match.group(2) or match.group(1))
+            return total
+        except Exception:
+            return None
+
+    def iter_text(self, source):
+        filename = source_name(source)
+        try:
+            workbook = openpyxl.load_workbook(path_or_file(source), read_only=True, data_only=True)
+        except Exception as e_xlsx:
+            logging.error(f"Error reading XLSX {filename}: {e_xlsx}")
+            return
+        try:
+            for sheet_no, worksheet in enumerate(workbook.worksheets):
+                gap = "\n" if sheet_no else "" # Blank line between sheets
+                try:
+                    worksheet.reset_dimensions() # Some exporters write a wrong <dimension>; read every row present
+                    yield from self._iter_sheet_rows(worksheet, f"{gap}--- Sheet: {worksheet.title} ---")
+                except Exception as e_sheet:
+                    logging.warning(f"Could not read sheet '{worksheet.title}' in {filename}: {e_sheet}")
+                    yield f"{gap}--- Sheet: {worksheet.title} (Error reading) ---"
+            logging.info(f"Xlsx extraction successful for {filename}.")
+        finally:
+            workbook.close()
+
+    def _iter_sheet_rows(self, worksheet, title):
+        header = None
+        for row in worksheet.iter_rows(values_only=True):
+            cells = [_format_xlsx_cell(value) for value in row]
+            while cells and not cells[-1]:
+                cells.pop()
+            if not cells:
+                yield "" # Keeps units_read in step with the sheet's row count
+                continue
+            if header is None:
+                header = cells
+                line = self.cell_separator.join(cells)
+            elif XLSX_LABELED_CELLS:
+                line = "; ".join(f"{header[col] if col < len(header) and header[col] else f'Column {col + 1}'}: {cell}"
+                                 for col, cell in enumerate(cells) if cell)
+            else:
+                line = self.cell_separator.join(cells)
+            if title:
+                line = f"{title}\n{line}"
+                title = None
+            yield line
+        if title: # Sheet without any values
+            yield title
+
+
+@register_extractor
+class ImageExtractor(TextExtractor):
+    """OCR of the whole image as a single chunk."""
+
+    extensions = (".png", ".jpg", ".jpeg", ".bmp", ".tiff", ".tif")
+    unit = "image"
+
+    def count_units(self, source):
+        return 1
+
+    def iter_text(self, source):
+        yield extract_text_from_image(source) # Logging is done inside extract_text_from_image
+
+
+@register_extractor
+class PlainTextExtractor(TextExtractor):
+    """Reads the file as UTF-8 in fixed-size blocks; also the fallback for unregistered extensions."""
+
+    extensions = (".txt",)
+    separator = ""
+    unit = "block"
+    block_chars = 64 * 1024
+
+    def count_units(self, source):
+        try:
+            size = source.size if isinstance(source, MemoryDocument) else os.path.getsize(source)
+            return -(-size // self.block_chars) # Bytes, so exact only for ASCII text
+        except OSError:
+            return None
+
+    def iter_text(self, source):
+        try:
+            with io.TextIOWrapper(open_source(source), encoding='utf-8', errors='ignore') as f:
+                while True:
+                    block = f.read(self.block_chars)
+                    if not block:
+                        break
+                    yield block
+        except Exception as e_txt:
+            logging.warning(f"Could not read {source_name(source)} as plain text: {e_txt}")
+
+
+def get_extractor(source):
+    """Returns the registered extractor for the file's extension (plain text for unknown types)."""
+    ext = pathlib.Path(source_name(source)).suffix.lower()
+    extractor = EXTRACTORS.get(ext)
+    if extractor is None:
+        logging.warning(f"Unsupported file type for standard text extraction: {ext}")
+        extractor = EXTRACTORS[".txt"] # Fallback: Try reading as plain text
+    return extractor
+
+def iter_document_text(source, coverage=None):
+    """Yields the document's text as chunks whose concatenation is the full text.
+
+    Empty chunks are dropped and separators are already included, so consumers can count characters and
+    stop reading at any point; closing the generator stops the underlying extractor. A `coverage` dict
+    receives the extractor's unit ('page', 'sheet', ...), units read so far and the total, if known.
+    """
+    extractor = get_extractor(source)
+    if coverage is not None:
+        coverage.update(unit=extractor.unit, units_read=0, units_total=extractor.count_units(source))
+    first = True
+    for chunk in extractor.iter_text(source):
+        if coverage is not None:
+            coverage['units_read'] += 1
+        if not chunk:
+            continue
+        yield chunk if first else extractor.separator + chunk
+        first = False
+
+class ExtractionCancelled(Exception):
+    """Raised by extract_text when its `cancel` event is set."""
+
+
+def extract_text(source, max_chars=None, coverage=None, cancel=None):
+    """Extract text from PDFs, DOCX, Images (using OCR), Excel and plain-text files.
+
+    `source` is a file path or a MemoryDocument (an upload that was never written to disk). Setting the
+    `cancel` event (a threading.Event) stops extraction at the next chunk with ExtractionCancelled.
+    With `max_chars`, reading stops as soon as that many characters have been extracted and the text is
+    cut to the budget, so the rest of a huge document is never parsed. A `coverage` dict receives how much
+    of the document was read (see iter_document_text) plus 'chars', 'char_budget' and 'complete'.
+    """
+    extracted_text = ""
+    filename = source_name(source)
+    ext = pathlib.Path(filename).suffix.lower()
+    coverage = {} if coverage is None else coverage
+
+    try:
+        logging.info(f"Attempting to extract text from: {filename} (type: {ext})")
+        parts = []
+        chars = 0
+        budget_reached = False
+        chunks = iter_document_text(source, coverage)
+        try:
+            for chunk in chunks:
+                if cancel is not None and cancel.is_set():
+                    raise ExtractionCancelled(f"Extraction of {filename} was cancelled")
+                parts.append(chunk)
+                chars += len(chunk)
+                if max_chars and chars >= max_chars:
+                    budget_reached = True
+                    break
+        finally:
+            chunks.close() # Stops the extractor (and any pool work it has queued) when the budget is met
+        extracted_text = "".join(parts)[:max_chars] if max_chars else "".join(parts)
+        units_total = coverage.get('units_total')
+        coverage.update(
+            chars=len(extracted_text),
+            char_budget=max_chars or None,
+            complete=not budget_reached or (chars <= max_chars and units_total is not None and coverage['units_read'] >= units_total),
+        )
+        if not coverage['complete']:
+            logging.info(f"Stopped extracting {filename} at the {max_chars} char budget after {coverage['units_read']} of {units_total or '?'} {coverage['unit']}s.")
 
         # Log length and snippet
         text_length = len(extracted_text)
         logging.info(f"📄 Extracted Text Length for {filename}: {text_length} chars")
         if text_length > 0:
              logging.debug(f"📄 Extracted Text Snippet (first 300 chars): {extracted_text[:300]}...")
-        elif ext not in [".png", ".jpg", ".jpeg", ".bmp", ".tiff", ".tif"]: # Avoid logging no text for images if OCR failed
+        elif ext not in ImageExtractor.extensions: # Avoid logging no text for images if OCR failed
             logging.warning(f"No text could be extracted from {filename}.")
 
-
+    except ExtractionCancelled:
+        logging.info(f"Extraction of {filename} cancelled after {coverage.get('units_read')} {coverage.get('unit')}s.")
+        raise
     except Exception as e:
         logging.error(f"❌ Unexpected error extracting text from {filename}: {e}", exc_info=True)
         return "" # Return empty string on error
@@ -463,82 +1323,326 @@ def handle_gemini_error_response(response, context="analysis"):
     return error_payload
 
 
-def analyze_text_with_gemini(text):
-    """Generate a structured medical summary from text using Gemini AI."""
-    try:
-        if len(text) > MAX_TEXT_ANALYSIS_CHARS:
-            logging.warning(f"Input text length ({len(text)} chars) exceeds limit ({MAX_TEXT_ANALYSIS_CHARS}), truncating.")
-            text = text[:MAX_TEXT_ANALYSIS_CHARS] + "\n... [Content Truncated]"
+def _request_text_analysis(text, model, part=None, model_slots=None):
+    """Sends one analysis prompt for `text` and parses the JSON reply (an {"error": ...} dict on failure).
+
+    `part` is (number, total) when the text is one chunk of a longer document. `model_slots` (e.g. a
+    semaphore) is held for the duration of the model call only.
+    """
+    part_note = ""
+    if part:
+        part_note = f"""
+    The text is part {part[0]} of {part[1]} of a longer medical record. Analyze only this part; the parts are merged afterwards."""
+    prompt = f"""
+    Analyze the following medical report text and extract the information into a structured JSON format.{part_note}
+    Be comprehensive but concise. If information for a field is not present, use `null` or an empty list `[]`.
+    Focus *only* on the information present in the text provided. Do not infer or add external knowledge.
+
+    YOUR RESPONSE MUST BE A SINGLE, VALID JSON OBJECT AND NOTHING ELSE.
+    DO NOT include any explanatory text before or after the JSON object.
+    DO NOT use markdown formatting like ```json.
+
+    JSON Format:
+    {{
+        "summary": "A concise summary of the main points of the medical report excerpt. Synthesize key findings.",
+        "diagnosis": "Primary or potential diagnosis mentioned, or null.",
+        "key_findings": ["List key observations, test results, or findings mentioned.", "Finding 2", "..."],
+        "causes": ["Possible causes mentioned for the condition, or null.", "Cause 2", "..."],
+        "recommendations": "Specific medical recommendations or next steps mentioned, or null.",
+        "precautions": ["Any precautions advised in the text.", "Precaution 2", "..."],
+        "remedies": ["Mentioned treatments, therapies, or remedies.", "Remedy 2", "..."],
+        "important_notes": "Other significant details or notes from the report.",
+        "treatment_plan": "Outline of the treatment plan if described, or null.",
+        "lifestyle_changes": ["Specific lifestyle changes suggested.", "Change 2", "..."],
+        "urgent_concerns": "Any explicitly mentioned urgent concerns or red flags, or null."
+    }}
+
+    Medical Report Text:
+    --- START TEXT ---
+    {text}
+    --- END TEXT ---
+
+    Now, provide ONLY the JSON object based on the text above.
+    """
 
+    try:
+         safety_settings = { # Adjust safety settings as needed for medical content
+            'HARM_CATEGORY_HARASSMENT': 'BLOCK_NONE',
+            'HARM_CATEGORY_HATE_SPEECH': 'BLOCK_NONE',
+            'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'BLOCK_LOW_AND_ABOVE', # Might need BLOCK_NONE if issues arise
+            'HARM_CATEGORY_DANGEROUS_CONTENT': 'BLOCK_NONE',
+         }
+         with model_slots or nullcontext():
+             response = model.generate_content(prompt, safety_settings=safety_settings)
+
+         # Check for valid response content
+         if response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
+             response_text = response.candidates[0].content.parts[0].text.strip()
+             return parse_gemini_json_response(response_text, context="text analysis")
+         else:
+             # Handle cases where generation failed or was blocked
+             return handle_gemini_error_response(response, context="text analysis")
+
+    except Exception as api_err:
+         logging.exception("❌ Error during Gemini API call for text analysis:")
+         if "API key not valid" in str(api_err):
+             return {"error": "Gemini API key is invalid. Please check your .env file."}
+         return {"error": f"Gemini API communication error: {api_err}"}
+
+
+def analyze_text_with_gemini(text, truncated=False, model=None, stats=None, model_slots=None):
+    """Generate a structured medical summary from text using Gemini AI.
+
+    `truncated` marks text that extraction already cut short (see extract_text's `max_chars`). Text longer
+    than MAX_TEXT_ANALYSIS_CHARS is analyzed with analyze_text_map_reduce when ANALYSIS_MAP_REDUCE is on.
+    `model` defaults to the shared Gemini model (pass a fake in tests); a `stats` dict receives the mode,
+    chunk count, per-chunk latency and `chars_analyzed` (less than len(text) if the text had to be cut).
+    `model_slots` is held around each model call (see _request_text_analysis).
+    """
+    model = model or gemini_model
+    try:
         if not text.strip():
             logging.warning("analyze_text_with_gemini called with empty text.")
             return {"error": "Input text was empty."}
 
-        logging.info("🔄 Sending text to Gemini for structured analysis...")
-
-        prompt = f"""
-        Analyze the following medical report text and extract the information into a structured JSON format.
-        Be comprehensive but concise. If information for a field is not present, use `null` or an empty list `[]`.
-        Focus *only* on the information present in the text provided. Do not infer or add external knowledge.
-
-        YOUR RESPONSE MUST BE A SINGLE, VALID JSON OBJECT AND NOTHING ELSE.
-        DO NOT include any explanatory text before or after the JSON object.
-        DO NOT use markdown formatting like ```json.
-
-        JSON Format:
-        {{
-            "summary": "A concise summary of the main points of the medical report excerpt. Synthesize key findings.",
-            "diagnosis": "Primary or potential diagnosis mentioned, or null.",
-            "key_findings": ["List key observations, test results, or findings mentioned.", "Finding 2", "..."],
-            "causes": ["Possible causes mentioned for the condition, or null.", "Cause 2", "..."],
-            "recommendations": "Specific medical recommendations or next steps mentioned, or null.",
-            "precautions": ["Any precautions advised in the text.", "Precaution 2", "..."],
-            "remedies": ["Mentioned treatments, therapies, or remedies.", "Remedy 2", "..."],
-            "important_notes": "Other significant details or notes from the report.",
-            "treatment_plan": "Outline of the treatment plan if described, or null.",
-            "lifestyle_changes": ["Specific lifestyle changes suggested.", "Change 2", "..."],
-            "urgent_concerns": "Any explicitly mentioned urgent concerns or red flags, or null."
-        }}
-
-        Medical Report Text:
-        --- START TEXT ---
-        {text}
-        --- END TEXT ---
-
-        Now, provide ONLY the JSON object based on the text above.
-        """
-
-        try:
-             safety_settings = { # Adjust safety settings as needed for medical content
-                'HARM_CATEGORY_HARASSMENT': 'BLOCK_NONE',
-                'HARM_CATEGORY_HATE_SPEECH': 'BLOCK_NONE',
-                'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'BLOCK_LOW_AND_ABOVE', # Might need BLOCK_NONE if issues arise
-                'HARM_CATEGORY_DANGEROUS_CONTENT': 'BLOCK_NONE',
-             }
-             response = gemini_model.generate_content(prompt, safety_settings=safety_settings)
-
-             # Check for valid response content
-             if response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
-                 response_text = response.candidates[0].content.parts[0].text.strip()
-                 return parse_gemini_json_response(response_text, context="text analysis")
-             else:
-                 # Handle cases where generation failed or was blocked
-                 return handle_gemini_error_response(response, context="text analysis")
-
-        except Exception as api_err:
-             logging.exception("❌ Error during Gemini API call for text analysis:")
-             if "API key not valid" in str(api_err):
-                 return {"error": "Gemini API key is invalid. Please check your .env file."}
-             return {"error": f"Gemini API communication error: {api_err}"}
+        if len(text) > MAX_TEXT_ANALYSIS_CHARS:
+            if ANALYSIS_MAP_REDUCE:
+                return analyze_text_map_reduce(text, truncated=truncated, model=model, stats=stats, model_slots=model_slots)
+            logging.warning(f"Input text length ({len(text)} chars) exceeds limit ({MAX_TEXT_ANALYSIS_CHARS}), truncating.")
+            text = text[:MAX_TEXT_ANALYSIS_CHARS]
+            truncated = True
+        chars_analyzed = len(text)
+        if truncated:
+            text += "\n... [Content Truncated]"
 
+        logging.info("🔄 Sending text to Gemini for structured analysis...")
+        start = time.perf_counter()
+        result = _request_text_analysis(text, model, model_slots=model_slots)
+        if stats is not None:
+            stats.update(mode='single', chunks=1, failed_chunks=int('error' in result), chunk_seconds=[round(time.perf_counter() - start, 3)],
+                         chars_analyzed=chars_analyzed)
+        return result
 
     except Exception as e:
         logging.exception("❌ Unexpected error during Gemini text analysis setup:")
         return {"error": f"Unexpected AI text processing error: {e}"}
 
 
-def analyze_image_with_gemini(image_data, filename="image"):
-    """Analyzes an image using Gemini AI and returns a structured JSON."""
+def _unique_items(items):
+    """Items in order without repeats, compared case-, whitespace- and trailing-punctuation-insensitively."""
+    seen = set()
+    unique = []
+    for item in items:
+        key = json.dumps(item, sort_keys=True) if isinstance(item, (dict, list)) else " ".join(str(item).lower().split()).rstrip(".;")
+        if key not in seen:
+            seen.add(key)
+            unique.append(item)
+    return unique
+
+
+def merge_analysis_results(results):
+    """Merges per-chunk (or, for a batch summary, per-file) analysis dicts into one with the same schema.
+
+    List fields (key_findings, precautions, remedies, ...) are concatenated in chunk order without
+    duplicates; text fields keep each distinct value, one paragraph per chunk. Any other values
+    come from the first chunk that has one.
+    """
+    merged = {}
+    for key in dict.fromkeys(key for result in results for key in result):
+        present = [result[key] for result in results if key in result]
+        values = [value for value in present if value not in (None, "", [])]
+        if any(isinstance(value, list) for value in present):
+            merged[key] = _unique_items(item for value in values for item in (value if isinstance(value, list) else [value]))
+        elif not values:
+            merged[key] = None
+        elif all(isinstance(value, str) for value in values):
+            merged[key] = "\n\n".join(_unique_items(values))
+        else:
+            merged[key] = values[0]
+    return merged
+
+
+def analyze_text_map_reduce(text, truncated=False, model=None, stats=None, model_slots=None):
+    """Analyzes a document too long for one prompt: splits it into ANALYSIS_CHUNK_CHARS chunks (at most
+    ANALYSIS_MAX_CHUNKS), analyzes them concurrently, ANALYSIS_MAP_CONCURRENCY at a time, and merges the
+    per-chunk JSON with merge_analysis_results. Chunks that fail are left out of the merge; the first
+    error is returned only if every chunk failed. With `model_slots`, each chunk request also takes a slot,
+    so a shared bound holds however many chunks are in flight.
+    """
+    model = model or gemini_model
+    chunks = chunk_document_text(text, ANALYSIS_CHUNK_CHARS, 0)
+    if len(chunks) > ANALYSIS_MAX_CHUNKS:
+        logging.warning(f"Input text ({len(text)} chars) needs {len(chunks)} chunks; analyzing the first {ANALYSIS_MAX_CHUNKS}.")
+        chunks = chunks[:ANALYSIS_MAX_CHUNKS]
+        truncated = True
+    chars_analyzed = min(len(text), sum(len(chunk) + 1 for chunk in chunks)) # Chunks were joined lines; +1 per dropped newline
+    if truncated:
+        chunks[-1] += "\n... [Content Truncated]"
+    chunk_seconds = [None] * len(chunks)
+
+    def analyze_chunk(index):
+        start = time.perf_counter()
+        result = _request_text_analysis(chunks[index], model, part=(index + 1, len(chunks)), model_slots=model_slots)
+        chunk_seconds[index] = round(time.perf_counter() - start, 3)
+        return result
+
+    logging.info(f"🔄 Sending {len(chunks)} chunks ({len(text)} chars) to Gemini for map-reduce analysis...")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, min(ANALYSIS_MAP_CONCURRENCY, len(chunks)))) as executor:
+        results = list(executor.map(analyze_chunk, range(len(chunks))))
+    succeeded = [result for result in results if isinstance(result, dict) and 'error' not in result]
+    logging.info(f"Map-reduce analysis: {len(succeeded)}/{len(chunks)} chunks in {time.perf_counter() - start:.2f}s, "
+                 f"per chunk: {chunk_seconds}")
+    if stats is not None:
+        stats.update(mode='map_reduce', chunks=len(chunks), failed_chunks=len(chunks) - len(succeeded),
+                     chunk_seconds=chunk_seconds, total_seconds=round(time.perf_counter() - start, 3), chars_analyzed=chars_analyzed)
+    if not succeeded:
+        return results[0]
+    if len(succeeded) < len(chunks):
+        logging.warning(f"{len(chunks) - len(succeeded)} of {len(chunks)} chunks failed; merging the rest.")
+    return merge_analysis_results(succeeded)
+
+
+class ImagePrepStats:
+    """Totals for prepare_image_for_gemini: images seen, passed through as-is, bytes saved and time spent."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.images = 0
+        self.passed_through = 0
+        self.downscaled = 0
+        self.original_bytes = 0
+        self.prepared_bytes = 0
+        self.seconds = 0.0
+
+    def record(self, report):
+        with self._lock:
+            self.images += 1
+            self.passed_through += not report["reencoded"]
+            self.downscaled += report["prepared_size"] != report["original_size"]
+            self.original_bytes += report["original_bytes"]
+            self.prepared_bytes += report["prepared_bytes"]
+            self.seconds += report["seconds"]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "images": self.images,
+                "passed_through": self.passed_through,
+                "downscaled": self.downscaled,
+                "bytes_saved": self.original_bytes - self.prepared_bytes,
+                "avg_prep_ms": round(self.seconds * 1000 / self.images, 2) if self.images else 0.0,
+            }
+
+image_prep_stats = ImagePrepStats()
+
+
+def _downscale(image, size):
+    """Area-averaging resize of an RGB image through OpenCV (faster than PIL's LANCZOS on large photos)."""
+    return Image.fromarray(cv2.resize(np.asarray(image), size, interpolation=cv2.INTER_AREA))
+
+def _encode_jpeg(image, quality):
+    buffer = BytesIO()
+    image.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+def _fit_jpeg_quality(image):
+    """Highest JPEG quality from IMAGE_MIN_JPEG_QUALITY to IMAGE_JPEG_QUALITY whose encoding fits IMAGE_TARGET_BYTES.
+
+    Returns (quality, data); if nothing fits, data is the (oversized) minimum-quality encoding. The binary
+    search runs on a 1/16-area preview, since size ratios between qualities barely depend on resolution,
+    so usually only two encodings are made at full size.
+    """
+    data = _encode_jpeg(image, IMAGE_JPEG_QUALITY)
+    if len(data) <= IMAGE_TARGET_BYTES or IMAGE_MIN_JPEG_QUALITY >= IMAGE_JPEG_QUALITY:
+        return IMAGE_JPEG_QUALITY, data
+    preview = image.reduce(4) if min(image.size) >= 256 else image
+    preview_budget = len(_encode_jpeg(preview, IMAGE_JPEG_QUALITY)) * IMAGE_TARGET_BYTES / len(data)
+    quality = IMAGE_MIN_JPEG_QUALITY
+    low, high = IMAGE_MIN_JPEG_QUALITY, IMAGE_JPEG_QUALITY - 1
+    while low <= high:
+        candidate = (low + high) // 2
+        if len(_encode_jpeg(preview, candidate)) <= preview_budget:
+            quality, low = candidate, candidate + 1
+        else:
+            high = candidate - 1
+    data = _encode_jpeg(image, quality)
+    while len(data) > IMAGE_TARGET_BYTES and quality > IMAGE_MIN_JPEG_QUALITY: # The estimate was optimistic
+        quality = max(IMAGE_MIN_JPEG_QUALITY, quality - 3)
+        data = _encode_jpeg(image, quality)
+    return quality, data
+
+def prepare_image_for_gemini(image_data, filename="image"):
+    """Returns (jpeg_bytes, report) for an image: at most IMAGE_MAX_LONG_EDGE x IMAGE_MAX_PIXELS, RGB on white,
+    EXIF orientation applied, encoded at the highest quality that fits IMAGE_TARGET_BYTES.
+
+    A JPEG that already meets every limit is passed through unchanged. When even IMAGE_MIN_JPEG_QUALITY does
+    not fit the target, the image is scaled down further. The report gives sizes, bytes saved, the quality
+    used and the preparation time; raises if PIL cannot read the image.
+    """
+    start = time.perf_counter()
+    image = Image.open(BytesIO(image_data))
+    original_size = image.size
+    width, height = original_size
+    scale = min(1.0, IMAGE_MAX_LONG_EDGE / max(width, height), math.sqrt(IMAGE_MAX_PIXELS / (width * height)))
+    orientation = image.getexif().get(0x0112, 1) # EXIF Orientation; 1 = upright
+    quality = None
+
+    if (image.format == 'JPEG' and image.mode in ('RGB', 'L') and scale == 1.0 and orientation == 1
+            and len(image_data) <= IMAGE_TARGET_BYTES):
+        prepared = bytes(image_data)
+    else:
+        target = (max(1, int(width * scale)), max(1, int(height * scale)))
+        if orientation in (5, 6, 7, 8): # Rotated a quarter turn: the draft size is in stored (unrotated) orientation
+            target = target[::-1]
+        if image.format == 'JPEG':
+            # libjpeg can decode at 1/2, 1/4 or 1/8 scale, much faster than a full decode plus resize; accepting
+            # a result up to 20% under the limits lets a 20 MP photo decode straight at half size
+            image.draft('RGB', (int(target[0] * 0.8), int(target[1] * 0.8)))
+        if orientation != 1:
+            image = ImageOps.exif_transpose(image)
+        if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, (0, 0), image)
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+        while True:
+            width, height = image.size
+            scale = min(1.0, IMAGE_MAX_LONG_EDGE / max(width, height), math.sqrt(IMAGE_MAX_PIXELS / (width * height)))
+            if scale < 1.0:
+                image = _downscale(image, (max(1, int(width * scale)), max(1, int(height * scale))))
+            quality, prepared = _fit_jpeg_quality(image)
+            if len(prepared) <= IMAGE_TARGET_BYTES or min(image.size) <= 256: # 256 px: send the smallest encoding as is
+                break
+            # Even the minimum quality is too large: shrink the area by the overshoot and try again
+            shrink = math.sqrt(IMAGE_TARGET_BYTES / len(prepared)) * 0.95
+            image = _downscale(image, (max(1, int(image.width * shrink)), max(1, int(image.height * shrink))))
+
+    report = {
+        "original_bytes": len(image_data),
+        "prepared_bytes": len(prepared),
+        "bytes_saved": len(image_data) - len(prepared),
+        "original_size": list(original_size),
+        "prepared_size": list(image.size),
+        "quality": quality,
+        "reencoded": quality is not None,
+        "seconds": round(time.perf_counter() - start, 4),
+    }
+    image_prep_stats.record(report)
+    logging.info(f"Image '{filename}' prepared for Gemini: {report['original_size']} -> {report['prepared_size']}, "
+                 f"{report['original_bytes']} -> {report['prepared_bytes']} bytes "
+                 f"({f'quality {quality}' if quality else 'passed through'}) in {report['seconds']}s.")
+    return prepared, report
+
+
+def analyze_image_with_gemini(image_data, filename="image", stats=None, model_slots=None):
+    """Analyzes an image using Gemini AI and returns a structured JSON.
+
+    `image_data` is any bytes-like object (bytes, or a memoryview over an in-memory upload). It is
+    downscaled and re-encoded by prepare_image_for_gemini first; a `stats` dict receives that report.
+    `model_slots` is held around the model call only."""
     try:
         logging.info(f"🔄 Preparing image '{filename}' for Gemini analysis...")
         prompt = """
@@ -562,24 +1666,10 @@ def analyze_image_with_gemini(image_data, filename="image"):
         """
 
         try:
-            image = Image.open(BytesIO(image_data))
-            logging.info(f"Image '{filename}' loaded via PIL. Original format: {image.format}, Mode: {image.mode}, Size: {image.size}")
-
-            # Ensure image is RGB
-            if image.mode == 'RGBA':
-                 bg = Image.new('RGB', image.size, (255, 255, 255))
-                 bg.paste(image, (0, 0), image)
-                 image = bg
-                 logging.info("Converted RGBA image to RGB by pasting on white background.")
-            elif image.mode != 'RGB':
-                 logging.info(f"Converting image mode from {image.mode} to RGB.")
-                 image = image.convert('RGB')
-
-            buffer = BytesIO()
-            image.save(buffer, format='JPEG', quality=90)
-            prepared_image_data = buffer.getvalue()
+            prepared_image_data, prep_report = prepare_image_for_gemini(image_data, filename)
             image_mime = 'image/jpeg'
-            logging.info(f"Image '{filename}' prepared for API as {image_mime}. Size: {len(prepared_image_data)} bytes.")
+            if stats is not None:
+                stats.update(mode='image', image_prep=prep_report)
 
         except Exception as img_err:
             logging.error(f"❌ Failed to load/process image '{filename}' with PIL: {img_err}", exc_info=True)
@@ -599,7 +1689,8 @@ def analyze_image_with_gemini(image_data, filename="image"):
                 'HARM_CATEGORY_DANGEROUS_CONTENT': 'BLOCK_NONE',
             }
             # Use generate_content directly with the list of parts
-            response = gemini_model.generate_content(content, safety_settings=safety_settings)
+            with model_slots or nullcontext():
+                response = gemini_model.generate_content(content, safety_settings=safety_settings)
             logging.info(f"Received response object from Gemini for image '{filename}'.")
 
             # Check for valid response content
@@ -623,8 +1714,120 @@ def analyze_image_with_gemini(image_data, filename="image"):
         return {"error": f"Unexpected AI image processing error: {e}"}
 
 
-def translate_analysis(analysis_dict, target_language):
-    """Translates the values and optionally keys of an analysis dictionary."""
+class TranslationStats:
+    """Counts strings and translator round trips so batching savings are visible."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.analyses = 0
+        self.strings = 0
+        self.unique_strings = 0
+        self.round_trips = 0
+        self.fallback_batches = 0
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "analyses": self.analyses,
+                "strings": self.strings,
+                "unique_strings": self.unique_strings,
+                "round_trips": self.round_trips,
+                "fallback_batches": self.fallback_batches,
+            }
+
+translation_stats = TranslationStats()
+
+TRANSLATION_SEPARATOR = "\n%%%\n" # Marker line between strings packed into one translation request
+_TRANSLATION_SPLIT_RE = re.compile(r"\s*\n\s*%%%\s*\n\s*")
+_NUMBER_RE = re.compile(r"\d+") # Unicode digits too, so numbers rewritten in another script still compare equal
+
+def _collect_translatable_strings(value, out):
+    """Appends every non-blank string leaf of a nested dict/list structure to `out`."""
+    if isinstance(value, str):
+        if value.strip():
+            out.append(value)
+    elif isinstance(value, list):
+        for item in value:
+            _collect_translatable_strings(item, out)
+    elif isinstance(value, dict):
+        for item in value.values():
+            _collect_translatable_strings(item, out)
+
+def _replace_translated_strings(value, translations):
+    """Rebuilds a nested dict/list structure with string leaves swapped for their translations."""
+    if isinstance(value, str):
+        return translations.get(value, value)
+    if isinstance(value, list):
+        return [_replace_translated_strings(item, translations) for item in value]
+    if isinstance(value, dict):
+        return {k: _replace_translated_strings(v, translations) for k, v in value.items()}
+    # Return non-string/non-list/non-dict items as is (like null, numbers, booleans)
+    return value
+
+def _build_translation_batches(texts):
+    """Groups strings into batches that stay under the translator's per-request size limit."""
+    batches, current, current_chars = [], [], 0
+    for text in texts:
+        extra = len(text) + len(TRANSLATION_SEPARATOR)
+        if current and (current_chars + extra > TRANSLATION_BATCH_MAX_CHARS or len(current) >= TRANSLATION_BATCH_MAX_ITEMS):
+            batches.append(current)
+            current, current_chars = [], 0
+        current.append(text)
+        current_chars += extra
+    if current:
+        batches.append(current)
+    return batches
+
+def _segment_matches_source(source, translated):
+    """Sanity check for one string unpacked from a packed translation: not blank, the same numbers as the
+    source (in any order) and a plausible length. A segment shifted to another string rarely passes all three."""
+    if not translated.strip():
+        return False
+    if sorted(int(n) for n in _NUMBER_RE.findall(source)) != sorted(int(n) for n in _NUMBER_RE.findall(translated)):
+        return False
+    return len(source) / 5 - 10 <= len(translated) <= len(source) * 5 + 10
+
+def _translate_batch(client, batch, dest_lang):
+    """Translates a batch in one request by packing it with marker lines; returns ({source: translation}, round_trips, verified).
+
+    If the translator mangles the markers (item count changes) or any unpacked segment fails
+    _segment_matches_source, the batch is re-sent through the client's list API instead. On failure
+    the original strings are kept. `verified` is True when every string was translated on its own
+    (a single string, or the list API), so its pairing with the source is certain.
+    """
+    round_trips = 0
+    try:
+        if len(batch) == 1:
+            round_trips += 1
+            return {batch[0]: client.translate(batch[0], dest=dest_lang).text}, round_trips, True
+        round_trips += 1
+        packed = client.translate(TRANSLATION_SEPARATOR.join(batch), dest=dest_lang).text
+        parts = _TRANSLATION_SPLIT_RE.split(packed.strip())
+        if len(parts) != len(batch):
+            logging.warning(f"Translation batch of {len(batch)} strings came back as {len(parts)} parts, retrying with the list API.")
+        elif not all(_segment_matches_source(source, part) for source, part in zip(batch, parts)):
+            logging.warning(f"Translation batch of {len(batch)} strings came back misaligned, retrying with the list API.")
+        else:
+            return dict(zip(batch, parts)), round_trips, False
+        translation_stats.add(fallback_batches=1)
+        round_trips += 1
+        return {source: translated.text for source, translated in zip(batch, client.translate(batch, dest=dest_lang))}, round_trips, True
+    except Exception as trans_err:
+        logging.warning(f"Translation failed for a batch of {len(batch)} strings (first: '{batch[0][:30]}...'): {trans_err}. Returning originals.")
+        return {}, round_trips, False
+
+def translate_analysis(analysis_dict, target_language, translator_client=None):
+    """Translates the values and optionally keys of an analysis dictionary.
+
+    All string leaves are collected and de-duplicated first, then translated in size-bounded
+    batches with bounded concurrency, and written back into the original structure.
+    `translator_client` defaults to the shared googletrans Translator (pass a stub in tests).
+    """
     if not isinstance(analysis_dict, dict):
         logging.warning("translate_analysis called with non-dictionary input.")
         return analysis_dict
@@ -636,32 +1839,37 @@ def translate_analysis(analysis_dict, target_language):
         return analysis_dict
 
     logging.info(f"Attempting to translate analysis to: {target_language_code}")
+    client = translator_client or translator
     translated_analysis = {}
 
     try:
-        # Nested function to handle translation
-        def translate_value(value, dest_lang):
-            if isinstance(value, str) and value.strip():
-                try:
-                    # Add slight delay to potentially avoid rate limits (adjust as needed)
-                    # time.sleep(0.05)
-                    translated = translator.translate(value, dest=dest_lang).text
-                    return translated
-                except Exception as trans_err:
-                    logging.warning(f"Translation failed for string snippet '{value[:30]}...': {trans_err}. Returning original.")
-                    return value # Return original string on error
-            elif isinstance(value, list):
-                # Translate each item in the list
-                return [translate_value(item, dest_lang) for item in value]
-            elif isinstance(value, dict):
-                 # Recursively translate values in nested dictionaries
-                return {k: translate_value(v, dest_lang) for k, v in value.items()}
-            # Return non-string/non-list/non-dict items as is (like null, numbers, booleans)
-            return value
-
-        # Translate all values first
-        for key, value in analysis_dict.items():
-            translated_analysis[key] = translate_value(value, target_language_code)
+        strings = []
+        _collect_translatable_strings(analysis_dict, strings)
+        unique_strings = list(dict.fromkeys(strings)) # De-duplicate, keeping first-seen order
+
+        # Consult the translation memory first; only unseen phrases go to the translator
+        translations = {}
+        if translation_memory is not None:
+            for text in unique_strings:
+                remembered = translation_memory.get(text, target_language_code)
+                if remembered is not None:
+                    translations[text] = remembered
+        batches = _build_translation_batches([text for text in unique_strings if text not in translations])
+
+        round_trips = 0
+        if batches:
+            with ThreadPoolExecutor(max_workers=max(1, min(TRANSLATION_MAX_CONCURRENCY, len(batches)))) as executor:
+                for batch_translations, batch_round_trips, verified in executor.map(lambda batch: _translate_batch(client, batch, target_language_code), batches):
+                    translations.update(batch_translations)
+                    round_trips += batch_round_trips
+                    # Packed results are only checked heuristically, so they are used for this analysis but never remembered
+                    if translation_memory is not None and verified:
+                        for text, translated in batch_translations.items():
+                            translation_memory.set(text, target_language_code, translated)
+
+        translated_analysis = _replace_translated_strings(analysis_dict, translations)
+        translation_stats.add(analyses=1, strings=len(strings), unique_strings=len(unique_strings), round_trips=round_trips)
+        logging.info(f"Translated {len(strings)} strings ({len(unique_strings)} unique) in {len(batches)} batches, {round_trips} round trips.")
 
         # --- Optional: Translate Keys (Uncomment if needed) ---
         # final_translated_dict = {}
@@ -692,11 +1900,820 @@ def translate_analysis(analysis_dict, target_language):
         return translated_analysis if translated_analysis else analysis_dict
 
 
+# -------------------- Caching --------------------
+
+class DiskCache:
+    """SQLite-backed key/value cache with TTL and size-based (LRU) eviction.
+
+    Values must be JSON serializable; they are stored zlib-compressed.
+    """
+
+    def __init__(self, path, table, max_entries=1000, max_bytes=64 * 1024 * 1024, ttl_seconds=24 * 3600):
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # One shared connection guarded by a lock; WAL lets several worker processes share the file
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_accessed ON {table} (accessed_at)")
+        self._conn.commit()
+
+    def get(self, key):
+        """Returns the cached value or None (expired entries count as misses)."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(f"SELECT value, created_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.ttl_seconds and now - row[1] > self.ttl_seconds):
+                if row is not None:
+                    self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                    self._conn.commit()
+                    self.evictions += 1
+                self.misses += 1
+                return None
+            self._conn.execute(f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(zlib.decompress(row[0]).decode("utf-8"))
+
+    def set(self, key, value):
+        """Stores a value, then evicts expired and least recently used entries."""
+        payload = zlib.compress(json.dumps(value).encode("utf-8"))
+        if self.max_bytes and len(payload) > self.max_bytes:
+            logging.warning(f"Cache entry for '{self.table}' ({len(payload)} bytes) exceeds the cache size limit, not storing.")
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, payload, len(payload), now, now),
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def _evict(self, now):
+        """Drops expired rows, then the least recently accessed rows until within limits. Caller holds the lock."""
+        if self.ttl_seconds:
+            cursor = self._conn.execute(f"DELETE FROM {self.table} WHERE created_at < ?", (now - self.ttl_seconds,))
+            self.evictions += max(cursor.rowcount, 0)
+        count, total_bytes = self._conn.execute(f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {self.table}").fetchone()
+        if count <= self.max_entries and total_bytes <= self.max_bytes:
+            return
+        stale_keys = []
+        for key, size in self._conn.execute(f"SELECT key, size FROM {self.table} ORDER BY accessed_at ASC"):
+            if count <= self.max_entries and total_bytes <= self.max_bytes:
+                break
+            stale_keys.append((key,))
+            count -= 1
+            total_bytes -= size
+        self._conn.executemany(f"DELETE FROM {self.table} WHERE key = ?", stale_keys)
+        self.evictions += len(stale_keys)
+
+    def stats(self):
+        with self._lock:
+            count, total_bytes = self._conn.execute(f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {self.table}").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": count,
+            "bytes": total_bytes,
+        }
+
+
+def file_sha256(source, chunk_size=1024 * 1024):
+    """Returns the hex SHA-256 of a file, read in chunks to keep memory flat, or of a MemoryDocument."""
+    if isinstance(source, MemoryDocument):
+        return hashlib.sha256(source.data).hexdigest()
+    digest = hashlib.sha256()
+    with open(source, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def analysis_cache_key(file_hash, language):
+    """Cache key for an analysis: content hash + model id + target language + extraction budget + chunk size."""
+    model_id = getattr(gemini_model, "model_name", "unknown")
+    language_code = (language or "en").lower().split('-')[0] # Same normalization as translate_analysis
+    return f"{ANALYSIS_CACHE_VERSION}:{file_hash}:{model_id}:{language_code}:{EXTRACTION_MAX_CHARS}:{ANALYSIS_CHUNK_CHARS if ANALYSIS_MAP_REDUCE else 0}"
+
+
+analysis_cache = None
+if ANALYSIS_CACHE_ENABLED:
+    try:
+        analysis_cache = DiskCache(
+            os.path.join(CACHE_DIR, "analysis_cache.sqlite3"),
+            table="analyses",
+            max_entries=ANALYSIS_CACHE_MAX_ENTRIES,
+            max_bytes=ANALYSIS_CACHE_MAX_BYTES,
+            ttl_seconds=ANALYSIS_CACHE_TTL_SECONDS,
+        )
+        logging.info(f"Analysis cache enabled at {analysis_cache.path}")
+    except Exception as e:
+        logging.error(f"Could not initialize analysis cache, continuing without it: {e}")
+        analysis_cache = None
+
+
+class TranslationMemory:
+    """Translation memory keyed by (normalized source text, target language).
+
+    An in-process LRU tier answers hot phrases; an optional DiskCache tier keeps them across restarts
+    and worker processes.
+    """
+
+    def __init__(self, max_entries=5000, disk_cache=None):
+        self.max_entries = max_entries
+        self.disk_cache = disk_cache
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(unicodedata.normalize("NFC", text).split())
+
+    def _key(self, text, language):
+        return f"{language}:{self.normalize(text)}"
+
+    def _remember(self, key, translation):
+        """Inserts into the LRU tier. Caller holds the lock."""
+        self._entries[key] = translation
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, text, language):
+        key = self._key(text, language)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return self._entries[key]
+        translation = None
+        if self.disk_cache is not None:
+            try:
+                translation = self.disk_cache.get(key)
+            except Exception as e:
+                logging.warning(f"Translation memory disk lookup failed: {e}")
+        with self._lock:
+            if translation is None:
+                self.misses += 1
+            else:
+                self.disk_hits += 1
+                self._remember(key, translation)
+        return translation
+
+    def set(self, text, language, translation):
+        key = self._key(text, language)
+        with self._lock:
+            self._remember(key, translation)
+        if self.disk_cache is not None:
+            try:
+                self.disk_cache.set(key, translation)
+            except Exception as e:
+                logging.warning(f"Could not store translation in disk memory: {e}")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            stats = {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+                "memory_entries": len(self._entries),
+            }
+        if self.disk_cache is not None:
+            stats["disk"] = self.disk_cache.stats()
+        return stats
+
+
+translation_memory = None
+if TRANSLATION_MEMORY_SIZE > 0:
+    translation_disk_cache = None
+    if TRANSLATION_MEMORY_DISK:
+        try:
+            translation_disk_cache = DiskCache(
+                os.path.join(CACHE_DIR, "translation_memory.sqlite3"),
+                table="translations",
+                max_entries=TRANSLATION_MEMORY_DISK_MAX_ENTRIES,
+                max_bytes=64 * 1024 * 1024,
+                ttl_seconds=TRANSLATION_MEMORY_TTL_SECONDS,
+            )
+        except Exception as e:
+            logging.error(f"Could not initialize on-disk translation memory, using memory only: {e}")
+    translation_memory = TranslationMemory(TRANSLATION_MEMORY_SIZE, translation_disk_cache)
+
+
+class SessionDataStore:
+    """Server-side store for bulky per-session data (document context, chat history).
+
+    The Flask session only carries the entry id, so cookies stay small regardless of document size.
+    Entries are kept zlib-compressed in an in-process LRU with TTL expiry; the optional DiskCache tier
+    makes entries visible to every worker process and survives restarts.
+    """
+
+    def __init__(self, max_entries=256, ttl_seconds=24 * 3600, disk_cache=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk_cache = disk_cache
+        self._entries = OrderedDict() # key -> (created_at, compressed JSON)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, key, created_at, blob):
+        """Inserts into the LRU tier. Caller holds the lock."""
+        self._entries[key] = (created_at, blob)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def put(self, value, key=None):
+        """Stores a JSON-serializable value under `key` (a new random id if omitted) and returns the key."""
+        key = key or secrets.token_urlsafe(16)
+        blob = zlib.compress(json.dumps(value).encode("utf-8"))
+        with self._lock:
+            self._remember(key, time.time(), blob)
+        if self.disk_cache is not None:
+            try:
+                self.disk_cache.set(key, value)
+            except Exception as e:
+                logging.warning(f"Could not persist session data {key}: {e}")
+        return key
+
+    def get(self, key):
+        """Returns the stored value, or None if unknown or expired."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] > self.ttl_seconds:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(zlib.decompress(entry[1]).decode("utf-8"))
+        value = None
+        if self.disk_cache is not None:
+            try:
+                value = self.disk_cache.get(key) # DiskCache applies the same TTL
+            except Exception as e:
+                logging.warning(f"Session data lookup failed for {key}: {e}")
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._remember(key, now, zlib.compress(json.dumps(value).encode("utf-8")))
+        return value
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.disk_cache is not None:
+            try:
+                self.disk_cache.delete(key)
+            except Exception as e:
+                logging.warning(f"Could not delete session data {key}: {e}")
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "compressed_bytes": sum(len(blob) for _, blob in self._entries.values()),
+            }
+        if self.disk_cache is not None:
+            stats["disk"] = self.disk_cache.stats()
+        return stats
+
+
+context_disk_cache = None
+if CONTEXT_STORE_DISK:
+    try:
+        context_disk_cache = DiskCache(
+            os.path.join(CACHE_DIR, "document_contexts.sqlite3"),
+            table="contexts",
+            max_entries=CONTEXT_STORE_DISK_MAX_ENTRIES,
+            max_bytes=CONTEXT_STORE_DISK_MAX_BYTES,
+            ttl_seconds=CONTEXT_STORE_TTL_SECONDS,
+        )
+    except Exception as e:
+        logging.error(f"Could not initialize on-disk document context store, using memory only: {e}")
+document_contexts = SessionDataStore(CONTEXT_STORE_MAX_ENTRIES, CONTEXT_STORE_TTL_SECONDS, context_disk_cache)
+
+chat_history_disk_cache = None
+if CONTEXT_STORE_DISK:
+    try:
+        chat_history_disk_cache = DiskCache(
+            os.path.join(CACHE_DIR, "chat_histories.sqlite3"),
+            table="chat_histories",
+            max_entries=CONTEXT_STORE_DISK_MAX_ENTRIES,
+            max_bytes=CONTEXT_STORE_DISK_MAX_BYTES,
+            ttl_seconds=CONTEXT_STORE_TTL_SECONDS,
+        )
+    except Exception as e:
+        logging.error(f"Could not initialize on-disk chat history store, using memory only: {e}")
+chat_histories = SessionDataStore(CONTEXT_STORE_MAX_ENTRIES * 4, CONTEXT_STORE_TTL_SECONDS, chat_history_disk_cache)
+
+
+# -------------------- Upload Store --------------------
+
+class UploadStore:
+    """Content-addressed store for uploaded files.
+
+    Each distinct file is kept once, as <sha256><ext> under blobs/<2 hex>/<2 hex>/, so identical uploads
+    share one file and no directory holds more than a few hundred entries. A SQLite index records size
+    and last access. A background thread, started with the first upload, deletes blobs unused for
+    `max_age_seconds` and then the least recently used ones until the store fits in `max_bytes`;
+    blobs used in the last `grace_seconds` are kept so analyses in progress do not lose their file.
+    """
+
+    BLOB_ID_PATTERN = re.compile(r"[0-9a-f]{64}(?:\.[a-z0-9]{1,10})?")
+
+    def __init__(self, root, max_bytes, max_age_seconds, gc_interval_seconds, grace_seconds=300):
+        self.root = root
+        self.blob_dir = os.path.join(root, "blobs")
+        self.tmp_dir = os.path.join(root, "tmp") # Uploads being written; same filesystem, so moves are renames
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.gc_interval_seconds = gc_interval_seconds
+        self.grace_seconds = grace_seconds
+        self.stored = 0
+        self.deduplicated = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.gc_runs = 0
+        self.last_gc_seconds = None
+        self._lock = threading.Lock()
+        self._gc_thread = None
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(self.blob_dir, "index.sqlite3"), timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            "blob_id TEXT PRIMARY KEY, size INTEGER NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_blobs_accessed ON blobs (accessed_at)")
+        self._conn.commit()
+
+    def blob_path(self, blob_id):
+        return os.path.join(self.blob_dir, blob_id[:2], blob_id[2:4], blob_id)
+
+    def blob_id_for_path(self, path):
+        """The blob id if `path` is a blob of this store, else None."""
+        if not isinstance(path, str):
+            return None
+        blob_id = os.path.basename(path)
+        if self.BLOB_ID_PATTERN.fullmatch(blob_id) and os.path.abspath(path) == os.path.abspath(self.blob_path(blob_id)):
+            return blob_id
+        return None
+
+    def put(self, upload, ext=""):
+        """Stores an uploaded file and returns (blob_id, path, deduplicated).
+
+        `upload` is an UploadBuffer, whose hash is already known so a duplicate is never written, or any
+        binary file object, which is hashed while it is copied to a temporary file.
+        """
+        ext = ext.lower() if re.fullmatch(r"\.[A-Za-z0-9]{1,10}", ext or "") else ""
+        if isinstance(upload, UploadBuffer):
+            blob_id = upload.sha256() + ext
+            if self.touch(blob_id):
+                return self._deduplicated(blob_id)
+            if upload.path is not None:
+                return self._add(blob_id, upload.detach_spill())
+        tmp_path, digest = self._write_temp(upload)
+        return self._add(digest + ext, tmp_path)
+
+    def _write_temp(self, upload, chunk_size=1024 * 1024):
+        digest = hashlib.sha256()
+        if upload.seekable():
+            upload.seek(0)
+        with tempfile.NamedTemporaryFile(prefix="upload_", dir=self.tmp_dir, delete=False) as tmp:
+            for chunk in iter(lambda: upload.read(chunk_size), b""):
+                digest.update(chunk)
+                tmp.write(chunk)
+        return tmp.name, digest.hexdigest()
+
+    def _add(self, blob_id, tmp_path):
+        if self.touch(blob_id):
+            os.remove(tmp_path)
+            return self._deduplicated(blob_id)
+        path = self.blob_path(blob_id)
+        now = time.time()
+        with self._lock: # Held across the rename so eviction cannot delete the file between rename and insert
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+            self._conn.execute("INSERT OR REPLACE INTO blobs (blob_id, size, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                               (blob_id, os.path.getsize(path), now, now))
+            self._conn.commit()
+            self.stored += 1
+        self._start_gc()
+        return blob_id, path, False
+
+    def _deduplicated(self, blob_id):
+        with self._lock:
+            self.deduplicated += 1
+        return blob_id, self.blob_path(blob_id), True
+
+    def touch(self, blob_id):
+        """Marks a blob as used now; returns False if it is not (or no longer) in the store."""
+        with self._lock:
+            cursor = self._conn.execute("UPDATE blobs SET accessed_at = ? WHERE blob_id = ?", (time.time(), blob_id))
+            if cursor.rowcount and not os.path.exists(self.blob_path(blob_id)): # Deleted behind the store's back
+                self._conn.execute("DELETE FROM blobs WHERE blob_id = ?", (blob_id,))
+            self._conn.commit()
+            return bool(cursor.rowcount) and os.path.exists(self.blob_path(blob_id))
+
+    def _start_gc(self):
+        if self.gc_interval_seconds <= 0:
+            return
+        with self._lock:
+            if self._gc_thread is None:
+                self._gc_thread = threading.Thread(target=self._gc_loop, name="upload-store-gc", daemon=True)
+                self._gc_thread.start()
+
+    def _gc_loop(self):
+        while True:
+            try:
+                self.collect()
+            except Exception:
+                logging.exception("Upload store eviction failed:")
+            time.sleep(self.gc_interval_seconds)
+
+    def collect(self, now=None):
+        """Deletes idle blobs, then least recently used ones over the size limit; returns how many were removed.
+
+        Also clears abandoned temporary files. Nothing outside blobs/ and tmp/ is touched (see remove_legacy_files).
+        """
+        start = time.perf_counter()
+        now = now or time.time()
+        with self._lock:
+            victims = self._conn.execute("SELECT blob_id, size FROM blobs WHERE accessed_at < ?",
+                                         (now - self.max_age_seconds,)).fetchall() if self.max_age_seconds else []
+            total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0] - sum(size for _, size in victims)
+            if self.max_bytes and total_bytes > self.max_bytes:
+                expired = {blob_id for blob_id, _ in victims}
+                for blob_id, size in self._conn.execute("SELECT blob_id, size FROM blobs WHERE accessed_at < ? ORDER BY accessed_at ASC",
+                                                        (now - self.grace_seconds,)):
+                    if total_bytes <= self.max_bytes:
+                        break
+                    if blob_id not in expired:
+                        victims.append((blob_id, size))
+                        total_bytes -= size
+            for blob_id, _ in victims:
+                try:
+                    os.remove(self.blob_path(blob_id))
+                except FileNotFoundError:
+                    pass
+            self._conn.executemany("DELETE FROM blobs WHERE blob_id = ?", [(blob_id,) for blob_id, _ in victims])
+            self._conn.commit()
+            self.evictions += len(victims)
+            self.evicted_bytes += sum(size for _, size in victims)
+        # Temporary files are not part of the index, so only those past their age are touched
+        self._remove_files_older_than(self.tmp_dir, now - max(self.grace_seconds, 3600))
+        with self._lock:
+            self.gc_runs += 1
+            self.last_gc_seconds = round(time.perf_counter() - start, 4)
+        if victims:
+            logging.info(f"Upload store evicted {len(victims)} blobs in {self.last_gc_seconds}s.")
+        return len(victims)
+
+    def remove_legacy_files(self, max_age_seconds, now=None):
+        """Deletes files that versions before this store saved directly in its root, once they are older than
+        `max_age_seconds`; returns how many were removed. A one-off migration (flask clean-legacy-uploads)."""
+        return self._remove_files_older_than(self.root, (now or time.time()) - max_age_seconds)
+
+    @staticmethod
+    def _remove_files_older_than(directory, cutoff):
+        removed = 0
+        for entry in os.scandir(directory):
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError:
+                pass
+        return removed
+
+    def stats(self):
+        with self._lock:
+            count, total_bytes = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+            return {
+                "blobs": count,
+                "bytes": total_bytes,
+                "stored": self.stored,
+                "deduplicated": self.deduplicated,
+                "evictions": self.evictions,
+                "evicted_bytes": self.evicted_bytes,
+                "gc_runs": self.gc_runs,
+                "last_gc_seconds": self.last_gc_seconds,
+            }
+
+
+upload_store = UploadStore(UPLOAD_FOLDER, UPLOAD_STORE_MAX_BYTES, UPLOAD_STORE_MAX_AGE_SECONDS, UPLOAD_STORE_GC_INTERVAL_SECONDS)
+
+@app.cli.command("clean-legacy-uploads")
+@click.option("--older-than", "older_than", type=int, default=UPLOAD_STORE_MAX_AGE_SECONDS, show_default=True,
+              help="Only delete files last modified this many seconds ago or earlier.")
+def clean_legacy_uploads_command(older_than):
+    """Deletes the files that versions before the upload store saved directly in the upload folder."""
+    removed = upload_store.remove_legacy_files(older_than)
+    print(f"Removed {removed} legacy uploads from {upload_store.root}.")
+
+
+def upload_sha256(source):
+    """SHA-256 of an upload, taken from the blob name or buffered upload when already known."""
+    blob_id = upload_store.blob_id_for_path(source)
+    if blob_id:
+        return blob_id[:64]
+    if isinstance(source, MemoryDocument) and source.sha256:
+        return source.sha256
+    return file_sha256(source)
+
+
+# -------------------- Speculative Extraction --------------------
+
+class SpeculativeExtractor:
+    """Extracts uploaded text documents in the background so /analyze can pick up the result.
+
+    Entries are keyed by file path (uploads are content-addressed, so a path always holds the same bytes)
+    and shared by every session that uploaded the file. release() drops one session's claim; once no
+    claims are left, an extraction still running is cancelled. Results are kept for `ttl_seconds` after
+    they were last used, and at most `max_entries` of them.
+    """
+
+    def __init__(self, workers, max_entries, ttl_seconds):
+        self.workers = workers
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.counts = Counter() # started, reused, awaited, missed, cancelled, failed
+        self.overlap_seconds = 0.0 # Extraction time that ran before /analyze asked for the text
+        self._entries = OrderedDict() # path -> entry (LRU)
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def start(self, path):
+        """Claims `path` for the caller's session and starts extracting it, unless that is already under way."""
+        path = os.path.abspath(path)
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            entry = self._entries.get(path)
+            if entry is not None:
+                entry['holders'] += 1
+                entry['used_at'] = now
+                self._entries.move_to_end(path)
+                return
+            while len(self._entries) >= self.max_entries:
+                self._drop(*self._entries.popitem(last=False))
+            entry = {'cancel': threading.Event(), 'coverage': {}, 'holders': 1,
+                     'started_at': now, 'finished_at': None, 'used_at': now}
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=max(1, self.workers), thread_name_prefix="speculative-extract")
+            entry['future'] = self._executor.submit(self._extract, path, entry)
+            self._entries[path] = entry
+            self.counts['started'] += 1
+
+    def _extract(self, path, entry):
+        try:
+            return extract_text(path, max_chars=EXTRACTION_MAX_CHARS, coverage=entry['coverage'], cancel=entry['cancel'])
+        finally:
+            entry['finished_at'] = time.time()
+
+    def release(self, path):
+        """Drops one claim on `path` (a newer upload replaced it); cancels the extraction if it was the last."""
+        path = os.path.abspath(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                return
+            entry['holders'] -= 1
+            if entry['holders'] <= 0:
+                self._drop(path, self._entries.pop(path))
+
+    def _drop(self, path, entry):
+        """Forgets an entry, cancelling its extraction if still running. Caller holds the lock."""
+        if entry['finished_at'] is None:
+            entry['cancel'].set()
+            entry['future'].cancel()
+            self.counts['cancelled'] += 1
+            logging.info(f"Cancelled speculative extraction of {os.path.basename(path)}.")
+
+    def _prune(self, now):
+        for path in [path for path, entry in self._entries.items() if now - entry['used_at'] > self.ttl_seconds]:
+            self._drop(path, self._entries.pop(path))
+
+    def take(self, path):
+        """Returns (text, coverage) extracted from `path` in the background, waiting if that is still running.
+
+        Returns None when there is no usable result (never started, cancelled or failed), so the caller
+        extracts the file itself.
+        """
+        path = os.path.abspath(path)
+        asked_at = time.time()
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                entry['used_at'] = asked_at
+        if entry is None:
+            outcome, text = 'missed', None
+        else:
+            outcome = 'reused' if entry['future'].done() else 'awaited'
+            try:
+                text = entry['future'].result()
+            except (ExtractionCancelled, CancelledError):
+                outcome, text = 'missed', None
+            except Exception as e:
+                logging.warning(f"Speculative extraction of {os.path.basename(path)} failed, extracting again: {e}")
+                outcome, text = 'failed', None
+        with self._lock:
+            self.counts[outcome] += 1
+            if text is not None:
+                self.overlap_seconds += max(0.0, min(entry['finished_at'], asked_at) - entry['started_at'])
+        if text is None:
+            return None
+        logging.info(f"Using speculative extraction of {os.path.basename(path)} ({outcome}).")
+        return text, dict(entry['coverage'])
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'running': sum(1 for entry in self._entries.values() if entry['finished_at'] is None),
+                **{name: self.counts[name] for name in ('started', 'reused', 'awaited', 'missed', 'cancelled', 'failed')},
+                'overlap_seconds': round(self.overlap_seconds, 3),
+            }
+
+
+speculative_extractor = SpeculativeExtractor(SPECULATIVE_EXTRACTION_WORKERS, SPECULATIVE_EXTRACTION_MAX_ENTRIES,
+                                             SPECULATIVE_EXTRACTION_TTL_SECONDS)
+
+
+def claim_speculative_extraction(file_path):
+    """Points the session at a new upload: releases the previous upload's extraction and, for text
+    documents, starts extracting the new one (`file_path` None just releases)."""
+    previous = session.pop('speculative_extraction_path', None)
+    if file_path and SPECULATIVE_EXTRACTION and pathlib.Path(file_path).suffix.lower() not in ANALYSIS_IMAGE_EXTENSIONS:
+        speculative_extractor.start(file_path)
+        session['speculative_extraction_path'] = file_path
+    if previous:
+        speculative_extractor.release(previous)
+
+
+# -------------------- Chat Retrieval --------------------
+
+CHAT_STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from has have how i if in is it its me my of on or should "
+    "that the this to was what when where which who why will with you your".split()
+)
+
+def tokenize_for_search(text):
+    """Lowercased word/number tokens (keeps decimals like 13.5) without common stopwords."""
+    return [t for t in re.findall(r"[a-z0-9]+(?:\.[0-9]+)?", text.lower()) if t not in CHAT_STOPWORDS]
+
+def chunk_document_text(text, chunk_chars, overlap_chars):
+    """Splits text into ~chunk_chars pieces on line boundaries, repeating ~overlap_chars between neighbours."""
+    chunks, current, current_len = [], [], 0
+    lines = []
+    for line in text.splitlines():
+        if len(line) > chunk_chars: # Hard-wrap pathological lines (e.g. whole PDFs without newlines)
+            lines.extend(line[i:i + chunk_chars] for i in range(0, len(line), chunk_chars))
+        else:
+            lines.append(line)
+    for line in lines:
+        if current and current_len + len(line) + 1 > chunk_chars:
+            chunks.append("\n".join(current))
+            # Carry trailing lines over so facts spanning a boundary are retrievable from either side
+            carried, carried_len = [], 0
+            for previous in reversed(current[1:]): # Never carry the whole chunk, or chunks would repeat
+                if carried_len + len(previous) + 1 > overlap_chars:
+                    break
+                carried.insert(0, previous)
+                carried_len += len(previous) + 1
+            current, current_len = carried, carried_len
+        current.append(line)
+        current_len += len(line) + 1
+    if current and any(l.strip() for l in current):
+        chunks.append("\n".join(current))
+    return chunks
+
+
+class DocumentIndex:
+    """Okapi BM25 index over document chunks; postings are numpy arrays per term."""
+
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self, text, chunk_chars=1200, overlap_chars=200):
+        self.chunks = chunk_document_text(text, chunk_chars, overlap_chars)
+        postings = {}
+        lengths = []
+        for chunk_id, chunk in enumerate(self.chunks):
+            counts = Counter(tokenize_for_search(chunk))
+            lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                ids, tfs = postings.setdefault(term, ([], []))
+                ids.append(chunk_id)
+                tfs.append(tf)
+        self.chunk_lengths = np.array(lengths, dtype=np.float32)
+        self.avg_length = max(float(self.chunk_lengths.mean()), 1.0) if lengths else 1.0
+        n = len(self.chunks)
+        self.postings = {}
+        for term, (ids, tfs) in postings.items():
+            idf = math.log(1 + (n - len(ids) + 0.5) / (len(ids) + 0.5))
+            self.postings[term] = (np.array(ids, dtype=np.int32), np.array(tfs, dtype=np.float32), idf)
+
+    def search(self, query, top_k):
+        """Returns up to top_k chunk ids ranked by BM25 score (only chunks sharing a term with the query)."""
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        for term in set(tokenize_for_search(query)):
+            if term not in self.postings:
+                continue
+            ids, tfs, idf = self.postings[term]
+            norm = self.chunk_lengths[ids] / self.avg_length
+            scores[ids] += idf * tfs * (self.K1 + 1) / (tfs + self.K1 * (1 - self.B + self.B * norm))
+        ranked = np.argsort(-scores, kind="stable")[:top_k]
+        return [int(chunk_id) for chunk_id in ranked if scores[chunk_id] > 0]
+
+
+_chat_indexes = OrderedDict() # context_id -> DocumentIndex (LRU)
+_chat_indexes_lock = threading.Lock()
+
+def get_document_index(context_id, text):
+    """Returns the chat index for a stored document context, building it on first use in this process."""
+    with _chat_indexes_lock:
+        index = _chat_indexes.get(context_id)
+        if index is not None:
+            _chat_indexes.move_to_end(context_id)
+            return index
+    start = time.perf_counter()
+    index = DocumentIndex(text, CHAT_CHUNK_CHARS, CHAT_CHUNK_OVERLAP_CHARS)
+    logging.info(f"Indexed document context {context_id}: {len(index.chunks)} chunks, {len(index.postings)} terms in {time.perf_counter() - start:.3f}s.")
+    with _chat_indexes_lock:
+        _chat_indexes[context_id] = index
+        while len(_chat_indexes) > CONTEXT_STORE_MAX_ENTRIES:
+            _chat_indexes.popitem(last=False)
+    return index
+
+def select_chat_context(context_id, text, query):
+    """Picks the document text to put in a chat prompt.
+
+    Short documents are sent whole; longer ones contribute only the top-k chunks relevant to the query
+    (in document order), capped at MAX_CONTEXT_CHARS_FOR_CHAT. Returns (context_text, description).
+    """
+    if len(text) <= CHAT_FULL_CONTEXT_MAX_CHARS:
+        return text, "full document"
+    index = get_document_index(context_id, text)
+    chunk_ids = index.search(query, CHAT_RETRIEVAL_TOP_K)
+    if not chunk_ids: # Nothing matched (e.g. "summarize this"): fall back to the opening of the document
+        chunk_ids = list(range(min(CHAT_RETRIEVAL_TOP_K, len(index.chunks))))
+    selected, used_chars = [], 0
+    for chunk_id in chunk_ids: # Ranked best first, so the budget keeps the most relevant chunks
+        chunk = index.chunks[chunk_id]
+        if selected and used_chars + len(chunk) > MAX_CONTEXT_CHARS_FOR_CHAT:
+            break
+        selected.append(chunk_id)
+        used_chars += len(chunk)
+    excerpts = [f"[Excerpt {chunk_id + 1} of {len(index.chunks)}]\n{index.chunks[chunk_id][:MAX_CONTEXT_CHARS_FOR_CHAT]}" for chunk_id in sorted(selected)]
+    return "\n...\n".join(excerpts), f"{len(selected)} of {len(index.chunks)} chunks"
+
+
 # -------------------- Flask Routes --------------------
 
+def safe_upload_filename(filename):
+    """Strips an uploaded file name down to letters, digits, '.', '_' and '-' (random name if nothing is left)."""
+    filename = "".join(c for c in filename if c.isalnum() or c in ('.', '_', '-')).strip()
+    return filename or f"uploaded_file_{secrets.token_hex(4)}" # Add random hex if sanitization fails
+
+
 @app.route("/upload", methods=["POST"])
 def upload_file():
-    """Upload a file, save it, and clear previous document context AND chat history."""
+    """Upload a file into the upload store (identical files are kept once) and clear previous document context AND chat history."""
     if "file" not in request.files:
         logging.warning("Upload attempt with no file part.")
         return jsonify({"error": "No file part"}), 400
@@ -706,33 +2723,386 @@ def upload_file():
         logging.warning("Upload attempt with no selected file.")
         return jsonify({"error": "No selected file"}), 400
 
-    filename = "".join(c for c in file.filename if c.isalnum() or c in ('.', '_', '-')).strip()
-    if not filename:
-        filename = f"uploaded_file_{secrets.token_hex(4)}" # Add random hex if sanitization fails
-
-    file_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
+    filename = safe_upload_filename(file.filename)
 
     try:
-        file.save(file_path)
-        logging.info(f"✅ File uploaded: {file_path}")
+        blob_id, file_path, deduplicated = upload_store.put(file.stream, pathlib.Path(filename).suffix)
+        logging.info(f"✅ File uploaded: {filename} -> {blob_id}{' (already stored)' if deduplicated else ''}")
+
+        # --- Start extracting the new file; cancel the previous upload's extraction ---
+        claim_speculative_extraction(file_path)
 
         # --- Clear previous context AND chat history on new upload ---
-        session.pop('last_analyzed_text', None)
-        session.pop('last_analyzed_filename', None)
-        session.pop('last_analysis_result', None)
-        session.pop('chat_history', None) # <-- Clear chat history
+        clear_analysis_context()
+        clear_chat_history() # <-- Clear chat history
         logging.info("Cleared previous document context, analysis, and chat history from session due to new upload.")
         session.modified = True # Ensure session changes are saved
 
-        return jsonify({"message": "File uploaded successfully", "file_path": file_path, "filename": filename}), 200
+        return jsonify({"message": "File uploaded successfully", "file_path": file_path, "filename": filename, "deduplicated": deduplicated}), 200
     except Exception as e:
         logging.error(f"❌ Failed to save uploaded file {filename}: {e}", exc_info=True)
         return jsonify({"error": f"Failed to save file: {e}"}), 500
 
 
+class AnalysisError(Exception):
+    """Raised by run_analysis for failures that map to an HTTP error response."""
+
+    def __init__(self, message, status_code=500, details=None, clear_context=False):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.details = details
+        self.clear_context = clear_context # Whether stale document context should be dropped from the session
+
+    def to_response(self):
+        payload = {'error': self.message}
+        if self.details is not None:
+            payload['details'] = self.details
+        return payload
+
+
+def run_analysis(file_path, filename, language='en', on_stage=None, model_slots=None, content_sha256=None):
+    """Extracts, analyzes and translates one uploaded file without touching the Flask session.
+
+    `file_path` may also be a MemoryDocument, for uploads analyzed without saving them (/analyze/upload).
+    `on_stage` is called with 'extracting', 'analyzing' and 'translating' as the work progresses,
+    so it can run on a background worker. `model_slots` (e.g. a semaphore) is held around each Gemini
+    request only, which bounds model calls without holding back extraction. `content_sha256` is the
+    file's digest when already known (e.g. from its upload buffer). Raises AnalysisError on failure.
+    """
+    def stage(name):
+        if on_stage:
+            on_stage(name)
+
+    # --- Serve repeat analyses of identical content from the cache ---
+    cache_key = None
+    if analysis_cache is not None:
+        try:
+            cache_key = analysis_cache_key(content_sha256 or upload_sha256(file_path), language)
+            cached = analysis_cache.get(cache_key)
+        except Exception as cache_err:
+            logging.warning(f"Analysis cache lookup failed for {filename}: {cache_err}")
+            cached = None
+        if cached:
+            logging.info(f"⚡ Analysis cache hit for {filename} (language: {language}).")
+            return dict(cached, filename=filename, cached=True)
+
+    # Determine file type and call appropriate analysis function
+    ext = pathlib.Path(filename).suffix.lower()
+    analysis_result = None
+    extracted_text_for_session = None
+    coverage = None
+    analysis_stats = {}
+
+    logging.info(f"Analyzing file: {filename} (type: {ext}), Target language: {language}")
+
+    # --- Image Analysis Path ---
+    if ext in ANALYSIS_IMAGE_EXTENSIONS:
+        logging.info(f"Detected image file type ({ext}). Reading image data...")
+        stage('extracting')
+        try:
+            if isinstance(file_path, MemoryDocument):
+                image_data = file_path.data
+            else:
+                with open(file_path, "rb") as f:
+                    image_data = f.read()
+        except FileNotFoundError:
+             logging.error(f"Image file not found at path during read: {file_path}")
+             raise AnalysisError(f'File not found during analysis: {filename}', 404)
+        except Exception as img_read_err:
+             logging.error(f"Error reading image file {filename}: {img_read_err}", exc_info=True)
+             raise AnalysisError(f'Error reading image file: {img_read_err}', 500)
+        if not image_data:
+             logging.error(f"Read 0 bytes from image file: {file_path}")
+             raise AnalysisError(f'Could not read image file content: {filename}', 500)
+
+        stage('analyzing')
+        analysis_result = analyze_image_with_gemini(image_data, filename, stats=analysis_stats, model_slots=model_slots)
+
+    # --- Text/Document Analysis Path ---
+    elif ext in ANALYSIS_TEXT_EXTENSIONS or not ext: # Treat common docs or no extension as text-based
+         logging.info(f"Detected text-based file type ({ext}). Extracting text...")
+         stage('extracting')
+         # Only /upload starts speculative extraction, so other sources (memory, spilled request files) never have one
+         speculative = speculative_extractor.take(file_path) if SPECULATIVE_EXTRACTION and upload_store.blob_id_for_path(file_path) else None
+         if speculative is not None:
+             extracted_text, coverage = speculative
+         else:
+             coverage = {}
+             extracted_text = extract_text(file_path, max_chars=EXTRACTION_MAX_CHARS, coverage=coverage)
+
+         if not extracted_text:
+             # Provide specific feedback if OCR failed on an image file processed via extract_text
+             if os.path.splitext(filename)[1].lower() in ImageExtractor.extensions and (isinstance(file_path, MemoryDocument) or os.path.exists(file_path)):
+                 logging.warning(f"OCR failed to extract text from image file via text path: {filename}")
+                 raise AnalysisError(f'Could not extract text using OCR from image file: {filename}. Analysis cannot proceed.', 400)
+             else:
+                 logging.warning(f"No text could be extracted from file: {filename}")
+                 raise AnalysisError(f'No text could be extracted from the file: {filename}. It might be empty, corrupted, or an unsupported format.', 400)
+
+         # Store extracted text for potential chat context
+         extracted_text_for_session = extracted_text
+         stage('analyzing')
+         analysis_result = analyze_text_with_gemini(extracted_text, truncated=not coverage.get('complete', True), stats=analysis_stats,
+                                                    model_slots=model_slots)
+         if analysis_stats.get('chars_analyzed', len(extracted_text)) < len(extracted_text): # Extracted text that did not fit the prompts
+             coverage = dict(coverage, chars_analyzed=analysis_stats['chars_analyzed'], complete=False)
+
+    # --- Unsupported File Type ---
+    else:
+        logging.warning(f"Unsupported file type for analysis: {ext} ({filename})")
+        raise AnalysisError(f'Unsupported file type: {ext}. Cannot analyze this file.', 400)
+
+    # --- Check Analysis Result ---
+    if not analysis_result or 'error' in analysis_result:
+        logging.error(f"Analysis failed for {filename}. Result: {analysis_result}")
+        error_message = analysis_result.get('error', 'Unknown analysis error') if isinstance(analysis_result, dict) else "Unknown analysis error"
+        # Clear potentially incomplete session data if analysis failed
+        raise AnalysisError(error_message, 500, details=analysis_result, clear_context=True)
+
+    # --- Translate the successful analysis ---
+    stage('translating')
+    final_analysis = translate_analysis(analysis_result, language)
+
+    result = {
+        'final_analysis': final_analysis,
+        'analysis_result': analysis_result,
+        'extracted_text': extracted_text_for_session, # Only set when text was successfully extracted and analyzed
+        'coverage': coverage, # How much of a text document was read (None for images)
+        'analysis_stats': analysis_stats or None, # Single prompt or map-reduce with per-chunk latency, or the image preparation report
+    }
+    if cache_key is not None:
+        try:
+            analysis_cache.set(cache_key, result)
+        except Exception as cache_err:
+            logging.warning(f"Could not store analysis for {filename} in cache: {cache_err}")
+
+    return dict(result, filename=filename, cached=False)
+
+
+def clear_analysis_context():
+    """Drops the document context used by chat from the context store and the session."""
+    context_id = session.pop('document_context_id', None)
+    if context_id:
+        document_contexts.delete(context_id)
+        with _chat_indexes_lock:
+            _chat_indexes.pop(context_id, None)
+    for legacy_key in ('last_analyzed_text', 'last_analyzed_filename', 'last_analysis_result'): # Pre context-store cookies
+        session.pop(legacy_key, None)
+    session.modified = True
+
+
+def store_analysis_context(result):
+    """Saves the chat context of a finished text analysis server-side; returns its id (None if no text)."""
+    if not result.get('extracted_text'):
+        return None
+    context_id = document_contexts.put({
+        'filename': result['filename'],
+        'text': result['extracted_text'],
+        'analysis_result': result['analysis_result'], # Store the analysis JSON too
+    })
+    logging.info(f"Stored extracted text ({len(result['extracted_text'])} chars) and analysis result for {result['filename']} as context {context_id}.")
+    if len(result['extracted_text']) > CHAT_FULL_CONTEXT_MAX_CHARS:
+        get_document_index(context_id, result['extracted_text']) # Index now so the first chat question does not pay for it
+    return context_id
+
+
+def apply_analysis_context(result):
+    """Points the session at the document context of a finished analysis, or clears it if no text was analyzed."""
+    context_id = result.get('context_id') or store_analysis_context(result)
+    if context_id is None:
+        clear_analysis_context()
+        return
+    previous_id = session.get('document_context_id')
+    if previous_id and previous_id != context_id:
+        document_contexts.delete(previous_id)
+    session['document_context_id'] = context_id
+    session.modified = True
+
+
+def load_analysis_context():
+    """Returns the session's document context dict (filename, text, analysis_result) or None."""
+    context_id = session.get('document_context_id')
+    return document_contexts.get(context_id) if context_id else None
+
+
+def run_analysis_job(file_path, filename, language='en', on_stage=None):
+    """Background variant of run_analysis: parks the extracted text in the context store right away,
+    so the finished job only holds the context id and polling does not copy the document around."""
+    result = run_analysis(file_path, filename, language, on_stage=on_stage)
+    result['context_id'] = store_analysis_context(result)
+    result['extracted_text'] = None
+    return result
+
+
+def analysis_response(result):
+    """Response body for a finished analysis: the final analysis, plus `document_coverage` when only
+    part of the document fit in the extraction budget."""
+    coverage = result.get('coverage')
+    if coverage and not coverage.get('complete', True):
+        return dict(result['final_analysis'], document_coverage=coverage)
+    return result['final_analysis']
+
+
+def resolve_upload_path(file_path, filename):
+    """Returns the path of an uploaded file, or None.
+
+    Only blobs of the upload store and files that older versions saved in UPLOAD_FOLDER (looked up by
+    secure_filename) are accepted, never another client-supplied path. Stored uploads are marked as used,
+    which keeps them from eviction while they are being analyzed."""
+    blob_id = upload_store.blob_id_for_path(file_path)
+    if blob_id:
+        return file_path if upload_store.touch(blob_id) else None
+    legacy_name = secure_filename(filename)
+    legacy_path = os.path.join(app.config["UPLOAD_FOLDER"], legacy_name)
+    if legacy_name and os.path.isfile(legacy_path):
+        return legacy_path
+    logging.error(f"/analyze error: File not found at path: {file_path}")
+    return None
+
+
+# -------------------- Background Jobs --------------------
+
+class InlineJobBackend:
+    """Runs each job immediately in the submitting thread (deterministic, for tests and debugging)."""
+
+    def submit(self, func):
+        func()
+
+    def shutdown(self):
+        pass
+
+
+class ThreadJobBackend:
+    """Runs jobs on a bounded pool of worker threads.
+
+    Threads are enough here: the CPU-heavy extraction already fans out to the extraction process pool,
+    and the rest of an analysis is waiting on Gemini and the translator.
+    """
+
+    def __init__(self, max_workers):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="analysis-job")
+
+    def submit(self, func):
+        self._executor.submit(func)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+JOB_BACKENDS = {
+    'thread': lambda: ThreadJobBackend(ANALYSIS_JOB_WORKERS),
+    'inline': InlineJobBackend,
+}
+
+
+class JobQueueFull(Exception):
+    """Raised when too many jobs are already waiting."""
+
+
+class JobQueue:
+    """Tracks background jobs through their stages and records per-stage durations."""
+
+    def __init__(self, backend, max_pending=100, ttl_seconds=900):
+        self.backend = backend
+        self.max_pending = max_pending
+        self.ttl_seconds = ttl_seconds # Finished jobs are forgotten after this long
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._stage_totals = {} # stage -> [count, total_seconds]
+
+    def submit(self, func, *args, **kwargs):
+        """Queues func(*args, on_stage=..., **kwargs) and returns the new job id."""
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            if self._count('queued') >= self.max_pending:
+                raise JobQueueFull(f"{self.max_pending} jobs are already waiting")
+            job_id = secrets.token_urlsafe(16)
+            self._jobs[job_id] = {
+                'job_id': job_id, 'status': 'queued', 'stage': 'queued',
+                'created_at': now, 'stage_started_at': now, 'finished_at': None,
+                'stage_durations': {}, 'result': None, 'error': None, 'status_code': None,
+            }
+        self.backend.submit(lambda: self._run(job_id, func, args, kwargs))
+        return job_id
+
+    def _run(self, job_id, func, args, kwargs):
+        with self._lock:
+            self._jobs[job_id]['status'] = 'running'
+        try:
+            result = func(*args, on_stage=lambda stage: self._set_stage(job_id, stage), **kwargs)
+        except AnalysisError as e:
+            self._finish(job_id, 'failed', error=e.to_response(), status_code=e.status_code)
+        except Exception as e:
+            logging.exception(f"❌ Background job {job_id} failed:")
+            self._finish(job_id, 'failed', error={'error': f'An unexpected server error occurred: {e}'}, status_code=500)
+        else:
+            self._finish(job_id, 'done', result=result, status_code=200)
+
+    def _close_stage(self, job, now):
+        """Records how long the job spent in its current stage. Caller holds the lock."""
+        elapsed = now - job['stage_started_at']
+        job['stage_durations'][job['stage']] = round(job['stage_durations'].get(job['stage'], 0.0) + elapsed, 4)
+        totals = self._stage_totals.setdefault(job['stage'], [0, 0.0])
+        totals[0] += 1
+        totals[1] += elapsed
+
+    def _set_stage(self, job_id, stage):
+        now = time.time()
+        with self._lock:
+            job = self._jobs[job_id]
+            self._close_stage(job, now)
+            job['stage'] = stage
+            job['stage_started_at'] = now
+        logging.info(f"Job {job_id}: {stage}")
+
+    def _finish(self, job_id, status, result=None, error=None, status_code=None):
+        now = time.time()
+        with self._lock:
+            job = self._jobs[job_id]
+            self._close_stage(job, now)
+            job.update(status=status, stage=status, stage_started_at=now, finished_at=now,
+                       result=result, error=error, status_code=status_code)
+
+    def _count(self, status):
+        return sum(1 for job in self._jobs.values() if job['status'] == status)
+
+    def _prune(self, now):
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job['finished_at'] is not None and now - job['finished_at'] > self.ttl_seconds]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        """Returns a snapshot of the job, or None if it is unknown or expired."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job, stage_durations=dict(job['stage_durations'])) if job else None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queue_depth': self._count('queued'),
+                'running': self._count('running'),
+                'done': self._count('done'),
+                'failed': self._count('failed'),
+                'avg_stage_seconds': {stage: round(total / count, 4) for stage, (count, total) in self._stage_totals.items()},
+            }
+
+
+analysis_jobs = JobQueue(JOB_BACKENDS.get(ANALYSIS_JOB_BACKEND, JOB_BACKENDS['thread'])(),
+                         max_pending=ANALYSIS_JOB_MAX_PENDING, ttl_seconds=ANALYSIS_JOB_TTL_SECONDS)
+
+
 @app.route("/analyze", methods=["POST"])
 def analyze_report():
-    """Analyzes uploaded file (text or image) and returns structured JSON."""
+    """Analyzes uploaded file (text or image) and returns structured JSON.
+
+    Send `"async": true` to queue the analysis instead; the response carries a job id to poll
+    at GET /analyze/jobs/<job_id>.
+    """
+    data = {}
     try:
         data = request.get_json()
         if not data:
@@ -747,169 +3117,377 @@ def analyze_report():
             return jsonify({'error': 'File path and filename are required'}), 400
 
         # Verify file exists
-        if not os.path.exists(file_path):
-             logging.error(f"/analyze error: File not found at path: {file_path}")
-             potential_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-             if os.path.exists(potential_path):
-                 file_path = potential_path
-                 logging.info(f"Corrected file path to: {file_path}")
-             else:
-                 return jsonify({'error': f'File not found: {filename}. It may not have been uploaded correctly or was deleted.'}), 404
-
-        # Determine file type and call appropriate analysis function
-        ext = pathlib.Path(filename).suffix.lower()
-        analysis_result = None
-        extracted_text_for_session = None
-
-        logging.info(f"Analyzing file: {filename} (type: {ext}), Target language: {language}")
+        file_path = resolve_upload_path(file_path, filename)
+        if file_path is None:
+            return jsonify({'error': f'File not found: {filename}. It may not have been uploaded correctly or was deleted.'}), 404
 
-        # --- Image Analysis Path ---
-        if ext in [".png", ".jpg", ".jpeg", ".bmp", ".tiff", ".tif", ".webp"]:
-            logging.info(f"Detected image file type ({ext}). Reading image data...")
+        if data.get('async'):
             try:
-                with open(file_path, "rb") as f:
-                    image_data = f.read()
-                if not image_data:
-                     logging.error(f"Read 0 bytes from image file: {file_path}")
-                     return jsonify({'error': f'Could not read image file content: {filename}'}), 500
-
-                analysis_result = analyze_image_with_gemini(image_data, filename)
-                # Clear any potential stale text context if analyzing an image
-                session.pop('last_analyzed_text', None)
-                session.pop('last_analyzed_filename', None)
-                session.modified = True
-
-            except FileNotFoundError:
-                 logging.error(f"Image file not found at path during read: {file_path}")
-                 return jsonify({'error': f'File not found during analysis: {filename}'}), 404
-            except Exception as img_read_err:
-                 logging.error(f"Error reading image file {filename}: {img_read_err}", exc_info=True)
-                 return jsonify({'error': f'Error reading image file: {img_read_err}'}), 500
-
-        # --- Text/Document Analysis Path ---
-        elif ext in [".pdf", ".docx", ".xlsx", ".txt", ".rtf", ".csv"] or not ext: # Treat common docs or no extension as text-based
-             logging.info(f"Detected text-based file type ({ext}). Extracting text...")
-             extracted_text = extract_text(file_path)
-
-             if not extracted_text:
-                 # Provide specific feedback if OCR failed on an image file processed via extract_text
-                 if os.path.splitext(filename)[1].lower() in [".png", ".jpg", ".jpeg", ".bmp", ".tiff", ".tif"] and os.path.exists(file_path):
-                     logging.warning(f"OCR failed to extract text from image file via text path: {filename}")
-                     return jsonify({'error': f'Could not extract text using OCR from image file: {filename}. Analysis cannot proceed.'}), 400
-                 else:
-                     logging.warning(f"No text could be extracted from file: {filename}")
-                     return jsonify({'error': f'No text could be extracted from the file: {filename}. It might be empty, corrupted, or an unsupported format.'}), 400
-
-             # Store extracted text for potential chat context
-             extracted_text_for_session = extracted_text
-             analysis_result = analyze_text_with_gemini(extracted_text)
-
-        # --- Unsupported File Type ---
-        else:
-            logging.warning(f"Unsupported file type for analysis: {ext} ({filename})")
-            return jsonify({'error': f'Unsupported file type: {ext}. Cannot analyze this file.'}), 400
-
-        # --- Check Analysis Result ---
-        if not analysis_result or 'error' in analysis_result:
-            logging.error(f"Analysis failed for {filename}. Result: {analysis_result}")
-            error_message = analysis_result.get('error', 'Unknown analysis error') if isinstance(analysis_result, dict) else "Unknown analysis error"
-            # Clear potentially incomplete session data if analysis failed
-            session.pop('last_analyzed_text', None)
-            session.pop('last_analyzed_filename', None)
-            session.pop('last_analysis_result', None)
-            session.modified = True
-            return jsonify({'error': error_message, 'details': analysis_result}), 500
-
-        # --- Store context in session ONLY if text was successfully extracted and analyzed ---
-        if extracted_text_for_session and analysis_result and 'error' not in analysis_result:
-             session['last_analyzed_text'] = extracted_text_for_session
-             session['last_analyzed_filename'] = filename
-             session['last_analysis_result'] = analysis_result # Store the analysis JSON too
-             logging.info(f"Stored extracted text ({len(extracted_text_for_session)} chars) and analysis result for {filename} in session.")
-             session.modified = True
-        # Explicitly clear if it wasn't a text analysis success
-        elif 'last_analyzed_text' in session or 'last_analyzed_filename' in session:
-             session.pop('last_analyzed_text', None)
-             session.pop('last_analyzed_filename', None)
-             session.pop('last_analysis_result', None) # Clear analysis result too if no text
-             session.modified = True
-
-
-        # --- Translate the successful analysis ---
-        final_analysis = translate_analysis(analysis_result, language)
+                job_id = analysis_jobs.submit(run_analysis_job, file_path, filename, language)
+            except JobQueueFull as e:
+                logging.warning(f"Rejected async analysis of {filename}: {e}")
+                return jsonify({'error': 'The server is busy analyzing other reports. Please try again shortly.'}), 503
+            logging.info(f"Queued analysis of {filename} as job {job_id}.")
+            return jsonify({'job_id': job_id, 'status': 'queued', 'status_url': f'/analyze/jobs/{job_id}'}), 202
 
+        try:
+            result = run_analysis(file_path, filename, language)
+        except AnalysisError as e:
+            if e.clear_context:
+                clear_analysis_context()
+            return jsonify(e.to_response()), e.status_code
 
+        apply_analysis_context(result)
         # Return the final (potentially translated) analysis
-        return jsonify(final_analysis), 200
+        return jsonify(analysis_response(result)), 200
 
     except Exception as e:
-        logging.exception(f"❌ Unexpected error in /analyze route for file {data.get('filename', 'unknown')}:")
+        logging.exception(f"❌ Unexpected error in /analyze route for file {(data or {}).get('filename', 'unknown')}:")
         return jsonify({'error': f'An unexpected server error occurred during analysis: {str(e)}'}), 500
 
 
+@app.route("/analyze/upload", methods=["POST"])
+def upload_and_analyze():
+    """Uploads and analyzes a file in one request, without saving it to UPLOAD_FOLDER.
+
+    Takes the same multipart `file` as /upload plus an optional `language` form field, and returns
+    the same body as /analyze. Files up to UPLOAD_MEMORY_MAX_BYTES are extracted straight from the
+    request's memory buffer; larger ones from the temporary file they spilled to.
+    """
+    file = request.files.get("file")
+    if not file or file.filename == "":
+        logging.warning("/analyze/upload called without a file.")
+        return jsonify({"error": "No file part"}), 400
+    filename = safe_upload_filename(file.filename)
+    language = request.form.get('language', 'en') or 'en'
+
+    content_sha256 = None
+    if isinstance(file.stream, UploadBuffer):
+        document = file.stream.document(filename)
+        content_sha256 = file.stream.sha256() # Hashed while it was received, also when it spilled to disk
+    else: # Another request class parsed the upload
+        document = MemoryDocument(filename, file.read())
+    logging.info(f"Analyzing upload {filename} from {'memory' if isinstance(document, MemoryDocument) else 'a spilled temp file'}.")
+
+    # A new document replaces the previous context, chat and pending extraction, as with /upload
+    claim_speculative_extraction(None)
+    clear_analysis_context()
+    clear_chat_history()
+    try:
+        result = run_analysis(document, filename, language, content_sha256=content_sha256)
+    except AnalysisError as e:
+        return jsonify(e.to_response()), e.status_code
+    except Exception as e:
+        logging.exception(f"❌ Unexpected error in /analyze/upload for file {filename}:")
+        return jsonify({'error': f'An unexpected server error occurred during analysis: {str(e)}'}), 500
+
+    apply_analysis_context(result)
+    return jsonify(analysis_response(result)), 200
+
+
+class BatchStats:
+    """Totals for /analyze/batch: batches, files analyzed and failed, and time per batch."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.files = 0
+        self.failed = 0
+        self.seconds = 0.0
+
+    def record(self, files, failed, seconds):
+        with self._lock:
+            self.batches += 1
+            self.files += files
+            self.failed += failed
+            self.seconds += seconds
+
+    def stats(self):
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "files": self.files,
+                "failed": self.failed,
+                "avg_batch_seconds": round(self.seconds / self.batches, 3) if self.batches else 0.0,
+                "model_concurrency": BATCH_MODEL_CONCURRENCY,
+            }
+
+batch_stats = BatchStats()
+batch_model_slots = threading.BoundedSemaphore(max(1, BATCH_MODEL_CONCURRENCY)) # Shared by every batch, so parallel batches cannot multiply the load on Gemini
+
+
+def _analyze_batch_file(index, document, filename, language, content_sha256=None):
+    """Runs one file of a batch; returns (event, analysis_result) where the event is the per-file SSE payload."""
+    start = time.perf_counter()
+    event = {'index': index, 'filename': filename}
+    try:
+        result = run_analysis(document, filename, language, model_slots=batch_model_slots, content_sha256=content_sha256)
+    except AnalysisError as e:
+        logging.warning(f"Batch analysis of {filename} failed: {e.message}")
+        return dict(event, **e.to_response(), status='error', status_code=e.status_code, seconds=round(time.perf_counter() - start, 3)), None
+    except Exception as e:
+        logging.exception(f"❌ Unexpected error in batch analysis of {filename}:")
+        return dict(event, status='error', status_code=500, error=f'An unexpected server error occurred during analysis: {e}',
+                    seconds=round(time.perf_counter() - start, 3)), None
+    event.update(status='done', result=analysis_response(result), coverage=result.get('coverage'),
+                 analysis_stats=result.get('analysis_stats'), cached=result['cached'], seconds=round(time.perf_counter() - start, 3))
+    return event, result['analysis_result']
+
+
+def _remove_batch_spills(executor, paths):
+    """Deletes the spilled uploads of a batch once its executor has finished the files already running."""
+    executor.shutdown(wait=True)
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError as e:
+            logging.warning(f"Could not delete spilled batch upload {path}: {e}")
+
+
+def stream_batch_events(documents, language='en', summary=False, spilled=()):
+    """Yields Server-Sent Events for a batch of (filename, document, sha256 or None) analyzed concurrently.
+
+    Files run BATCH_WORKERS at a time, with their Gemini calls limited to BATCH_MODEL_CONCURRENCY
+    across all batches. Each file produces a `file` event as soon as it finishes (in completion order,
+    carrying its `index` in the request); with `summary`, a `summary` event then carries the successful
+    analyses merged by merge_analysis_results and translated once. A final `done` event reports the
+    counts and total time. Files not started yet are cancelled if the client disconnects. The `spilled`
+    temporary files (detached from the request, which closes before the stream is read) are deleted
+    once the batch is over.
+    """
+    start = time.perf_counter()
+    analyses = [None] * len(documents)
+    executor = ThreadPoolExecutor(max_workers=max(1, min(BATCH_WORKERS, len(documents))), thread_name_prefix="batch-analysis")
+    try:
+        futures = [executor.submit(_analyze_batch_file, index, document, filename, language, content_sha256)
+                   for index, (filename, document, content_sha256) in enumerate(documents)]
+        for future in as_completed(futures):
+            event, analysis = future.result()
+            analyses[event['index']] = analysis
+            yield f"event: file\ndata: {json.dumps(event)}\n\n"
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        if spilled:
+            threading.Thread(target=_remove_batch_spills, args=(executor, list(spilled)), name="batch-cleanup", daemon=True).start()
+
+    succeeded = [index for index, analysis in enumerate(analyses) if analysis is not None]
+    if summary and succeeded:
+        try:
+            merged = merge_analysis_results([analyses[index] for index in succeeded])
+            payload = {'files': [documents[index][0] for index in succeeded], 'analysis': translate_analysis(merged, language)}
+            yield f"event: summary\ndata: {json.dumps(payload)}\n\n"
+        except Exception as e:
+            logging.exception("❌ Error while merging the batch summary:")
+            yield f"event: error\ndata: {json.dumps({'error': f'Could not build the batch summary: {e}'})}\n\n"
+
+    total = time.perf_counter() - start
+    failed = len(documents) - len(succeeded)
+    batch_stats.record(len(documents), failed, total)
+    logging.info(f"Batch analysis finished: {len(succeeded)}/{len(documents)} files in {total:.2f}s.")
+    yield f"event: done\ndata: {json.dumps({'files': len(documents), 'succeeded': len(succeeded), 'failed': failed, 'total_ms': round(total * 1000, 1)})}\n\n"
+
+
+@app.route("/analyze/batch", methods=["POST"])
+def analyze_batch():
+    """Analyzes several files (e.g. one patient's record bundle) in one request and streams the results.
+
+    Takes multipart `files` fields (up to BATCH_MAX_FILES), an optional `language` and `summary=true`
+    for a merged summary, and responds with the Server-Sent Events of stream_batch_events. Files are
+    read from the request's upload buffers as in /analyze/upload, but each keeps at most
+    BATCH_UPLOAD_MEMORY_MAX_BYTES in memory; the session's chat context is left as is.
+    """
+    files = [file for file in request.files.getlist("files") if file and file.filename]
+    if not files:
+        logging.warning("/analyze/batch called without files.")
+        return jsonify({"error": "No files provided"}), 400
+    if len(files) > BATCH_MAX_FILES:
+        return jsonify({"error": f"Too many files: {len(files)} (at most {BATCH_MAX_FILES} per batch)"}), 400
+    language = request.form.get('language', 'en') or 'en'
+    summary = request.form.get('summary', 'false').lower() == 'true'
+
+    documents = []
+    spilled = []
+    for file in files:
+        filename = safe_upload_filename(file.filename)
+        if isinstance(file.stream, UploadBuffer):
+            documents.append((filename, file.stream.document(filename), file.stream.sha256())) # Hashed while it was received
+            if file.stream.path is not None: # Closing the request would delete it before the stream reads it
+                spilled.append(file.stream.detach_spill())
+        else: # Another request class parsed the upload
+            documents.append((filename, MemoryDocument(filename, file.read()), None))
+    logging.info(f"Batch analysis of {len(documents)} files (language: {language}, summary: {summary}).")
+
+    return Response(
+        stream_with_context(stream_batch_events(documents, language, summary, spilled)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/analyze/jobs/<job_id>", methods=["GET"])
+def analysis_job_status(job_id):
+    """Reports the progress of a queued analysis and returns its result once finished."""
+    job = analysis_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job id'}), 404
+
+    payload = {
+        'job_id': job_id,
+        'status': job['status'],
+        'stage': job['stage'],
+        'stage_durations': job['stage_durations'],
+        'elapsed_seconds': round((job['finished_at'] or time.time()) - job['created_at'], 4),
+    }
+    if job['status'] == 'done':
+        apply_analysis_context(job['result']) # The worker had no session; attach the chat context for the polling client
+        payload['result'] = analysis_response(job['result'])
+        payload['coverage'] = job['result'].get('coverage')
+        payload['analysis_stats'] = job['result'].get('analysis_stats')
+    elif job['status'] == 'failed':
+        if job['status_code'] == 500:
+            clear_analysis_context()
+        payload.update(job['error'])
+    return jsonify(payload), 200
+
+
+def load_chat_history():
+    """Returns (chat_id, history) for the current session, assigning a chat id on first use."""
+    chat_id = session.get('chat_id')
+    if not chat_id:
+        chat_id = secrets.token_urlsafe(16)
+        session['chat_id'] = chat_id
+        session.modified = True
+    history = chat_histories.get(chat_id) or {'summary': '', 'turns': [], 'compacted_turns': 0}
+    return chat_id, history
+
+
+def clear_chat_history():
+    """Forgets the session's conversation."""
+    chat_id = session.pop('chat_id', None)
+    if chat_id:
+        chat_histories.delete(chat_id)
+    session.pop('chat_history', None) # Pre history-store cookies
+    session.modified = True
+
+
+def _summarize_turn(turn):
+    """One-line digest of an old turn for the rolling summary (question + first sentence of the answer)."""
+    question = " ".join(turn['user'].split())[:CHAT_SUMMARY_SNIPPET_CHARS]
+    answer = re.split(r"(?<=[.!?])\s", " ".join(turn['model'].split()), maxsplit=1)[0][:CHAT_SUMMARY_SNIPPET_CHARS]
+    return f"- User asked: {question} | Assistant: {answer}"
+
+
+def record_chat_turn(chat_id, user_message, answer):
+    """Appends a turn; turns beyond MAX_CHAT_HISTORY_TURNS are folded into a rolling summary
+    capped at CHAT_SUMMARY_MAX_CHARS, so the history in the prompt stays bounded."""
+    history = chat_histories.get(chat_id) or {'summary': '', 'turns': [], 'compacted_turns': 0}
+    history['turns'].append({'user': user_message, 'model': answer})
+    while len(history['turns']) > MAX_CHAT_HISTORY_TURNS:
+        summary_lines = history['summary'].splitlines() + [_summarize_turn(history['turns'].pop(0))]
+        while len(summary_lines) > 1 and len("\n".join(summary_lines)) > CHAT_SUMMARY_MAX_CHARS:
+            summary_lines.pop(0) # Oldest digests fall off first
+        history['summary'] = "\n".join(summary_lines)[-CHAT_SUMMARY_MAX_CHARS:]
+        history['compacted_turns'] += 1
+    chat_histories.put(history, key=chat_id)
+
+
+def format_chat_history(history):
+    """Renders the rolling summary and recent turns for the prompt ('' when there is no history)."""
+    if not history['summary'] and not history['turns']:
+        return ""
+    parts = ["*Conversation So Far:*"]
+    if history['summary']:
+        parts.append(f"Summary of earlier conversation:\n{history['summary']}")
+    for turn in history['turns']:
+        parts.append(f"User: {turn['user']}\nAssistant: {turn['model']}")
+    return "\n\n".join(parts) + "\n"
+
+
+def chat_prompt_stats(prompt, history):
+    """Size report for a chat prompt (tokens approximated as chars / 4)."""
+    return {
+        'prompt_chars': len(prompt),
+        'approx_prompt_tokens': len(prompt) // 4,
+        'history_turns': len(history['turns']),
+        'summarized_turns': history['compacted_turns'],
+        'summary_chars': len(history['summary']),
+    }
+
+
+def build_chat_prompt(user_message, history=None):
+    """Builds the Gemini chat prompt, using the document context referenced by the session if available
+    and the conversation history (rolling summary + recent turns) if given."""
+    history_text = format_chat_history(history) if history else ""
+    # Retrieve document context referenced by the session
+    context_id = session.get('document_context_id')
+    context = load_analysis_context()
+    document_text = context['text'] if context else None
+    filename = context['filename'] if context else None
+
+    if document_text and filename:
+        logging.info(f"Chat query received. Using context from document: {filename}")
+        # Only the parts of the document relevant to this query go into the prompt
+        truncated_context, context_scope = select_chat_context(context_id, document_text, user_message)
+        logging.info(f"Chat context for {filename}: {context_scope}, {len(truncated_context)} of {len(document_text)} chars.")
+
+        # Construct prompt telling Gemini to use the context if relevant
+        prompt_for_gemini = f"""Forget that you are an ai and imagine your self as a helpful medical AI assistant. You have access to the content of a medical document named '{filename}'. Also dont I am an AI assistant and cannot provide medical advice instead tell then that i have suggested the medicine but only take it under a doctor supervision.
+
+        *Instructions:*
+        1. Answer the user's query below.
+        2. *Prioritize using the provided document context* if the query seems related to it. Clearly state if your answer comes from the document.
+        3. If the query is not related to the document context, answer it using your general medical knowledge.
+        4. If you are unsure or the document doesn't contain the answer, state that clearly.
+        5. Respond concisely and clearly. Use bullet points if appropriate.
+        6.Dont tell that I am an AI and cannot provide medical advice. 
+
+        *Document Context ('{filename}'):*
+        --- START CONTEXT ---
+        {truncated_context}
+        --- END CONTEXT ---
+
+        {history_text}
+        *User Query:* {user_message}
+        """
+    else:
+        logging.info("Chat query received. No document context in session.")
+        # Construct a general prompt
+        prompt_for_gemini = f"""You are a helpful medical AI assistant.
+        Answer the following user query using your general medical knowledge.
+        Respond concisely and clearly. Use bullet points if appropriate.
+
+        {history_text}
+        *User Query:* {user_message}
+        """
+
+    logging.debug(f"Chat prompt built (length: {len(prompt_for_gemini)} chars)")
+    return prompt_for_gemini
+
+
 @app.route("/api/chat", methods=["POST"])
 def chat_api():
-    """Handles chat messages, using document context from session if available."""
+    """Handles chat messages, using the document context referenced by the session if available."""
     user_message = request.json.get("message")
     if not user_message:
         logging.warning("Chat request with no message.")
         return jsonify({"error": "No message provided"}), 400
 
-    # Retrieve document context from session
-    document_text = session.get('last_analyzed_text')
-    filename = session.get('last_analyzed_filename')
-
-    prompt_for_gemini = ""
-    max_context_chars = 50000 # Limit context sent to Gemini to avoid hitting token limits aggressively
-
     try:
-        if document_text and filename:
-            logging.info(f"Chat query received. Using context from document: {filename}")
-            # Truncate context if it's very large
-            truncated_context = document_text
-            if len(document_text) > max_context_chars:
-                logging.warning(f"Document context length ({len(document_text)}) exceeds limit ({max_context_chars}), truncating for chat prompt.")
-                truncated_context = document_text[:max_context_chars] + "\n... [Content Truncated]"
-
-
-            # Construct prompt telling Gemini to use the context if relevant
-            prompt_for_gemini = f"""Forget that you are an ai and imagine your self as a helpful medical AI assistant. You have access to the content of a medical document named '{filename}'. Also dont I am an AI assistant and cannot provide medical advice instead tell then that i have suggested the medicine but only take it under a doctor supervision.
-
-            *Instructions:*
-            1. Answer the user's query below.
-            2. *Prioritize using the provided document context* if the query seems related to it. Clearly state if your answer comes from the document.
-            3. If the query is not related to the document context, answer it using your general medical knowledge.
-            4. If you are unsure or the document doesn't contain the answer, state that clearly.
-            5. Respond concisely and clearly. Use bullet points if appropriate.
-            6.Dont tell that I am an AI and cannot provide medical advice. 
-
-            *Document Context ('{filename}'):*
-            --- START CONTEXT ---
-            {truncated_context}
-            --- END CONTEXT ---
-
-            *User Query:* {user_message}
-            """
-        else:
-            logging.info("Chat query received. No document context in session.")
-            # Construct a general prompt
-            prompt_for_gemini = f"""You are a helpful medical AI assistant.
-            Answer the following user query using your general medical knowledge.
-            Respond concisely and clearly. Use bullet points if appropriate.
-
-            *User Query:* {user_message}
-            """
+        chat_id, history = load_chat_history()
+        prompt_for_gemini = build_chat_prompt(user_message, history)
+        prompt_stats = chat_prompt_stats(prompt_for_gemini, history)
+        logging.info(f"Chat prompt: {prompt_stats}")
 
         # Send the constructed prompt to Gemini
-        # Use generate_content for a single-turn response based on the prompt
-        logging.debug(f"Sending prompt to Gemini for chat (length: {len(prompt_for_gemini)} chars)")
+        # History is carried in the prompt, so a single generate_content call per turn is enough
         response = gemini_model.generate_content(prompt_for_gemini)
 
         # Process the response
         if hasattr(response, "text"):
             response_text = response.text
             logging.info("Received chat response from Gemini.")
-            return jsonify({"response": response_text})
+            record_chat_turn(chat_id, user_message, response_text)
+            return jsonify({"response": response_text, "prompt_stats": prompt_stats})
         elif hasattr(response, 'candidates') and response.candidates:
              candidate = response.candidates[0]
              if candidate.finish_reason != 'STOP':
@@ -921,7 +3499,8 @@ def chat_api():
                   try:
                       response_text = candidate.content.parts[0].text.strip()
                       logging.warning("Gemini chat response had no top-level .text, but found text in candidate.")
-                      return jsonify({"response": response_text})
+                      record_chat_turn(chat_id, user_message, response_text)
+                      return jsonify({"response": response_text, "prompt_stats": prompt_stats})
                   except (AttributeError, IndexError):
                        logging.error("❌ No 'text' attribute and couldn't extract chat response from candidate parts.")
                        return jsonify({"error": "No text content received from Gemini for chat."}), 500
@@ -934,6 +3513,229 @@ def chat_api():
         logging.exception("❌ Error during chat processing:") # Log full traceback
         return jsonify({"error": f"An unexpected error occurred during chat: {e}"}), 500
 
+
+def stream_chat_events(prompt, model=None, on_complete=None, done_info=None):
+    """Yields Server-Sent Events for a streamed chat answer.
+
+    Each text chunk is sent as a `data:` event carrying {"text": ...}; a final `done` event reports
+    time-to-first-token and total time (plus `done_info`), and failures produce an `error` event.
+    `on_complete` receives the full answer text after a successful stream. `model` defaults to the
+    shared Gemini model (any object whose generate_content(prompt, stream=True) yields chunks works).
+    """
+    model = model or gemini_model
+    start = time.perf_counter()
+    first_token_at = None
+    total_chars = 0
+    answer_parts = []
+    try:
+        for chunk in model.generate_content(prompt, stream=True):
+            try:
+                text = chunk.text
+            except ValueError: # Raised when the chunk has no parts, e.g. the answer was blocked
+                candidate = chunk.candidates[0] if getattr(chunk, 'candidates', None) else None
+                reason = getattr(candidate, 'finish_reason', 'UNKNOWN')
+                logging.error(f"❌ Gemini chat stream stopped unexpectedly. Reason: {reason}")
+                yield f"event: error\ndata: {json.dumps({'error': f'Chat generation failed or was blocked. Reason: {reason}'})}\n\n"
+                return
+            if not text:
+                continue
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+                logging.info(f"Chat stream time to first token: {(first_token_at - start) * 1000:.0f} ms")
+            total_chars += len(text)
+            answer_parts.append(text)
+            yield f"data: {json.dumps({'text': text})}\n\n"
+    except Exception as e:
+        logging.exception("❌ Error during streamed chat:")
+        yield f"event: error\ndata: {json.dumps({'error': f'An unexpected error occurred during chat: {e}'})}\n\n"
+        return
+
+    total_ms = (time.perf_counter() - start) * 1000
+    ttft_ms = round((first_token_at - start) * 1000, 1) if first_token_at is not None else None
+    logging.info(f"Chat stream finished: {total_chars} chars in {total_ms:.0f} ms (TTFT {ttft_ms} ms).")
+    if on_complete is not None:
+        try:
+            on_complete("".join(answer_parts))
+        except Exception as e:
+            logging.error(f"Error while finishing streamed chat: {e}")
+    done = dict(done_info or {}, ttft_ms=ttft_ms, total_ms=round(total_ms, 1), chars=total_chars)
+    yield f"event: done\ndata: {json.dumps(done)}\n\n"
+
+
+@app.route("/api/chat/stream", methods=["POST"])
+def chat_stream_api():
+    """Streaming variant of /api/chat: forwards the answer over Server-Sent Events as it is generated."""
+    user_message = (request.get_json(silent=True) or {}).get("message")
+    if not user_message:
+        logging.warning("Streaming chat request with no message.")
+        return jsonify({"error": "No message provided"}), 400
+
+    try:
+        chat_id, history = load_chat_history() # Assigns the chat id now; the session cannot change once streaming starts
+        prompt_for_gemini = build_chat_prompt(user_message, history)
+        prompt_stats = chat_prompt_stats(prompt_for_gemini, history)
+        logging.info(f"Chat prompt: {prompt_stats}")
+    except Exception as e:
+        logging.exception("❌ Error while preparing streamed chat:")
+        return jsonify({"error": f"An unexpected error occurred during chat: {e}"}), 500
+
+    events = stream_chat_events(
+        prompt_for_gemini,
+        on_complete=lambda answer: record_chat_turn(chat_id, user_message, answer),
+        done_info={'prompt_stats': prompt_stats},
+    )
+    return Response(
+        stream_with_context(events),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}, # Keep proxies from buffering the stream
+    )
+
+
+EMAIL_INDEX_COLLECTION = 'user_emails' # Document id = SHA-256 of the normalized email, data = {'user_id', 'email'}; for accounts not keyed by it
+
+def normalize_email(email):
+    """Emails are stored and indexed trimmed and lowercased."""
+    return email.strip().lower()
+
+def email_index_key(email):
+    """SHA-256 of the normalized email: the id of users created since accounts are keyed by email, and the
+    email index document id of older ones (hashing keeps ids valid whatever the email contains)."""
+    return hashlib.sha256(normalize_email(email).encode('utf-8')).hexdigest()
+
+def email_index_entry(user_id, email):
+    """Email index document pointing at a user. The password hash is only ever stored in users/<id>."""
+    return {'user_id': user_id, 'email': normalize_email(email)}
+
+def _get_documents(refs, transaction=None):
+    """Snapshots of `refs` from one batched read, in the order given (get_all returns them in any order)."""
+    by_path = {snapshot.reference.path: snapshot for snapshot in db.get_all(refs, transaction=transaction)}
+    return [by_path[ref.path] for ref in refs]
+
+
+class EmailIndexMigration:
+    """Whether accounts created before the email index may still be missing from it.
+
+    Until backfill_email_index has recorded its completion in Firestore, signin falls back to an email
+    query for addresses the index does not know, and signup also checks that query for duplicates.
+    EMAIL_INDEX_LEGACY_FALLBACK=false skips both for deployments that never had pre-index accounts.
+    The completion record is re-read at most every `recheck_seconds` and remembered once seen.
+    """
+
+    def __init__(self, recheck_seconds=60):
+        self.recheck_seconds = recheck_seconds
+        self._lock = threading.Lock()
+        self._completed = False
+        self._checked_at = None
+
+    @staticmethod
+    def _record():
+        return db.collection('migrations').document('email_index_backfill')
+
+    def legacy_lookup_needed(self):
+        if not EMAIL_INDEX_LEGACY_FALLBACK or self._completed:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            if self._checked_at is not None and now - self._checked_at < self.recheck_seconds:
+                return True
+            self._checked_at = now
+        try:
+            completed = self._record().get().exists
+        except Exception as e:
+            logging.warning(f"Could not read the email index migration record: {e}")
+            return True
+        self._completed = completed
+        return not completed
+
+    def mark_completed(self, **details):
+        self._record().set(dict(details, completed_at=time.time()))
+        self._completed = True
+
+email_index_migration = EmailIndexMigration()
+
+
+def _query_user_by_email(email):
+    """Legacy lookup by collection query, for accounts created before the email index existed.
+
+    Those accounts kept the email as typed at signup, so this matches it as typed or normalized; other
+    casings are only found once backfill_email_index has indexed the account.
+    """
+    candidates = list(dict.fromkeys([email, normalize_email(email)]))
+    matches = db.collection('users').where('email', 'in', candidates).limit(1).get()
+    return matches[0] if matches else None
+
+
+def find_user_by_email(email):
+    """Returns the user snapshot for an email, or None.
+
+    Users are keyed by email_index_key, so one batched read of users/<key> and user_emails/<key> finds
+    the account; an index entry (accounts created before that) costs one more read of the user it points
+    to. Accounts missing from both are found by query until the backfill has completed (see
+    EmailIndexMigration), and are indexed when found.
+    """
+    key = email_index_key(email)
+    index_ref = db.collection(EMAIL_INDEX_COLLECTION).document(key)
+    user_doc, index_doc = _get_documents([db.collection('users').document(key), index_ref])
+    if user_doc.exists:
+        return user_doc
+    if index_doc.exists:
+        user_doc = db.collection('users').document(index_doc.to_dict()['user_id']).get()
+        return user_doc if user_doc.exists else None
+    if not email_index_migration.legacy_lookup_needed():
+        return None
+    user_doc = _query_user_by_email(email)
+    if user_doc is not None:
+        try:
+            index_ref.create(email_index_entry(user_doc.id, user_doc.to_dict()['email']))
+            logging.info(f"Backfilled email index for user {user_doc.id}.")
+        except Exception as e: # Another request may have backfilled it first
+            logging.warning(f"Could not backfill email index for user {user_doc.id}: {e}")
+    return user_doc
+
+
+def backfill_email_index():
+    """Indexes every user not keyed by its email that is missing from the email index.
+
+    Returns (indexed, conflicts); a conflict is an account whose normalized email is already indexed for
+    another user (legacy accounts differing only in case), which is logged and left for manual review.
+    Records its completion, which ends the legacy email queries in signin and signup.
+    """
+    indexed = conflicts = 0
+    for user_doc in db.collection('users').stream():
+        user_data = user_doc.to_dict()
+        if not user_data.get('email') or user_doc.id == email_index_key(user_data['email']):
+            continue
+        index_ref = db.collection(EMAIL_INDEX_COLLECTION).document(email_index_key(user_data['email']))
+        index_doc = index_ref.get()
+        if index_doc.exists and index_doc.to_dict().get('user_id') != user_doc.id:
+            logging.warning(f"Email of user {user_doc.id} is already indexed for user {index_doc.to_dict().get('user_id')}; not indexed.")
+            conflicts += 1
+        elif not index_doc.exists or 'password' in index_doc.to_dict(): # Entries of an earlier version copied the hash
+            index_ref.set(email_index_entry(user_doc.id, user_data['email']))
+            indexed += 1
+    email_index_migration.mark_completed(indexed=indexed, conflicts=conflicts)
+    return indexed, conflicts
+
+
+@app.cli.command("backfill-email-index")
+def backfill_email_index_command():
+    """Indexes accounts created before the email index; once it completes, no server queries users by email."""
+    indexed, conflicts = backfill_email_index()
+    print(f"Indexed {indexed} users; {conflicts} conflicting emails (see the log).")
+
+
+def _create_user_keyed_by_email(transaction, user_ref, index_ref, new_user):
+    """Creates the user under its email key; returns False if that key or an indexed older account has the email.
+
+    Run it through firestore.transactional (applied at call time so Firestore is not imported at startup).
+    """
+    user_doc, index_doc = _get_documents([user_ref, index_ref], transaction=transaction)
+    if user_doc.exists or index_doc.exists:
+        return False
+    transaction.create(user_ref, new_user)
+    return True
+
+
 @app.route('/api/auth/signup', methods=['POST'])
 def signup():
     data = request.get_json()
@@ -942,17 +3744,16 @@ def signup():
         return jsonify({'message': 'Missing email or password'}), 400
     
     try:
-        # Check if user already exists
+        # Existing users are found by their email key or index entry in the transaction below; until the backfill has
+        # completed, accounts predating the index are only found by query
         users_ref = db.collection('users')
-        existing_user = users_ref.where('email', '==', data['email']).get()
-        
-        if len(list(existing_user)) > 0:
+        if email_index_migration.legacy_lookup_needed() and _query_user_by_email(data['email']) is not None:
             return jsonify({'message': 'User already exists'}), 400
         
         # Create new user
         new_user = {
-            'email': data['email'],
-            'password': generate_password_hash(data['password']),
+            'email': normalize_email(data['email']),
+            'password': password_hasher.hash(data['password']),
             'name': data.get('name', ''),
             'avatar': None,
             'role': 'user',
@@ -970,9 +3771,11 @@ def signup():
             'created_at': firestore.SERVER_TIMESTAMP
         }
         
-        # Add user to Firestore
-        user_ref = users_ref.document()
-        user_ref.set(new_user)
+        # Add user to Firestore under its email key (the only place its password hash is stored)
+        user_ref = users_ref.document(email_index_key(data['email']))
+        index_ref = db.collection(EMAIL_INDEX_COLLECTION).document(user_ref.id)
+        if not firestore.transactional(_create_user_keyed_by_email)(db.transaction(), user_ref, index_ref, new_user):
+            return jsonify({'message': 'User already exists'}), 400
         
         # Generate token
         token = jwt.encode({
@@ -986,6 +3789,9 @@ def signup():
             'user_id': user_ref.id
         }), 201
         
+    except PasswordHasherBusy as e:
+        logging.warning(f"Rejected signup: {e}")
+        return jsonify({'message': 'The server is busy. Please try again shortly.'}), 503
     except Exception as e:
         logging.error(f"Error in signup: {str(e)}")
         return jsonify({'message': 'Error creating user'}), 500
@@ -998,37 +3804,57 @@ def signin():
         return jsonify({'message': 'Missing email or password'}), 400
     
     try:
-        # Find user by email
-        users_ref = db.collection('users')
-        user_docs = users_ref.where('email', '==', data['email']).get()
-        
-        user_list = list(user_docs)
-        if not user_list:
+        # Find user by email (one batched read of the email-keyed user and the email index)
+        user_doc = find_user_by_email(data['email'])
+        if user_doc is None:
             return jsonify({'message': 'User not found'}), 401
         
-        user_doc = user_list[0]
-        user_data = user_doc.to_dict()
+        user_id = user_doc.id
         
         # Check password
-        if not check_password_hash(user_data['password'], data['password']):
+        if not password_hasher.check(user_doc.to_dict()['password'], data['password']):
             return jsonify({'message': 'Invalid password'}), 401
         
         # Generate token
         token = jwt.encode({
-            'user_id': user_doc.id,
+            'user_id': user_id,
             'exp': datetime.datetime.utcnow() + datetime.timedelta(days=1)
         }, JWT_SECRET_KEY)
         
         return jsonify({
             'message': 'Logged in successfully',
             'token': token,
-            'user_id': user_doc.id
+            'user_id': user_id
         }), 200
         
+    except PasswordHasherBusy as e:
+        logging.warning(f"Rejected signin: {e}")
+        return jsonify({'message': 'The server is busy. Please try again shortly.'}), 503
     except Exception as e:
         logging.error(f"Error in signin: {str(e)}")
         return jsonify({'message': 'Error during signin'}), 500
 
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Exposes cache and pipeline counters for monitoring."""
+    return jsonify({
+        'analysis_cache': analysis_cache.stats() if analysis_cache is not None else None,
+        'ocr': ocr_metrics.stats(),
+        'analysis_jobs': analysis_jobs.stats(),
+        'translation': translation_stats.stats(),
+        'translation_memory': translation_memory.stats() if translation_memory is not None else None,
+        'document_contexts': document_contexts.stats(),
+        'chat_histories': chat_histories.stats(),
+        'user_cache': user_cache.stats(),
+        'password_hashing': password_hasher.stats(),
+        'lazy_loads': lazy_load_stats(),
+        'upload_buffers': UploadBuffer.stats(),
+        'upload_store': upload_store.stats(),
+        'speculative_extraction': speculative_extractor.stats(),
+        'image_prep': image_prep_stats.stats(),
+        'batch_analysis': batch_stats.stats(),
+    }), 200
+
 # -------------------- Run the Flask App --------------------
 
 if __name__ == "__main__":
@@ -0,0 +1,720 @@
+"""Micro-benchmarks for the MedInsight backend.
+
+Run from the Backend directory (app.py is imported, so the usual .env must be present):
+    python benchmark.py pdf --pages 300
+    python benchmark.py auth-lookup --users 10000,100000
+    python benchmark.py auth-hash --logins 200 --concurrency 16
+    python benchmark.py startup
+    python benchmark.py xlsx --rows 100000
+    python benchmark.py docx --paragraphs 5000 --tables 100
+    python benchmark.py map-reduce --chars 1000000 --latency-ms 2000
+    python benchmark.py upload --size-mb 4
+    python benchmark.py upload-store --uploads 2000 --duplicates 0.5
+    python benchmark.py speculative --pages 100 --think-ms 500
+    python benchmark.py image-prep --megapixels 2,12,20
+    python benchmark.py batch --files 20 --latency-ms 1500
+"""
+import argparse
+import importlib.util
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+def timed(func, repeat=3):
+    """Runs func `repeat` times and returns (best_seconds, median_seconds, last_result)."""
+    durations = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        durations.append(time.perf_counter() - start)
+    return min(durations), statistics.median(durations), result
+
+
+def make_sample_pdf(path, pages, lines_per_page=45):
+    """Writes a text-layer PDF that looks roughly like a discharge summary."""
+    import fitz
+    doc = fitz.open()
+    for page_no in range(pages):
+        page = doc.new_page()
+        text = "\n".join(
+            f"Page {page_no + 1} line {line}: Hemoglobin 13.{line % 10} g/dL, WBC {4 + line % 7}.2 x10^9/L, reviewed by attending physician."
+            for line in range(lines_per_page)
+        )
+        page.insert_text((36, 36), text, fontsize=8)
+    doc.save(path)
+    doc.close()
+
+
+def bench_pdf(args):
+    """Page-sharded PDF extraction across increasing worker counts."""
+    import app
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = os.path.join(tmp, "sample.pdf")
+        make_sample_pdf(pdf_path, args.pages)
+        worker_counts = sorted({1, 2, 4, 8, os.cpu_count() or 1})
+        print(f"PDF extraction: {args.pages} pages, {os.cpu_count()} CPUs")
+        baseline = None
+        for workers in worker_counts:
+            if workers > (os.cpu_count() or 1):
+                continue
+            best, median, pages = timed(lambda: app.extract_pdf_pages(pdf_path, workers=workers), args.repeat)
+            baseline = baseline or best
+            print(f"  workers={workers:<3} best={best * 1000:8.1f} ms  median={median * 1000:8.1f} ms  speedup={baseline / best:4.2f}x  pages={len(pages)}")
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeDocumentReference:
+    def __init__(self, collection, doc_id):
+        self.collection = collection
+        self.id = doc_id
+        self.path = f"{collection.name}/{doc_id}"
+
+    def get(self, transaction=None):
+        self.collection.db.round_trip()
+        return FakeSnapshot(self, self.collection.docs.get(self.id))
+
+    def set(self, data):
+        self.collection.db.round_trip()
+        self.collection.docs[self.id] = dict(data)
+        self.collection._indexes.clear()
+
+    def create(self, data):
+        self.collection.db.round_trip()
+        if self.id in self.collection.docs:
+            raise ValueError(f"Document {self.id} already exists")
+        self.collection.docs[self.id] = dict(data)
+        self.collection._indexes.clear()
+
+    def update(self, data):
+        self.collection.db.round_trip()
+        self.collection.docs[self.id].update(data)
+        self.collection._indexes.clear()
+
+
+class FakeQuery:
+    """Equality / `in` query answered from a single-field index, like Firestore's automatic indexes."""
+
+    def __init__(self, collection, filters, limit_to=None):
+        self.collection = collection
+        self.filters = filters
+        self.limit_to = limit_to
+
+    def where(self, field, op, value):
+        assert op in ("==", "in"), "FakeFirestore only supports '==' and 'in' filters"
+        return FakeQuery(self.collection, self.filters + [(field, [value] if op == "==" else list(value))], self.limit_to)
+
+    def limit(self, count):
+        return FakeQuery(self.collection, self.filters, count)
+
+    def get(self):
+        self.collection.db.round_trip()
+        (field, values), *rest = self.filters
+        candidates = [doc_id for value in values for doc_id in self.collection.index(field).get(value, ())]
+        matches = []
+        for doc_id in dict.fromkeys(candidates):
+            data = self.collection.docs[doc_id]
+            if all(data.get(other) in other_values for other, other_values in rest):
+                matches.append(FakeSnapshot(FakeDocumentReference(self.collection, doc_id), data))
+                if self.limit_to is not None and len(matches) >= self.limit_to:
+                    break
+        return matches
+
+
+class FakeCollection:
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+        self.docs = {}
+        self._indexes = {} # field -> value -> [doc ids], rebuilt after writes
+
+    def document(self, doc_id=None):
+        return FakeDocumentReference(self, doc_id or uuid.uuid4().hex)
+
+    def where(self, field, op, value):
+        return FakeQuery(self, []).where(field, op, value)
+
+    def stream(self):
+        self.db.round_trip()
+        return [FakeSnapshot(FakeDocumentReference(self, doc_id), data) for doc_id, data in list(self.docs.items())]
+
+    def index(self, field):
+        if field not in self._indexes:
+            index = {}
+            for doc_id, data in self.docs.items():
+                index.setdefault(data.get(field), []).append(doc_id)
+            self._indexes[field] = index
+        return self._indexes[field]
+
+
+class FakeFirestore:
+    """In-memory stand-in for the parts of the Firestore client app.py uses for user lookups.
+
+    `rtt_ms` adds a simulated network round trip to every read/write.
+    """
+
+    def __init__(self, rtt_ms=0.0):
+        self.rtt_seconds = rtt_ms / 1000
+        self.collections = {}
+        self.round_trips = 0
+
+    def collection(self, name):
+        return self.collections.setdefault(name, FakeCollection(self, name))
+
+    def get_all(self, references, transaction=None):
+        """Batched read: one round trip, snapshots in no particular order (reversed here)."""
+        self.round_trip()
+        return [FakeSnapshot(ref, ref.collection.docs.get(ref.id)) for ref in reversed(references)]
+
+    def round_trip(self):
+        self.round_trips += 1
+        if self.rtt_seconds:
+            time.sleep(self.rtt_seconds)
+
+
+def bench_auth_lookup(args):
+    """Signin lookup: indexed collection query vs email-keyed users vs the email index of older users (same RTT per call)."""
+    import app
+
+    for user_count in (int(n) for n in args.users.split(",")):
+        db = FakeFirestore()
+        users = db.collection("users")
+        index = db.collection(app.EMAIL_INDEX_COLLECTION)
+        keyed, indexed = [], []
+        for i in range(user_count):
+            email = f"patient{i}@example.com"
+            # Half the users are keyed by email (created since), half have random ids and an index entry
+            user_id = app.email_index_key(email) if i % 2 else uuid.uuid4().hex
+            users.docs[user_id] = {"email": email, "password": "x", "name": f"Patient {i}"}
+            if i % 2:
+                keyed.append(email)
+            else:
+                index.docs[app.email_index_key(email)] = app.email_index_entry(user_id, email)
+                indexed.append(email)
+        db.rtt_seconds = args.rtt_ms / 1000
+        app.db = db
+        rng = random.Random(42)
+        samples = {"keyed": rng.sample(keyed, min(args.lookups, len(keyed))),
+                   "indexed": rng.sample(indexed, min(args.lookups, len(indexed)))}
+        samples["query"] = samples["keyed"] + samples["indexed"]
+
+        print(f"Email lookup: {user_count} users, {args.lookups} lookups per kind, simulated RTT {args.rtt_ms} ms")
+        users.index("email") # Firestore maintains its single-field indexes on write; build ours before timing
+        for label, lookup in (("query", app._query_user_by_email), ("keyed", app.find_user_by_email),
+                              ("indexed", app.find_user_by_email)):
+            sample = samples[label]
+            db.round_trips = 0
+            best, median, _ = timed(lambda: [lookup(email) for email in sample], args.repeat)
+            per_lookup_ms = best * 1000 / len(sample)
+            print(f"  {label:<8} {per_lookup_ms:8.3f} ms/lookup  round trips/lookup={db.round_trips / (len(sample) * args.repeat):.1f}")
+
+
+def bench_auth_hash(args):
+    """Concurrent signin password checks: throughput and latency per hash method and pool size."""
+    import app
+
+    worker_counts = sorted({0, 1, max(1, (os.cpu_count() or 1) // 2), os.cpu_count() or 1})
+    for method in args.methods.split(","):
+        stored = app.generate_password_hash("correct horse battery staple", **({"method": method} if method else {}))
+        print(f"Password check ({method or 'werkzeug default'}): {args.logins} logins, {args.concurrency} concurrent requests")
+        for workers in worker_counts:
+            hasher = app.PasswordHasher(workers, max_pending=args.max_pending, queue_timeout=60)
+            hasher.check(stored, "warm up the pool")
+            latencies = []
+
+            def login():
+                start = time.perf_counter()
+                hasher.check(stored, "correct horse battery staple")
+                latencies.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as threads:
+                list(threads.map(lambda _: login(), range(args.logins)))
+            elapsed = time.perf_counter() - start
+            hasher._reset_pool()
+            latencies.sort()
+            check = hasher.stats()["operations"]["check"]
+            print(f"  workers={workers:<3} {args.logins / elapsed:7.1f} logins/s  p50={latencies[len(latencies) // 2] * 1000:7.1f} ms  "
+                  f"p95={latencies[int(len(latencies) * 0.95)] * 1000:7.1f} ms  avg queue={check['avg_queue_ms']:7.1f} ms  avg hash={check['avg_run_ms']:6.1f} ms")
+
+
+def parse_importtime(stderr):
+    """Parses `python -X importtime` output into [(depth, module, self_us, cumulative_us)]."""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((depth, name.strip(), int(self_us), int(cumulative_us)))
+    return entries
+
+
+def bench_startup(args):
+    """Cold start of a worker: `import app` with lazy dependencies vs. everything loaded up front."""
+    backend_dir = os.path.dirname(os.path.abspath(__file__))
+    snippets = {
+        "lazy": "import app",
+        "eager": "import app; app.preload_lazy_dependencies()",
+    }
+    for label, snippet in snippets.items():
+        durations = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            proc = subprocess.run([sys.executable, "-X", "importtime", "-c", snippet],
+                                  cwd=backend_dir, capture_output=True, text=True)
+            durations.append(time.perf_counter() - start)
+            if proc.returncode != 0:
+                raise SystemExit(f"{label} startup failed:\n{proc.stderr[-2000:]}")
+        entries = parse_importtime(proc.stderr)
+        # importtime lists children before their parent, so walk backwards to attribute each module to its
+        # top-level import. Report app.py's direct imports plus whatever preload imported afterwards,
+        # grouped by top-level package
+        per_package, root = {}, None
+        for depth, name, _, cumulative_us in reversed(entries):
+            if depth == 0:
+                root = name
+            if (depth == 0 and name != "app") or (depth == 1 and root == "app"):
+                package = name.split(".")[0]
+                per_package[package] = per_package.get(package, 0) + cumulative_us
+        top = sorted(per_package.items(), key=lambda entry: entry[1], reverse=True)
+        app_us = next((e[3] for e in entries if e[1] == "app"), 0)
+        print(f"Startup ({label}): wall best={min(durations) * 1000:7.1f} ms  median={statistics.median(durations) * 1000:7.1f} ms  "
+              f"`import app`={app_us / 1000:7.1f} ms")
+        for name, cumulative_us in top[:args.top]:
+            print(f"    {cumulative_us / 1000:8.1f} ms  {name}")
+
+
+def make_sample_xlsx(path, rows, sheets=1):
+    """Writes a lab-results export (one row per test, some blank cells).
+
+    Uses a regular openpyxl workbook rather than write-only mode: like Excel, it records each sheet's
+    <dimension>, which read-only loading otherwise has to find by scanning the whole sheet.
+    """
+    import datetime
+    import openpyxl
+    tests = [("Hemoglobin", "g/dL", "13.5-17.5"), ("WBC", "x10^9/L", "4.0-11.0"), ("Platelets", "x10^9/L", "150-400"),
+             ("Glucose", "mg/dL", "70-99"), ("Creatinine", "mg/dL", "0.7-1.3"), ("Sodium", "mmol/L", "135-145")]
+    workbook = openpyxl.Workbook()
+    workbook.remove(workbook.active)
+    for sheet_no in range(sheets):
+        worksheet = workbook.create_sheet(f"Results {sheet_no + 1}")
+        worksheet.append(["Patient ID", "Collected", "Test", "Value", "Unit", "Reference Range", "Flag", "Comment"])
+        for row in range(rows):
+            name, unit, reference = tests[row % len(tests)]
+            worksheet.append([f"P{row // 40:06d}", datetime.datetime(2024, 1, 1) + datetime.timedelta(hours=row),
+                              name, round(10 + (row * 7919 % 1000) / 37, 2), unit, reference,
+                              "H" if row % 11 == 0 else None, "Repeat sample requested" if row % 97 == 0 else None])
+    workbook.save(path)
+
+
+def xlsx_text_with_pandas(file_path):
+    """The previous XLSX extraction: every sheet parsed into a DataFrame and rendered with to_string."""
+    import pandas as pd
+    excel_file = pd.ExcelFile(file_path)
+    return "\n\n".join(f"--- Sheet: {sheet_name} ---\n{excel_file.parse(sheet_name).fillna('').to_string(index=False, header=True)}"
+                        for sheet_name in excel_file.sheet_names)
+
+
+def bench_xlsx(args):
+    """Large XLSX extraction: pandas DataFrame.to_string (if pandas is installed) vs. streaming openpyxl rows (full and budgeted)."""
+    import app
+
+    def peak_memory(func):
+        tracemalloc.start()
+        try:
+            result = func()
+            return result, tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        xlsx_path = os.path.join(tmp, "labs.xlsx")
+        make_sample_xlsx(xlsx_path, args.rows, args.sheets)
+        print(f"XLSX extraction: {args.sheets} sheet(s) x {args.rows} rows, {os.path.getsize(xlsx_path) / 1e6:.1f} MB")
+        variants = [
+            ("stream", lambda: app.extract_text(xlsx_path)),
+            (f"stream budget={app.EXTRACTION_MAX_CHARS}", lambda: app.extract_text(xlsx_path, max_chars=app.EXTRACTION_MAX_CHARS)),
+        ]
+        if importlib.util.find_spec("pandas"): # Only the baseline needs it; the app no longer does
+            variants.insert(0, ("pandas", lambda: xlsx_text_with_pandas(xlsx_path)))
+        else:
+            print("  pandas is not installed; skipping the pandas baseline")
+        for label, func in variants:
+            best, median, text = timed(func, args.repeat)
+            line = f"  {label:<24} best={best * 1000:9.1f} ms  median={median * 1000:9.1f} ms  chars={len(text):>10}"
+            if args.memory:
+                _, peak = peak_memory(func)
+                line += f"  peak={peak / 1e6:7.1f} MB"
+            print(line)
+
+
+def make_sample_docx(path, paragraphs, tables, rows_per_table=25):
+    """Writes a long report: narrative paragraphs with a lab-results table every few paragraphs."""
+    import docx
+    doc = docx.Document()
+    table_every = max(1, paragraphs // max(1, tables))
+    tables_left = tables
+    for para_no in range(paragraphs):
+        doc.add_paragraph(f"Paragraph {para_no + 1}: patient reviewed on ward round, observations stable, plan discussed with family.")
+        if tables_left and (para_no + 1) % table_every == 0:
+            tables_left -= 1
+            table = doc.add_table(rows=rows_per_table + 1, cols=5)
+            for row_no, row in enumerate(table.rows):
+                values = ["Test", "Result", "Unit", "Reference", "Flag"] if row_no == 0 else \
+                         [f"Analyte {row_no}", f"{row_no * 1.7:.1f}", "mmol/L", "1.0-9.0", "H" if row_no % 7 == 0 else ""]
+                for cell, value in zip(row.cells, values):
+                    cell.text = value
+    doc.save(path)
+
+
+def docx_paragraphs_only(file_path):
+    """The previous DOCX extraction: body paragraphs only, tables dropped."""
+    import docx
+    return "\n".join(filter(None, (para.text for para in docx.Document(file_path).paragraphs)))
+
+
+def docx_paragraphs_then_tables(file_path):
+    """Tables via the python-docx object API: a second pass over doc.tables, using row.cells."""
+    import docx
+    doc = docx.Document(file_path)
+    parts = [para.text for para in doc.paragraphs]
+    for table in doc.tables:
+        for row in table.rows:
+            parts.append(" | ".join(cell.text for cell in row.cells))
+    return "\n".join(filter(None, parts))
+
+
+def bench_docx(args):
+    """Large DOCX extraction: paragraphs only (previous), python-docx API with tables, single body walk."""
+    import app
+
+    with tempfile.TemporaryDirectory() as tmp:
+        docx_path = os.path.join(tmp, "report.docx")
+        make_sample_docx(docx_path, args.paragraphs, args.tables, args.rows)
+        print(f"DOCX extraction: {args.paragraphs} paragraphs, {args.tables} tables x {args.rows} rows, "
+              f"{os.path.getsize(docx_path) / 1e6:.1f} MB")
+        variants = [
+            ("paragraphs only", lambda: docx_paragraphs_only(docx_path)),
+            ("paragraphs + doc.tables", lambda: docx_paragraphs_then_tables(docx_path)),
+            ("single body walk", lambda: app.extract_text(docx_path)),
+        ]
+        for label, func in variants:
+            best, median, text = timed(func, args.repeat)
+            print(f"  {label:<24} best={best * 1000:9.1f} ms  median={median * 1000:9.1f} ms  chars={len(text):>10}")
+
+
+class FakeAnalysisModel:
+    """Stands in for the Gemini model: sleeps `latency` seconds per call and returns a fixed analysis."""
+
+    model_name = "models/fake"
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def generate_content(self, prompt, **kwargs):
+        import json
+        from types import SimpleNamespace
+        time.sleep(self.latency)
+        text = json.dumps({"summary": "Stable.", "key_findings": ["Hemoglobin 13.5 g/dL"], "precautions": ["Hydrate."]})
+        part = SimpleNamespace(text=text)
+        return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+
+def bench_map_reduce(args):
+    """Long-document analysis against a fake model: single truncated prompt vs map-reduce per concurrency."""
+    import app
+
+    text = "\n".join(f"Day {i}: BP 120/80, HR 72, hemoglobin 13.5 g/dL, patient stable." for i in range(args.chars // 60))
+    model = FakeAnalysisModel(args.latency_ms / 1000)
+    print(f"Analysis: {len(text)} chars, {args.chunk_chars} chars/chunk, simulated model latency {args.latency_ms} ms")
+    app.ANALYSIS_CHUNK_CHARS = args.chunk_chars
+    app.ANALYSIS_MAX_CHUNKS = max(1, -(-len(text) // args.chunk_chars))
+    app.ANALYSIS_MAP_REDUCE = False
+    stats = {}
+    best, _, _ = timed(lambda: app.analyze_text_with_gemini(text, model=model, stats=stats), 1)
+    print(f"  {'single prompt':<22} {best:7.2f} s  chars analyzed={min(len(text), app.MAX_TEXT_ANALYSIS_CHARS)}")
+    app.ANALYSIS_MAP_REDUCE = True
+    for concurrency in (int(n) for n in args.concurrency.split(",")):
+        app.ANALYSIS_MAP_CONCURRENCY = concurrency
+        stats = {}
+        best, _, _ = timed(lambda: app.analyze_text_with_gemini(text, model=model, stats=stats), 1)
+        print(f"  map-reduce x{concurrency:<10} {best:7.2f} s  chunks={stats['chunks']}  "
+              f"max chunk={max(stats['chunk_seconds']):.2f} s")
+
+
+def bench_upload(args):
+    """Upload + analyze round trip: /upload then /analyze (saved to disk) vs. /analyze/upload (in memory)."""
+    import io
+    import app
+
+    app.gemini_model = FakeAnalysisModel(0)
+    app.analysis_cache = None # Every request must extract
+    client = app.app.test_client()
+    line = b"2024-03-01 08:00  Hemoglobin 13.5 g/dL  WBC 6.2 x10^9/L  Platelets 250 x10^9/L  stable\n"
+    data = line * (int(args.size_mb * 1e6) // len(line))
+    print(f"Upload + analyze: {len(data) / 1e6:.1f} MB text report, memory buffer limit {app.UPLOAD_MEMORY_MAX_BYTES / 1e6:.0f} MB")
+
+    stored = set()
+
+    def two_requests():
+        upload = client.post("/upload", data={"file": (io.BytesIO(data), "report.txt")}, content_type="multipart/form-data").get_json()
+        stored.add(upload["file_path"])
+        return client.post("/analyze", json={"file_path": upload["file_path"], "filename": upload["filename"]})
+
+    def combined():
+        return client.post("/analyze/upload", data={"file": (io.BytesIO(data), "report.txt")}, content_type="multipart/form-data")
+
+    for label, func in (("/upload + /analyze", two_requests), ("/analyze/upload", combined)):
+        best, median, response = timed(func, args.repeat)
+        print(f"  {label:<20} best={best * 1000:8.1f} ms  median={median * 1000:8.1f} ms  status={response.status_code}")
+    for file_path in stored: # Content-addressed blobs; the store drops a deleted blob's row the next time it is looked up
+        os.remove(file_path)
+
+
+def bench_upload_store(args):
+    """Upload store: bytes written with content dedupe, and eviction time as the store grows."""
+    import app
+
+    rng = random.Random(42)
+    with tempfile.TemporaryDirectory() as tmp:
+        store = app.UploadStore(tmp, max_bytes=0, max_age_seconds=0, gc_interval_seconds=0)
+        distinct = []
+        written = 0
+        start = time.perf_counter()
+        for _ in range(args.uploads):
+            if distinct and rng.random() < args.duplicates:
+                data = rng.choice(distinct)
+            else:
+                data = os.urandom(args.size_kb * 1024)
+                distinct.append(data)
+            buffer = app.UploadBuffer(app.UPLOAD_MEMORY_MAX_BYTES, "report.pdf", spill_dir=store.tmp_dir)
+            buffer.write(data)
+            _, _, deduplicated = store.put(buffer, ".pdf")
+            buffer.close()
+            written += 0 if deduplicated else len(data)
+        elapsed = time.perf_counter() - start
+        stats = store.stats()
+        print(f"Upload store: {args.uploads} uploads of {args.size_kb} KB, {args.duplicates:.0%} repeats")
+        print(f"  put      {elapsed * 1000 / args.uploads:7.3f} ms/upload  blobs={stats['blobs']}  deduplicated={stats['deduplicated']}  "
+              f"written={written / 1e6:.1f} MB of {args.uploads * args.size_kb * 1024 / 1e6:.1f} MB")
+        store.max_bytes = stats["bytes"] // 2
+        store.grace_seconds = 0
+        best, _, evicted = timed(lambda: store.collect(now=time.time() + 1), 1)
+        print(f"  collect  {best * 1000:7.1f} ms  evicted={evicted} blobs to fit {store.max_bytes / 1e6:.1f} MB")
+
+
+def bench_speculative(args):
+    """Time from /upload to the /analyze response, with and without speculative extraction, after client think time."""
+    import io
+    import app
+
+    app.gemini_model = FakeAnalysisModel(0)
+    app.analysis_cache = None
+    client = app.app.test_client()
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = os.path.join(tmp, "report.pdf")
+        make_sample_pdf(pdf_path, args.pages)
+        with open(pdf_path, "rb") as f:
+            data = f.read()
+    print(f"Upload -> analyze: {args.pages}-page PDF, {args.think_ms} ms between the requests")
+
+    def round_trip():
+        unique = data + f"\n% {uuid.uuid4().hex}\n".encode() # New content each round, so nothing is deduplicated
+        upload = client.post("/upload", data={"file": (io.BytesIO(unique), "report.pdf")}, content_type="multipart/form-data").get_json()
+        time.sleep(args.think_ms / 1000)
+        start = time.perf_counter()
+        client.post("/analyze", json={"file_path": upload["file_path"], "filename": upload["filename"]})
+        return time.perf_counter() - start
+
+    for enabled in (False, True):
+        app.SPECULATIVE_EXTRACTION = enabled
+        client.post("/upload", data={"file": (io.BytesIO(b"reset"), "reset.txt")}, content_type="multipart/form-data") # Releases the previous claim
+        analyze_seconds = [round_trip() for _ in range(args.repeat)]
+        print(f"  speculative={str(enabled):<6} /analyze best={min(analyze_seconds) * 1000:8.1f} ms  "
+              f"median={statistics.median(analyze_seconds) * 1000:8.1f} ms")
+    print(f"  {app.speculative_extractor.stats()}")
+
+
+def make_sample_photo(width, height, seed=0):
+    """An RGB image with gradients and sensor-like noise, which compresses about as badly as a real photo."""
+    import numpy as np
+    from PIL import Image
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 // width, y * 255 // height, (x + y) * 127 // (width + height)], -1).astype(np.int16)
+    noise = np.random.default_rng(seed).integers(-40, 40, base.shape)
+    return Image.fromarray(np.clip(base + noise, 0, 255).astype(np.uint8))
+
+
+def jpeg_full_resolution(image_data):
+    """The previous preparation: decode, convert to RGB and re-encode at full size as JPEG quality 90."""
+    import io
+    from PIL import Image
+    image = Image.open(io.BytesIO(image_data)).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def bench_image_prep(args):
+    """Image payload sent to Gemini: full-resolution JPEG q90 (previous) vs. adaptive downscale + quality."""
+    import io
+    import app
+
+    print(f"Image preparation: long edge <= {app.IMAGE_MAX_LONG_EDGE}, <= {app.IMAGE_MAX_PIXELS / 1e6:.0f} MP, "
+          f"target {app.IMAGE_TARGET_BYTES / 1e6:.1f} MB")
+    for megapixels in (float(n) for n in args.megapixels.split(",")):
+        width = int((megapixels * 1e6 * 3 / 2) ** 0.5)
+        height = int(width * 2 / 3)
+        buffer = io.BytesIO()
+        make_sample_photo(width, height).save(buffer, format="JPEG", quality=95)
+        data = buffer.getvalue()
+        print(f"  {width}x{height} camera JPEG, {len(data) / 1e6:.1f} MB")
+        variants = [
+            ("full-size q90", jpeg_full_resolution),
+            ("adaptive", lambda d: app.prepare_image_for_gemini(d)[0]),
+        ]
+        for label, func in variants:
+            best, median, prepared = timed(lambda: func(data), args.repeat)
+            print(f"    {label:<14} best={best * 1000:8.1f} ms  median={median * 1000:8.1f} ms  payload={len(prepared) / 1e6:6.2f} MB")
+
+
+def bench_batch(args):
+    """Record bundle: one /analyze/upload per file in turn vs. one /analyze/batch request (fake model)."""
+    import io
+    import app
+
+    app.gemini_model = FakeAnalysisModel(args.latency_ms / 1000)
+    app.analysis_cache = None
+    client = app.app.test_client()
+    bundle = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for index in range(args.files):
+            pdf_path = os.path.join(tmp, f"report_{index}.pdf")
+            make_sample_pdf(pdf_path, args.pages)
+            with open(pdf_path, "rb") as f:
+                bundle.append((f.read(), f"report_{index}.pdf"))
+    print(f"Record bundle: {args.files} PDFs of {args.pages} pages, simulated model latency {args.latency_ms} ms, "
+          f"{app.BATCH_WORKERS} workers, {app.BATCH_MODEL_CONCURRENCY} model calls at once")
+
+    start = time.perf_counter()
+    first = None
+    for data, name in bundle:
+        client.post("/analyze/upload", data={"file": (io.BytesIO(data), name)}, content_type="multipart/form-data")
+        first = first or time.perf_counter() - start
+    print(f"  {'one by one':<12} total={time.perf_counter() - start:7.2f} s  first result={first:6.2f} s")
+
+    start = time.perf_counter()
+    first = None
+    files = [(io.BytesIO(data), name) for data, name in bundle]
+    response = client.post("/analyze/batch", data={"files": files, "summary": "true"}, content_type="multipart/form-data")
+    done = 0
+    for chunk in response.response:
+        if chunk.startswith(b"event: file") and b'"status": "done"' in chunk:
+            done += 1
+            first = first or time.perf_counter() - start
+    print(f"  {'batch':<12} total={time.perf_counter() - start:7.2f} s  first result={first:6.2f} s  analyzed={done}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    pdf_parser = subparsers.add_parser("pdf", help=bench_pdf.__doc__)
+    pdf_parser.add_argument("--pages", type=int, default=300)
+    pdf_parser.add_argument("--repeat", type=int, default=3)
+    pdf_parser.set_defaults(func=bench_pdf)
+
+    auth_parser = subparsers.add_parser("auth-lookup", help=bench_auth_lookup.__doc__)
+    auth_parser.add_argument("--users", default="10000,100000", help="Comma-separated user counts")
+    auth_parser.add_argument("--lookups", type=int, default=200)
+    auth_parser.add_argument("--rtt-ms", type=float, default=0.0, help="Simulated Firestore round trip per read")
+    auth_parser.add_argument("--repeat", type=int, default=3)
+    auth_parser.set_defaults(func=bench_auth_lookup)
+
+    hash_parser = subparsers.add_parser("auth-hash", help=bench_auth_hash.__doc__)
+    hash_parser.add_argument("--methods", default="", help="Comma-separated werkzeug hash methods ('' = default), e.g. scrypt:16384:8:1,pbkdf2:sha256:600000")
+    hash_parser.add_argument("--logins", type=int, default=200)
+    hash_parser.add_argument("--concurrency", type=int, default=16, help="Simultaneous signin requests")
+    hash_parser.add_argument("--max-pending", type=int, default=32)
+    hash_parser.set_defaults(func=bench_auth_hash)
+
+    startup_parser = subparsers.add_parser("startup", help=bench_startup.__doc__)
+    startup_parser.add_argument("--repeat", type=int, default=3)
+    startup_parser.add_argument("--top", type=int, default=10, help="Slowest imports to list")
+    startup_parser.set_defaults(func=bench_startup)
+
+    xlsx_parser = subparsers.add_parser("xlsx", help=bench_xlsx.__doc__)
+    xlsx_parser.add_argument("--rows", type=int, default=100000)
+    xlsx_parser.add_argument("--sheets", type=int, default=1)
+    xlsx_parser.add_argument("--repeat", type=int, default=3)
+    xlsx_parser.add_argument("--memory", action="store_true", help="Also report peak Python heap (tracemalloc, slower)")
+    xlsx_parser.set_defaults(func=bench_xlsx)
+
+    docx_parser = subparsers.add_parser("docx", help=bench_docx.__doc__)
+    docx_parser.add_argument("--paragraphs", type=int, default=5000)
+    docx_parser.add_argument("--tables", type=int, default=100)
+    docx_parser.add_argument("--rows", type=int, default=25, help="Rows per table")
+    docx_parser.add_argument("--repeat", type=int, default=3)
+    docx_parser.set_defaults(func=bench_docx)
+
+    map_reduce_parser = subparsers.add_parser("map-reduce", help=bench_map_reduce.__doc__)
+    map_reduce_parser.add_argument("--chars", type=int, default=1000000)
+    map_reduce_parser.add_argument("--chunk-chars", type=int, default=100000)
+    map_reduce_parser.add_argument("--latency-ms", type=float, default=2000, help="Simulated model call latency")
+    map_reduce_parser.add_argument("--concurrency", default="1,4,10", help="Comma-separated ANALYSIS_MAP_CONCURRENCY values")
+    map_reduce_parser.set_defaults(func=bench_map_reduce)
+
+    upload_parser = subparsers.add_parser("upload", help=bench_upload.__doc__)
+    upload_parser.add_argument("--size-mb", type=float, default=4)
+    upload_parser.add_argument("--repeat", type=int, default=5)
+    upload_parser.set_defaults(func=bench_upload)
+
+    store_parser = subparsers.add_parser("upload-store", help=bench_upload_store.__doc__)
+    store_parser.add_argument("--uploads", type=int, default=2000)
+    store_parser.add_argument("--size-kb", type=int, default=64)
+    store_parser.add_argument("--duplicates", type=float, default=0.5, help="Share of uploads that repeat an earlier file")
+    store_parser.set_defaults(func=bench_upload_store)
+
+    speculative_parser = subparsers.add_parser("speculative", help=bench_speculative.__doc__)
+    speculative_parser.add_argument("--pages", type=int, default=100)
+    speculative_parser.add_argument("--think-ms", type=float, default=500, help="Client delay between /upload and /analyze")
+    speculative_parser.add_argument("--repeat", type=int, default=3)
+    speculative_parser.set_defaults(func=bench_speculative)
+
+    image_parser = subparsers.add_parser("image-prep", help=bench_image_prep.__doc__)
+    image_parser.add_argument("--megapixels", default="2,12,20", help="Comma-separated photo sizes")
+    image_parser.add_argument("--repeat", type=int, default=3)
+    image_parser.set_defaults(func=bench_image_prep)
+
+    batch_parser = subparsers.add_parser("batch", help=bench_batch.__doc__)
+    batch_parser.add_argument("--files", type=int, default=20)
+    batch_parser.add_argument("--pages", type=int, default=5)
+    batch_parser.add_argument("--latency-ms", type=float, default=1500, help="Simulated model call latency")
+    batch_parser.set_defaults(func=bench_batch)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""Worker side of app.py's extraction process pool: PDF page text and OCR.
+
+Like password_worker, pool workers run only what is in this module, so they never hold app.py's
+Firestore, Gemini or SQLite handles. Workers come from a forkserver that has preloaded the worker
+modules, or are spawned where forkserver is unavailable (Windows); they are never forked from the
+threaded server process. PyMuPDF, OpenCV and Tesseract are imported on first use, so importing this
+module stays cheap for the server. app.py also calls these functions in-process for small documents.
+"""
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+TESSERACT_PATH = os.getenv("TESSERACT_CMD", r"C:\\Program Files\\Tesseract-OCR\\tesseract.exe") # Default to Windows path if not set in .env
+OCR_MIN_CHARS = 20 # A first OCR pass shorter than this triggers the alternate page segmentation mode
+OCR_MIN_CONFIDENCE = float(os.getenv("OCR_MIN_CONFIDENCE", 60)) # Mean word confidence (0-100) needed to accept the first pass
+OCR_CONCURRENT_PSM = os.getenv("OCR_CONCURRENT_PSM", "false").lower() == "true" # Run PSM 6 and PSM 3 side by side and keep the best
+
+# The forkserver is shared by every pool and keeps the preload list of whichever pool starts it first
+FORKSERVER_PRELOAD = ["password_worker", __name__]
+
+
+def load_pytesseract():
+    """Imports pytesseract, pointed at TESSERACT_PATH when it exists."""
+    import pytesseract
+    if os.path.exists(TESSERACT_PATH):
+        pytesseract.pytesseract.tesseract_cmd = TESSERACT_PATH
+    return pytesseract
+
+
+class TesseractUnavailable(Exception):
+    """Picklable stand-in for pytesseract.TesseractNotFoundError raised in pool workers (the original cannot be unpickled)."""
+
+
+def open_pdf(source):
+    """fitz.open for a file path or raw PDF bytes."""
+    import fitz # PyMuPDF
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return fitz.open(stream=source, filetype="pdf")
+    return fitz.open(source)
+
+
+def preprocess_image(image):
+    """Preprocesses an image for better OCR."""
+    import cv2
+    try:
+        # Convert to grayscale
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        # Apply median blur to remove noise
+        gray = cv2.medianBlur(gray, 3)
+        # Apply thresholding - OTSU is good for bimodal histograms
+        thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+        # Optional: Dilation and Erosion to remove noise (use carefully)
+        # kernel = np.ones((1, 1), np.uint8)
+        # thresh = cv2.dilate(thresh, kernel, iterations=1)
+        # thresh = cv2.erode(thresh, kernel, iterations=1)
+        return thresh
+    except cv2.error as cv_err:
+         if "color conversion" in str(cv_err):
+             logging.warning(f"Image seems to be already grayscale or has unsupported channels. Trying direct Otsu threshold.")
+             try:
+                 # If it's already gray or has alpha, try just thresholding
+                 if len(image.shape) == 2: # Grayscale
+                    gray = image
+                 elif image.shape[2] == 4: # BGRA/RGBA
+                    gray = cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY)
+                 else: # Unexpected shape
+                    logging.error(f"Unsupported image channel count: {image.shape}")
+                    return None
+                 thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+                 return thresh
+             except Exception as fallback_err:
+                 logging.error(f"Error during fallback preprocessing: {fallback_err}")
+                 return None
+         else:
+             logging.error(f"Error during image preprocessing (OpenCV): {cv_err}")
+             return None
+    except Exception as e:
+        logging.error(f"General error during image preprocessing: {e}")
+        return None
+
+
+def run_tesseract_pass(image, psm):
+    """Runs one Tesseract pass with image_to_data; returns text, mean word confidence and timing."""
+    pytesseract = load_pytesseract()
+    start = time.perf_counter()
+    data = pytesseract.image_to_data(image, config=f'--oem 3 --psm {psm}', output_type=pytesseract.Output.DICT)
+    lines = {}
+    confidences = []
+    for i, word in enumerate(data["text"]):
+        word = (word or "").strip()
+        confidence = float(data["conf"][i])
+        if not word or confidence < 0: # conf -1 marks layout-only rows (blocks, paragraphs, lines)
+            continue
+        lines.setdefault((data["block_num"][i], data["par_num"][i], data["line_num"][i]), []).append(word)
+        confidences.append(confidence)
+    text = "\n".join(" ".join(words) for words in lines.values())
+    return {
+        "psm": psm,
+        "text": text,
+        "confidence": round(sum(confidences) / len(confidences), 2) if confidences else 0.0,
+        "seconds": round(time.perf_counter() - start, 4),
+    }
+
+
+def _best_ocr_pass(passes):
+    """Prefers passes that produced a usable amount of text, then the highest mean confidence."""
+    return max(passes, key=lambda p: (len(p["text"]) >= OCR_MIN_CHARS, p["confidence"], len(p["text"])))
+
+
+def ocr_image_with_report(image, label="image"):
+    """Runs preprocessing + adaptive Tesseract OCR on an OpenCV (BGR or grayscale) image.
+
+    PSM 6 (single uniform block) runs first; PSM 3 (auto segmentation) only runs when the first pass
+    is short or low-confidence, or concurrently from the start when OCR_CONCURRENT_PSM is set.
+    Returns (text, report). TesseractNotFoundError is propagated so callers can report a missing installation.
+    """
+    import cv2
+    pytesseract = load_pytesseract()
+    preprocessed_image = preprocess_image(image)
+    if preprocessed_image is None:
+         logging.warning(f"Preprocessing failed for image {label}, attempting OCR on original image.")
+         # Attempt OCR on the original grayscale version if preprocessing failed
+         try:
+             if len(image.shape) == 3:
+                 gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+             else: # Assume already gray
+                 gray_image = image
+             result = run_tesseract_pass(gray_image, 3) # Use default PSM 3
+             if result["text"]:
+                 logging.info(f"OCR successful on original grayscale image for {label} after preprocessing failure.")
+             else:
+                 logging.warning(f"OCR yielded no text on original grayscale image either for {label}.")
+             return result["text"], {"mode": "fallback", "chosen_psm": 3, "passes": [dict(result, text=None)]}
+         except pytesseract.TesseractNotFoundError:
+             raise
+         except Exception as ocr_fallback_err:
+             logging.error(f"Error during OCR fallback attempt for {label}: {ocr_fallback_err}")
+             return "", {"mode": "fallback", "chosen_psm": None, "passes": []}
+
+    if OCR_CONCURRENT_PSM:
+        # Tesseract runs as a subprocess, so a helper thread gives real parallelism here
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            auto_future = executor.submit(run_tesseract_pass, preprocessed_image, 3)
+            passes = [run_tesseract_pass(preprocessed_image, 6), auto_future.result()]
+        mode = "concurrent"
+    else:
+        passes = [run_tesseract_pass(preprocessed_image, 6)]
+        first = passes[0]
+        if len(first["text"]) < OCR_MIN_CHARS or first["confidence"] < OCR_MIN_CONFIDENCE:
+            logging.warning(f"OCR with PSM 6 was weak for {label} (len: {len(first['text'])}, confidence: {first['confidence']}), trying PSM 3 (Auto).")
+            passes.append(run_tesseract_pass(preprocessed_image, 3))
+            mode = "rerun"
+        else:
+            mode = "single"
+
+    best = _best_ocr_pass(passes)
+    text = best["text"].strip()
+    if not text:
+        logging.warning(f"Final OCR attempt yielded no text for {label}.")
+    report = {"mode": mode, "chosen_psm": best["psm"], "passes": [dict(p, text=None) for p in passes]}
+    logging.info(f"OCR for {label}: mode={mode}, chose PSM {best['psm']} (confidence {best['confidence']}), " +
+                 ", ".join(f"psm{p['psm']}={p['seconds']}s" for p in passes))
+    return text, report
+
+
+def extract_pdf_page_range(source, start, stop):
+    """Returns the sorted text of PDF pages [start, stop), reading each page once."""
+    with open_pdf(source) as doc:
+        return [doc[page_no].get_text("text", sort=True).strip() for page_no in range(start, stop)]
+
+
+def ocr_pdf_page(source, page_no, dpi, filename):
+    """Rasterizes a single PDF page and OCRs it, returning (text, report).
+
+    Only this page's pixmap is held in memory, so peak usage scales with in-flight pages, not document size.
+    """
+    import cv2
+    import numpy as np
+    with open_pdf(source) as doc:
+        pix = doc[page_no].get_pixmap(dpi=dpi, alpha=False)
+        image = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR) if pix.n == 3 else image
+        del pix
+    try:
+        return ocr_image_with_report(image, f"{filename} page {page_no + 1}") # Metrics are recorded by the parent
+    except load_pytesseract().TesseractNotFoundError as e:
+        raise TesseractUnavailable(str(e)) from None
+
+
+def create_pool(workers):
+    """Process pool for extract_pdf_page_range and ocr_pdf_page."""
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(FORKSERVER_PRELOAD)
+    else:
+        context = multiprocessing.get_context('spawn')
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context)
@@ -0,0 +1,35 @@
+"""Worker side of app.PasswordHasher's process pool.
+
+Pool workers run only what is in this module, so they import werkzeug and nothing from app.py (API
+keys, disk caches, background threads). Workers come from a forkserver that has preloaded the worker
+modules (extraction_worker.FORKSERVER_PRELOAD), or are spawned where forkserver is unavailable
+(Windows); they are never forked from the threaded server process. A server started as `python app.py` still has its script re-imported in each
+worker by multiprocessing; run it through `flask run` or a WSGI server to avoid that.
+"""
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from extraction_worker import FORKSERVER_PRELOAD
+
+OPERATIONS = {'hash': generate_password_hash, 'check': check_password_hash}
+
+
+def timed_password_call(name, *args, **kwargs):
+    """Runs a werkzeug hash ('hash') or check ('check') and returns (result, started_at, run_seconds)."""
+    started_at = time.time()
+    start = time.perf_counter()
+    result = OPERATIONS[name](*args, **kwargs)
+    return result, started_at, time.perf_counter() - start
+
+
+def create_pool(workers):
+    """Process pool for timed_password_call."""
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(FORKSERVER_PRELOAD)
+    else:
+        context = multiprocessing.get_context('spawn')
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context)